@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+analytics.py -- Registration time series for conference organizers
+
+Every registration and unregistration appends a `RegistrationEvent` to the
+conference's entity group. It is written in the same batch, and the same
+transaction, as the Profile and the seat count. A rollup cron folds the
+events into the conference's `ConferenceStats` and deletes them:
+
+    Conference
+        RegistrationEvent       delta (+1 / -1), created
+        ConferenceStats('stats') registrations and cancellations per day
+
+`getConferenceStats` reads the conference and its stats in one batch get,
+whatever the number of attendees. Events younger than the last rollup are
+not counted yet.
+
+"""
+
+from google.appengine.ext import ndb
+
+from models import ConferenceStats
+from models import ConferenceStatsForm
+from models import DailyRegistrationsForm
+from models import RegistrationEvent
+
+# events folded per conference and transaction (a commit holds at most 500 writes)
+ROLLUP_BATCH_SIZE = 400
+# events scanned by a rollup to find the conferences that have pending events
+ROLLUP_SCAN_SIZE = 1000
+
+
+def statsKey(conf_key):
+    """Return the key of the registration stats of `conf_key`."""
+    return ndb.Key(ConferenceStats, 'stats', parent=conf_key)
+
+
+def registrationEvent(conf_key, delta):
+    """Return the (unsaved) event of a registration (+1) or unregistration (-1)."""
+    return RegistrationEvent(parent=conf_key, delta=delta)
+
+
+@ndb.transactional()
+def _rollupConference(conf_key):
+    """Fold a batch of pending events of `conf_key` into its stats and delete them.
+    Returns the number of events folded.
+    """
+    events = RegistrationEvent.query(ancestor=conf_key).fetch(ROLLUP_BATCH_SIZE)
+    if not events:
+        return 0
+    conf, stats = ndb.get_multi([conf_key, statsKey(conf_key)])
+    if not conf or conf.deleted:
+        # the conference's stats are deleted with it
+        ndb.delete_multi([event.key for event in events])
+        return len(events)
+    if not stats:
+        stats = ConferenceStats(key=statsKey(conf_key), days={})
+        # registrations made before the event log count from the start
+        pending = RegistrationEvent.query(ancestor=conf_key).fetch()
+        attendees = (conf.maxAttendees or 0) - (conf.seatsAvailable or 0)
+        stats.baseline = attendees - sum(event.delta for event in pending)
+
+    for event in events:
+        day = stats.days.setdefault(event.created.strftime('%Y-%m-%d'), [0, 0])
+        day[0 if event.delta > 0 else 1] += abs(event.delta)
+    stats.put()
+    ndb.delete_multi([event.key for event in events])
+    return len(events)
+
+
+def rollup():
+    """Fold the pending events of every conference into its stats.
+    Returns the number of events folded.
+    """
+    keys = RegistrationEvent.query().fetch(ROLLUP_SCAN_SIZE, keys_only=True)
+    conf_keys = []
+    for key in keys:
+        if key.parent() not in conf_keys:
+            conf_keys.append(key.parent())
+    return sum(_rollupConference(conf_key) for conf_key in conf_keys)
+
+
+def toForm(conf, stats):
+    """Return the ConferenceStatsForm of `conf`: daily registrations, cancellations, attendees and fill rate."""
+    form = ConferenceStatsForm(websafeConferenceKey=conf.key.urlsafe(), maxAttendees=conf.maxAttendees,
+                               attendees=(conf.maxAttendees or 0) - (conf.seatsAvailable or 0))
+    attendees = stats.baseline if stats else 0
+    for date in sorted(stats.days if stats else {}):
+        registrations, cancellations = stats.days[date]
+        attendees += registrations - cancellations
+        form.days.append(DailyRegistrationsForm(
+            date=date, registrations=registrations, cancellations=cancellations, attendees=attendees,
+            fillRate=float(attendees) / conf.maxAttendees if conf.maxAttendees else None))
+    return form
@@ -1,5 +1,16 @@
+import os
+
+from google.appengine.ext import vendor
+
+# third-party libraries installed with `pip install -t lib`, such as the GCS
+# client library used by export.py's gcs sink
+if os.path.isdir(os.path.join(os.path.dirname(__file__), 'lib')):
+    vendor.add(os.path.join(os.path.dirname(__file__), 'lib'))
+
 
 def webapp_add_wsgi_middleware(app):
-    """" Wrap WSGI application with the appstats middleware. """
+    """" Wrap WSGI application with the profiler, metrics and appstats middleware. """
     from google.appengine.ext.appstats import recording
-    return recording.appstats_wsgi_middleware(app)
+    from metrics import metrics_wsgi_middleware
+    from profiler import profiler_wsgi_middleware
+    return recording.appstats_wsgi_middleware(metrics_wsgi_middleware(profiler_wsgi_middleware(app)))
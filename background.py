@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+background.py -- Background work behind the cron and task handlers
+
+The announcement, featured speaker and confirmation email logic used by
+`main.py`. It is kept apart from `conference.py`, so task and cron
+instances don't load the Endpoints API surface (every ProtoRPC resource
+container and the `endpoints.api_server` registration). Models and other
+modules are imported by the functions that need them.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+MEMCACHE_FEATURED_SPEAKER_KEY = 'FEATURED_SPEAKERS'
+
+
+def cacheAnnouncement():
+    """Create Announcement & assign to memcache; used by
+    memcache cron job & putAnnouncement().
+    """
+    from models import Conference
+    confs = Conference.query(ndb.AND(
+        Conference.seatsAvailable <= 5,
+        Conference.seatsAvailable > 0)
+    ).fetch(projection=[Conference.name])
+
+    if confs:
+        # If there are almost sold out conferences,
+        # format announcement and set it in memcache
+        announcement = ANNOUNCEMENT_TPL % (
+            ', '.join(conf.name for conf in confs))
+        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    else:
+        # If there are no sold out conferences,
+        # delete the memcache announcements entry
+        announcement = ""
+        memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+
+    return announcement
+
+
+def setFeaturedSpeaker(conf_key, speakerName):
+    """Make `speakerName` the featured speaker if they have more than one session in `conf_key`.
+    Returns the new featured speaker message, or None if it wasn't updated.
+    """
+    from models import Session, Speaker
+    speaker = Speaker(name=speakerName)
+    # get all sessions registered to this conference filtered by speaker
+    featured_sessions = Session.query(ancestor=conf_key).filter(Session.speaker == speaker).fetch()
+
+    # If speaker is registered to more than one session, update featured speaker
+    if len(featured_sessions) > 1:
+        session_names = [session.name for session in featured_sessions]
+        message = speaker.name + ': ' + ', '.join(session_names)
+        memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, message)
+        return message
+    return None
+
+
+def queueConfirmationEmail(conf_key):
+    """Queue the email confirming the creation of `conf_key` in the outbox."""
+    import outbox
+    conf = conf_key.get()
+    if not conf:
+        # the conference is gone, nothing to confirm
+        return None
+    # the organizer's Profile is the conference's parent
+    prof = conf.key.parent().get()
+    return outbox.queueConfirmation(conf, prof)
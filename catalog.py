@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+catalog.py -- Bitmap-indexed in-memory catalog of conferences
+
+A cron job numbers every conference by name and stores, in one
+compressed `ConferenceCatalog` entity:
+
+    conferences     websafe keys, one row per conference
+    bitmaps         city, topic and month -> bitmap of rows (a Python int)
+    columns         maxAttendees and seatsAvailable: values and rows,
+                    sorted by value
+
+Instances decode the catalog once and keep it in memory, checking for a
+newer one every CATALOG_CHECK_SECONDS. A filter resolves to a bitmap:
+equalities pick one bitmap, inequalities OR the bitmaps of a range of
+the sorted vocabulary, or take a slice of a sorted column. Filters are
+AND-ed, so any combination of them needs no composite index. Only the
+matching conferences are loaded, with one `get_multi`.
+
+The catalog is as old as its last rebuild. Loaded conferences are checked
+against the filters again, so changed values (like `seatsAvailable`)
+never yield a wrong match. Conferences that only started matching, or
+were created, since the rebuild are missed until the next one.
+
+"""
+
+import bisect
+import operator
+import threading
+import time
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceCatalog
+
+CATALOG_KEY = ndb.Key(ConferenceCatalog, 'latest')
+# conferences indexed by a catalog; bounds the entity size
+CATALOG_MAX_CONFERENCES = 20000
+# seconds an instance serves its catalog before checking for a newer one
+CATALOG_CHECK_SECONDS = 60
+BITMAP_FIELDS = ('city', 'topics', 'month')
+COLUMN_FIELDS = ('maxAttendees', 'seatsAvailable')
+
+# (time checked, Catalog) of the catalog this instance serves
+_loaded = {}
+_lock = threading.Lock()
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class Catalog(object):
+    """A decoded catalog: rows of conference keys and their bitmap and sorted column indexes."""
+
+    def __init__(self, entity):
+        self.computed = entity.computed
+        self.keys = [ndb.Key(urlsafe=websafeKey) for websafeKey in entity.conferences]
+        self.all = (1 << len(self.keys)) - 1
+        self.bitmaps = {}
+        self.vocabularies = {}
+        for field in BITMAP_FIELDS:
+            bitmaps = entity.bitmaps[field]
+            if field == 'month':
+                # JSON object keys are strings
+                bitmaps = dict((int(value), bitmap) for value, bitmap in bitmaps.items())
+            self.bitmaps[field] = bitmaps
+            self.vocabularies[field] = sorted(bitmaps)
+        self.columns = dict((field, tuple(entity.columns[field])) for field in COLUMN_FIELDS)
+
+    def _rowsBitmap(self, rows):
+        """Return the bitmap of `rows`."""
+        bits = ['0'] * len(self.keys)
+        for row in rows:
+            bits[-1 - row] = '1'
+        return int(''.join(bits) or '0', 2)
+
+    def _range(self, values, op, value):
+        """Return the slice of the sorted `values` that compares to `value` with `op`."""
+        left, right = bisect.bisect_left(values, value), bisect.bisect_right(values, value)
+        return {
+            '=': (left, right),
+            '<': (0, left),
+            '<=': (0, right),
+            '>': (right, len(values)),
+            '>=': (left, len(values)),
+        }[op]
+
+    def bitmap(self, field, op, value):
+        """Return the bitmap of the conferences whose `field` compares to `value` with operator `op`."""
+        if op == '!=':
+            return self.all & ~self.bitmap(field, '=', value)
+        if field in BITMAP_FIELDS:
+            vocabulary = self.vocabularies[field]
+            start, stop = self._range(vocabulary, op, value)
+            bits = 0
+            for term in vocabulary[start:stop]:
+                bits |= self.bitmaps[field][term]
+            return bits
+        values, rows = self.columns[field]
+        start, stop = self._range(values, op, value)
+        return self._rowsBitmap(rows[start:stop])
+
+    def query(self, filters):
+        """Return the keys of the conferences matching every (field, operator, value) filter, by name."""
+        bits = self.all
+        for field, op, value in filters:
+            bits &= self.bitmap(field, op, value)
+        # row 0 is the lowest bit
+        return [self.keys[row] for row, bit in enumerate(reversed(bin(bits)[2:])) if bit == '1']
+
+
+def build(conferences):
+    """Return the (unsaved) catalog of `conferences`."""
+    conferences = sorted(conferences, key=lambda conf: conf.name)
+    bitmaps = dict((field, {}) for field in BITMAP_FIELDS)
+    for row, conf in enumerate(conferences):
+        for field in BITMAP_FIELDS:
+            values = getattr(conf, field)
+            for value in (values if isinstance(values, list) else [values]):
+                if value is not None:
+                    bitmaps[field][value] = bitmaps[field].get(value, 0) | 1 << row
+    columns = {}
+    for field in COLUMN_FIELDS:
+        pairs = sorted((getattr(conf, field), row) for row, conf in enumerate(conferences)
+                       if getattr(conf, field) is not None)
+        columns[field] = [[value for value, row in pairs], [row for value, row in pairs]]
+    return ConferenceCatalog(key=CATALOG_KEY, conferences=[conf.key.urlsafe() for conf in conferences],
+                             bitmaps=bitmaps, columns=columns)
+
+
+def rebuild():
+    """Rebuild the catalog from every conference and return it."""
+    conferences = Conference.query().fetch(CATALOG_MAX_CONFERENCES)
+    entity = build([conf for conf in conferences if not conf.deleted])
+    entity.put()
+    # this instance serves the new catalog right away
+    with _lock:
+        _loaded.pop('latest', None)
+    return entity
+
+
+def load(now=None):
+    """Return the in-memory catalog, or None when none was built yet."""
+    now = now or time.time()
+    with _lock:
+        checked, catalog = _loaded.get('latest', (0, None))
+    if now - checked < CATALOG_CHECK_SECONDS:
+        return catalog
+    entity = CATALOG_KEY.get()
+    if entity and (catalog is None or catalog.computed != entity.computed):
+        catalog = Catalog(entity)
+    elif not entity:
+        catalog = None
+    with _lock:
+        _loaded['latest'] = (now, catalog)
+    return catalog
+
+
+def matches(conf, filters):
+    """Return True if `conf` matches every (field, operator, value) filter with its current values."""
+    for field, op, value in filters:
+        current = getattr(conf, field)
+        if isinstance(current, list):
+            # a repeated property matches when one of its values does, '!=' when none equals
+            if op == '!=':
+                if value in current:
+                    return False
+            elif not any(OPERATORS[op](item, value) for item in current):
+                return False
+        elif not OPERATORS[op](current, value):
+            return False
+    return True
@@ -13,15 +13,17 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 from datetime import datetime, time, date
+import httplib
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
 from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
 from models import ConflictException
 from models import Profile
@@ -29,15 +31,22 @@ from models import ProfileMiniForm
 from models import ProfileForm
 from models import StringMessage
 from models import BooleanMessage
+from models import BatchRequestForm
+from models import BatchResultForm
+from models import BatchResultForms
 from models import Conference
+from models import ConferenceDeletion
+from models import ConferenceDetailForm
 from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
-from models import TeeShirtSize
+from models import ConferenceStatsForm
+from models import WaitlistForm
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionQueryForm
 from models import SessionQueryForms
 from models import Speaker
 
@@ -45,15 +54,25 @@ from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
+from settings import BATCH_MAX_ITEMS
+from settings import BATCH_MAX_COST
 
 from utils import getUserId, formToDict, expression_closure
+from background import MEMCACHE_ANNOUNCEMENTS_KEY
+from background import MEMCACHE_FEATURED_SPEAKER_KEY
+import analytics
+import background
+import contention
+import deletion
+import hotcache
+import idempotency
+import ratelimit
+import tasks
+import trending
+import waitlist
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
-                    'are nearly sold out: %s')
-MEMCACHE_FEATURED_SPEAKER_KEY = 'FEATURED_SPEAKERS'
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -76,7 +95,8 @@ CONFERENCE_FIELDS = {
     'CITY': 'city',
     'TOPIC': 'topics',
     'MONTH': 'month',
-    'MAX_ATTENDEES': 'maxAttendees'
+    'MAX_ATTENDEES': 'maxAttendees',
+    'SEATS_AVAILABLE': 'seatsAvailable'
 }
 
 SESSION_FIELDS = {
@@ -93,6 +113,12 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_REGISTER_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    idempotencyKey=messages.StringField(2),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
@@ -114,6 +140,11 @@ SESSION_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1, required=True)
 )
 
+SESSION_QUERY_POST_REQUEST = endpoints.ResourceContainer(
+    SessionQueryForms,
+    websafeConferenceKey=messages.StringField(1, required=True)
+)
+
 SESSION_BY_SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1, required=True),
@@ -123,6 +154,39 @@ SESSION_WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeSessionKey=messages.StringField(1, required=True)
 )
+
+# read-only methods callable through `batch`, as name -> (request, cost)
+BATCH_METHODS = {
+    'getConference': (CONF_GET_REQUEST, 1),
+    'getConferenceDetail': (CONF_GET_REQUEST, 3),
+    'getConferenceSessions': (CONF_GET_REQUEST, 1),
+    'getConferenceSessionsByType': (SESSION_BY_TYPE_GET_REQUEST, 1),
+    'queryConferenceSessions': (SESSION_QUERY_POST_REQUEST, 2),
+    'getSessionsBySpeaker': (SESSION_BY_SPEAKER_GET_REQUEST, 2),
+    'getConferencesCreated': (message_types.VoidMessage, 2),
+    'getConferencesToAttend': (message_types.VoidMessage, 1),
+    'getSessionsInWishlist': (message_types.VoidMessage, 1),
+    'getRecommendedConferences': (message_types.VoidMessage, 3),
+    'getTrendingConferences': (message_types.VoidMessage, 1),
+    'getWaitlistPosition': (CONF_GET_REQUEST, 1),
+    'getProfile': (message_types.VoidMessage, 1),
+    'getAnnouncement': (message_types.VoidMessage, 1),
+    'getFeaturedSpeaker': (message_types.VoidMessage, 1),
+    'queryConferences': (ConferenceQueryForms, 5),
+    'searchConferences': (ConferenceQueryForms, 2),
+    'querySessions': (SessionQueryForms, 5),
+}
+
+
+def _conferenceGroup(service, request, *args, **kwargs):
+    """Return the conference a request writes to; transaction collisions are reported under it."""
+    return ndb.Key(urlsafe=request.websafeConferenceKey)
+
+
+def _profileGroup(service, request, *args, **kwargs):
+    """Return the Profile of the user making a request; transaction collisions are reported under it."""
+    return service._getUserKey()[1]
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -138,18 +202,16 @@ class ConferenceApi(remote.Service):
     def _createConferenceObject(self, conferenceForm):
         """Create conference object, returns ConferenceForm."""
 
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user, p_key = self._getUserKey()
 
-        data = formToDict(conferenceForm, exclude=('websafeKey', 'organizerDisplayName'))
+        data = formToDict(conferenceForm, exclude=('websafeKey', 'organizerDisplayName', 'idempotencyKey'))
         # add default values for those missing
         for df in DEFAULTS:
             if data[df] in (None, []):
                 data[df] = DEFAULTS[df]
 
         # add organizerUserId before checking the required fields
-        data['organizerUserId'] = user_id = getUserId(user)
+        data['organizerUserId'] = p_key.id()
 
         # check required fields
         for key in Conference.required_fields_schema:
@@ -171,9 +233,8 @@ class ConferenceApi(remote.Service):
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
 
-        # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
+        # generate Conference ID based on Profile key
+        # get Conference key from ID
         c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
@@ -182,10 +243,7 @@ class ConferenceApi(remote.Service):
         # creation of Conference & return (modified) ConferenceForm
         conf = Conference(**data)
         conf.put()
-        taskqueue.add(
-            params={'email': user.email(), 'conferenceInfo': repr(conferenceForm)},
-            url='/tasks/send_confirmation_email'
-        )
+        tasks.add(tasks.confirmationEmailTask(c_key))
         return conf.toForm()
 
     @endpoints.method(ConferenceForm,
@@ -193,22 +251,20 @@ class ConferenceApi(remote.Service):
                       path='conference',
                       http_method='POST',
                       name='createConference')
+    @ratelimit.limit('write')
+    @idempotency.idempotent(ConferenceForm)
+    @tasks.flushTasks
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
 
-    @ndb.transactional()
+    @contention.transactional(group=_conferenceGroup)
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, p_key = self._getUserKey()
+        user_id = p_key.id()
 
-        # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        # check that conference exists
-        if not conf:
-            raise endpoints.NotFoundException('No conference found with key: %s' % request.websafeConferenceKey)
+        # update existing conference; check that it exists
+        conf = self._getConference(request.websafeConferenceKey)
 
         # check that user is owner
         if user_id != conf.organizerUserId:
@@ -229,7 +285,9 @@ class ConferenceApi(remote.Service):
                 # write to Conference object
                 setattr(conf, field.name, data)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
+        hotcache.invalidate(conf.key)
+        # the owner's Profile shares the conference's entity group
+        prof = self._getProfileFromUser()
         return conf.toForm(prof.displayName)
 
     @endpoints.method(CONF_POST_REQUEST,
@@ -237,49 +295,134 @@ class ConferenceApi(remote.Service):
                       path='conference/{websafeConferenceKey}',
                       http_method='PUT',
                       name='updateConference')
+    @ratelimit.limit('write')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
+    @contention.transactional(group=_conferenceGroup)
+    def _deleteConferenceObject(self, request):
+        """Mark the conference as deleted and start its background cleanup."""
+        user, p_key = self._getUserKey()
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if not conf:
+            raise endpoints.NotFoundException('No conference found with key: %s' % request.websafeConferenceKey)
+
+        # check that user is owner
+        if p_key.id() != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete the conference.')
+
+        conf.deleted = True
+        progress = deletion.progressKey(conf.key).get()
+        if progress:
+            # Deleting an already deleted conference restarts its cleanup from the last saved batch.
+            # The new batch number makes the tasks of the pending chain stale.
+            progress.batch += 1
+        else:
+            progress = ConferenceDeletion(key=deletion.progressKey(conf.key))
+        ndb.put_multi([conf, progress])
+        tasks.deleteConferenceTask(conf.key, progress.batch).add(transactional=True)
+        hotcache.invalidate(conf.key)
+        hotcache.invalidate(conf.key, 'sessions')
+        return BooleanMessage(data=True)
+
+    @endpoints.method(CONF_GET_REQUEST,
+                      BooleanMessage,
+                      path='conference/delete/{websafeConferenceKey}',
+                      http_method='DELETE',
+                      name='deleteConference')
+    @ratelimit.limit('write')
+    def deleteConference(self, request):
+        """Delete conference, its sessions and every reference to them."""
+        return self._deleteConferenceObject(request)
+
     @endpoints.method(CONF_GET_REQUEST,
                       ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET',
                       name='getConference')
+    @ratelimit.limit('read')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        return self._conferenceForm(request.websafeConferenceKey)
+
+    def _conferenceForm(self, websafeConferenceKey):
+        """Return the ConferenceForm of a conference, from the hot cache when possible."""
+        def build():
+            # get Conference object from request; bail if not found
+            conf = self._getConference(websafeConferenceKey)
+            prof = conf.key.parent().get()
+            return conf.toForm(prof.displayName)
+        # popular conferences are served from the instance's memory
+        return hotcache.getOrBuild('conference', ndb.Key(urlsafe=websafeConferenceKey), build)
+
+    @endpoints.method(CONF_GET_REQUEST,
+                      ConferenceDetailForm,
+                      path='conference/{websafeConferenceKey}/detail',
+                      http_method='GET',
+                      name='getConferenceDetail')
+    @ratelimit.limit('read')
+    def getConferenceDetail(self, request):
+        """Return a conference with its sessions, the user's registration and wishlist, and the featured speaker.
+            Note:
+                Every datastore and memcache RPC is issued up front and runs in
+                parallel: the organizer's Profile is the conference's parent, so
+                nothing waits on the conference itself.
+        """
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        # signed-out visitors get the conference without their registration state
+        p_key = self._getUserKey()[1] if endpoints.get_current_user() else None
+        futures = ndb.get_multi_async([conf_key, conf_key.parent()] + ([p_key] if p_key else []))
+        sessions = Session.query(ancestor=conf_key).fetch_async()
+        featured = ndb.get_context().memcache_get(MEMCACHE_FEATURED_SPEAKER_KEY)
+
+        conf = futures[0].get_result()
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException('No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
-        return conf.toForm(prof.displayName)
+        organizer = futures[1].get_result()
+        prof = futures[2].get_result() if p_key else None
+        sessions = sessions.get_result()
+        wishList = set(prof.wishList) if prof else set()
+        return ConferenceDetailForm(
+            conference=conf.toForm(organizer.displayName if organizer else ''),
+            sessions=[session.toForm() for session in sessions],
+            isAttending=bool(prof and conf.key in prof.conferenceKeysToAttend),
+            wishlistSessionKeys=[session.key.urlsafe() for session in sessions if session.key in wishList],
+            featuredSpeaker=featured.get_result() or '')
 
     @endpoints.method(message_types.VoidMessage,
                       ConferenceForms,
                       path='getConferencesCreated',
                       http_method='POST',
                       name='getConferencesCreated')
+    @ratelimit.limit('read')
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        prof = self._getProfileFromUser()
 
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs = self._fetchByKeys(Conference.query(ancestor=prof.key))
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[conf.toForm(prof.displayName) for conf in confs])
+        return ConferenceForms(items=[conf.toForm(prof.displayName) for conf in confs if not conf.deleted])
+
+    def _fetchByKeys(self, query):
+        """Returns the entities matched by `query`, in order.
+            Note:
+                The query is run keys-only and the entities are loaded with a batched
+                `ndb.get_multi`, so hot entities come from ndb's context cache or memcache
+                and only misses hit the datastore. Lookups by key are strongly consistent,
+                so values like `seatsAvailable` are never stale.
+        """
+        return [entity for entity in ndb.get_multi(query.fetch(keys_only=True)) if entity]
 
     def _buildQuery(self, model_class, filters, field_mapping, order_by=None):
-        """Returns a formatted query from the submitted filters.
-           If the query contains multiple inequalities, returns the filtered set.
+        """Returns the list of entities matching the submitted filters.
             Note:
                 Only the first inequality is handled by the datastore,
                 any additional inequalities will be filtered using python.
+                Entities are loaded by key. (see `_fetchByKeys()`)
 
         :param model_class: The model class used when building the query. `Model.query()`
         :type model_class: ndb.Model
@@ -325,13 +468,13 @@ class ConferenceApi(remote.Service):
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr['value'])
             q = q.filter(formatted_query)
 
-        # return the query if there are no additional inequalities
+        # return the entities if there are no additional inequalities
         if len(inequality_filters) <= 1:
-            return q
+            return self._fetchByKeys(q)
         # Any additional inequalities must be implemented with Python.
 
         # Make a asynchronous query so we can create our closures while waiting for the request.
-        rows = q.fetch_async()
+        keys = q.fetch_async(keys_only=True)
         # remove the inequality handled by datastore
         inequality_filters.pop(0)
         # For each inequality we will create a closure so we can quickly
@@ -343,7 +486,9 @@ class ConferenceApi(remote.Service):
             # add the returned function to `filters`
             filters.append(expression_closure(**filtr))
         filtered_rows = []
-        for row in rows.get_result():
+        for row in ndb.get_multi(keys.get_result()):
+            if not row:
+                continue
             is_valid = True  # assume this row passes all filters
             for filtr in filters:
                 # If one filter returns false, mark this row as invalid and break out of the loop
@@ -355,28 +500,41 @@ class ConferenceApi(remote.Service):
         # return the filtered set
         return filtered_rows
 
-    def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if non-existent."""
+    def _getConference(self, websafeConferenceKey):
+        """Return the Conference for `websafeConferenceKey`.
+        Raises NotFoundException when it doesn't exist or was deleted.
+        """
+        conf = ndb.Key(urlsafe=websafeConferenceKey).get()
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException('No conference found with key: %s' % websafeConferenceKey)
+        return conf
+
+    def _getUserKey(self):
+        """Return the authed user and the key of their Profile.
+            Note:
+                Endpoints creates a service instance per request, so the
+                user id lookup (a tokeninfo fetch for oauth ids) is memoized
+                on `self` and shared by every helper in the request.
+        """
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
-        # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        # create new Profile if not there
-        if not profile:
-            profile = Profile(
-                key=p_key,
-                displayName=user.nickname(),
-                mainEmail=user.email(),
-                teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            profile.put()
-
-        return profile  # return Profile
+        profileKeys = self.__dict__.setdefault('_profileKeys', {})
+        if user.email() not in profileKeys:
+            profileKeys[user.email()] = ndb.Key(Profile, getUserId(user))
+        return user, profileKeys[user.email()]
+
+    def _getProfileFromUser(self):
+        """Return user Profile from datastore, creating new one if non-existent.
+            Note:
+                The Profile is loaded once per request; later calls are
+                answered by ndb's in-context cache. Inside a transaction
+                the read goes through the transaction's own context.
+        """
+        user, p_key = self._getUserKey()
+        return Profile.getOrCreate(user, p_key.id())
 
     # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
@@ -385,11 +543,14 @@ class ConferenceApi(remote.Service):
                       path='queryConferences',
                       http_method='POST',
                       name='queryConferences')
+    @ratelimit.limit('read')
     def queryConferences(self, request):
         """Query for conferences."""
 
         # use `CONFERENCE_FIELDS` to construct query.
         conferences = self._buildQuery(Conference, request.filters, CONFERENCE_FIELDS, order_by=['name'])
+        # deleted conferences are excluded until their cleanup removes them
+        conferences = [conf for conf in conferences if not conf.deleted]
 
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
@@ -405,6 +566,71 @@ class ConferenceApi(remote.Service):
         # return individual ConferenceForm object per Conference
         return ConferenceForms(items=[conf.toForm(names.get(conf.organizerUserId, '')) for conf in conferences])
 
+    @endpoints.method(ConferenceQueryForms,
+                      ConferenceForms,
+                      path='searchConferences',
+                      http_method='POST',
+                      name='searchConferences')
+    @ratelimit.limit('read')
+    def searchConferences(self, request):
+        """Query for conferences with any combination of filters, using the in-memory catalog.
+            Note:
+                The catalog is rebuilt by a cron job (see `catalog.py`), so
+                conferences created since the last rebuild are not found yet.
+                Until the first rebuild this is `queryConferences`.
+        """
+        import catalog
+        index = catalog.load()
+        if index is None:
+            return self.queryConferences(request)
+
+        inequality_filters, filters = self._formatFilters(request.filters, CONFERENCE_FIELDS)
+        # `filters` only holds the first inequality, the catalog handles them all
+        filters = [filtr for filtr in filters if filtr['operator'] == '='] + inequality_filters
+        for filtr in filters:
+            self._parseFilter(Conference, filtr)
+        filters = [(filtr['field'], filtr['operator'], filtr['value']) for filtr in filters]
+
+        # values may have changed since the rebuild, so the loaded conferences are checked again
+        conferences = [conf for conf in ndb.get_multi(index.query(filters))
+                       if conf and not conf.deleted and catalog.matches(conf, filters)]
+        profiles = ndb.get_multi([conf.key.parent() for conf in conferences])
+        names = dict((profile.key.id(), profile.displayName) for profile in profiles if profile)
+        return ConferenceForms(items=[conf.toForm(names.get(conf.organizerUserId, '')) for conf in conferences])
+
+    @endpoints.method(message_types.VoidMessage,
+                      ConferenceForms,
+                      path='conferences/recommended',
+                      http_method='GET',
+                      name='getRecommendedConferences')
+    @ratelimit.limit('read')
+    def getRecommendedConferences(self, request):
+        """Return upcoming conferences with topics similar to the user's conferences and wishlist."""
+        # NumPy is only loaded by instances serving recommendations
+        import recommendations
+        prof = self._getProfileFromUser()
+        conferences = [conf for conf in ndb.get_multi(recommendations.recommend(prof)) if conf and not conf.deleted]
+
+        # get organizers
+        profiles = ndb.get_multi([ndb.Key(Profile, conf.organizerUserId) for conf in conferences])
+        names = dict((profile.key.id(), profile.displayName) for profile in profiles if profile)
+        return ConferenceForms(items=[conf.toForm(names.get(conf.organizerUserId, '')) for conf in conferences])
+
+    @endpoints.method(message_types.VoidMessage,
+                      ConferenceForms,
+                      path='conferences/trending',
+                      http_method='GET',
+                      name='getTrendingConferences')
+    @ratelimit.limit('read')
+    def getTrendingConferences(self, request):
+        """Return the conferences with the most recent registrations, hottest first."""
+        conferences = [conf for conf in ndb.get_multi(trending.top()) if conf and not conf.deleted]
+
+        # get organizers
+        profiles = ndb.get_multi([ndb.Key(Profile, conf.organizerUserId) for conf in conferences])
+        names = dict((profile.key.id(), profile.displayName) for profile in profiles if profile)
+        return ConferenceForms(items=[conf.toForm(names.get(conf.organizerUserId, '')) for conf in conferences])
+
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
@@ -431,6 +657,7 @@ class ConferenceApi(remote.Service):
                       path='profile',
                       http_method='GET',
                       name='getProfile')
+    @ratelimit.limit('read')
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
@@ -440,6 +667,7 @@ class ConferenceApi(remote.Service):
                       path='profile',
                       http_method='POST',
                       name='saveProfile')
+    @ratelimit.limit('write')
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -451,30 +679,14 @@ class ConferenceApi(remote.Service):
         """Create Announcement & assign to memcache; used by
         memcache cron job & putAnnouncement().
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
+        return background.cacheAnnouncement()
 
     @endpoints.method(message_types.VoidMessage,
                       StringMessage,
                       path='conference/announcement/get',
                       http_method='GET',
                       name='getAnnouncement')
+    @ratelimit.limit('read')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
         return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
@@ -486,13 +698,14 @@ class ConferenceApi(remote.Service):
                       path='conferences/attending',
                       http_method='GET',
                       name='getConferencesToAttend')
+    @ratelimit.limit('read')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser()  # get user Profile
-        conferences = ndb.get_multi(prof.conferenceKeysToAttend)
+        conferences = [conf for conf in ndb.get_multi(prof.conferenceKeysToAttend) if conf and not conf.deleted]
 
         # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences if conf]
+        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
         profiles = ndb.get_multi(organisers)
 
         # put display names in a dict for easier fetching
@@ -503,7 +716,7 @@ class ConferenceApi(remote.Service):
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(items=[conf.toForm(names.get(conf.organizerUserId, '')) for conf in conferences])
 
-    @ndb.transactional(xg=True)
+    @contention.transactional(xg=True, group=_conferenceGroup)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
         prof = self._getProfileFromUser()  # get user Profile
@@ -512,7 +725,7 @@ class ConferenceApi(remote.Service):
         # get conference; check that it exists
         key = ndb.Key(urlsafe=request.websafeConferenceKey)
         conf = key.get()
-        if not conf:
+        if not conf or (reg and conf.deleted):
             raise endpoints.NotFoundException('No conference found with key: %s' % request.websafeConferenceKey)
 
         # register
@@ -529,6 +742,7 @@ class ConferenceApi(remote.Service):
             prof.conferenceKeysToAttend.append(key)
             conf.seatsAvailable -= 1
             retval = True
+            ndb.get_context().call_on_commit(lambda: trending.record(key))
 
         # unregister
         else:
@@ -538,21 +752,34 @@ class ConferenceApi(remote.Service):
                 prof.conferenceKeysToAttend.remove(key)
                 conf.seatsAvailable += 1
                 retval = True
+                if not conf.deleted:
+                    # hand the seat to the next waiter
+                    tasks.promoteWaitlistTask(key).add(transactional=True)
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        # write things back to the datastore (and log the registration of a live conference) & return
+        entities = [prof, conf]
+        if retval and not conf.deleted:
+            entities.append(analytics.registrationEvent(key, 1 if reg else -1))
+        ndb.put_multi(entities)
+        if retval:
+            hotcache.invalidate(conf.key)
         return BooleanMessage(data=retval)
 
-    @endpoints.method(CONF_GET_REQUEST,
+    @endpoints.method(CONF_REGISTER_REQUEST,
                       BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST',
                       name='registerForConference')
+    @ratelimit.limit('registration')
+    @idempotency.idempotent(BooleanMessage)
     def registerForConference(self, request):
         """Register user for selected conference."""
+        # Freed seats go to the waitlist first, in order. Checked outside the registration
+        # transaction, so joining the waitlist doesn't collide with registrations.
+        if waitlist.isWaiting(ndb.Key(urlsafe=request.websafeConferenceKey)):
+            raise ConflictException("Freed seats go to the waitlist first, please join the waitlist.")
         return self._conferenceRegistration(request)
 
     @endpoints.method(CONF_GET_REQUEST,
@@ -560,49 +787,135 @@ class ConferenceApi(remote.Service):
                       path='conference/{websafeConferenceKey}',
                       http_method='DELETE',
                       name='unregisterFromConference')
+    @ratelimit.limit('registration')
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
 
+    @endpoints.method(CONF_GET_REQUEST,
+                      ConferenceStatsForm,
+                      path='conference/{websafeConferenceKey}/stats',
+                      http_method='GET',
+                      name='getConferenceStats')
+    @ratelimit.limit('read')
+    def getConferenceStats(self, request):
+        """Return registrations per day and the fill rate of a conference, open to its organizer."""
+        user, p_key = self._getUserKey()
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf, stats = ndb.get_multi([conf_key, analytics.statsKey(conf_key)])
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException('No conference found with key: %s' % request.websafeConferenceKey)
+        if p_key.id() != conf.organizerUserId:
+            raise endpoints.ForbiddenException('Only the organizer of this conference can see its stats.')
+        return analytics.toForm(conf, stats)
+
+    @endpoints.method(CONF_GET_REQUEST,
+                      WaitlistForm,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='POST',
+                      name='joinWaitlist')
+    @ratelimit.limit('registration')
+    def joinWaitlist(self, request):
+        """Join the waitlist of a sold-out conference, or of one with users waiting for freed seats.
+        The user is registered when a seat frees up.
+        """
+        prof = self._getProfileFromUser()
+        conf = self._getConference(request.websafeConferenceKey)
+        if conf.key in prof.conferenceKeysToAttend:
+            raise ConflictException("You have already registered for this conference")
+        if conf.seatsAvailable > 0 and not waitlist.isWaiting(conf.key):
+            raise ConflictException("There are seats available, register for the conference instead.")
+        return WaitlistForm(websafeConferenceKey=request.websafeConferenceKey,
+                            position=waitlist.join(conf.key, prof.key.id()))
+
+    @endpoints.method(CONF_GET_REQUEST,
+                      WaitlistForm,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='GET',
+                      name='getWaitlistPosition')
+    @ratelimit.limit('read')
+    def getWaitlistPosition(self, request):
+        """Return the user's position in the waitlist of a conference (0 when not waiting)."""
+        user, p_key = self._getUserKey()
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        return WaitlistForm(websafeConferenceKey=request.websafeConferenceKey,
+                            position=waitlist.position(conf_key, p_key.id()))
+
         # - - - Conference Session - - - - - - - - - - - - - - - - - - - -
 
     @endpoints.method(CONF_GET_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/sessions',
                       http_method='GET',
                       name='getConferenceSessions')
+    @ratelimit.limit('read')
     def getConferenceSessions(self, request):
         """Given a conference, return all sessions"""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException('No conference found with key: %s' % request.websafeConferenceKey)
+        return self._sessionForms(request.websafeConferenceKey)
 
-        # Return a set of SessionForm objects per session
-        return SessionForms(items=[session.toForm() for session in conf.sessions])
+    def _sessionForms(self, websafeConferenceKey):
+        """Return the SessionForms of a conference, from the hot cache when possible."""
+        def build():
+            # get Conference object from request; bail if not found
+            conf = self._getConference(websafeConferenceKey)
+
+            # Return a set of SessionForm objects per session
+            return SessionForms(items=[session.toForm() for session in conf.sessions])
+        # seat changes and registrations don't bump the 'sessions' version
+        return hotcache.getOrBuild('sessions', ndb.Key(urlsafe=websafeConferenceKey), build, 'sessions')
 
     @endpoints.method(SESSION_BY_TYPE_GET_REQUEST,
                       SessionForms,
                       path='conference/{websafeConferenceKey}/sessions/type/{typeOfSession}',
                       http_method='GET',
                       name='getConferenceSessionsByType')
+    @ratelimit.limit('read')
     def getConferenceSessionsByType(self, request):
         """Given a conference, return all sessions of a specified type (eg lecture, keynote, workshop)"""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException('No conference found with key: %s' % request.websafeConferenceKey)
-
         # filter sessions by typeOfSession
-        sessions = conf.sessions.filter(Session.typeOfSession == request.typeOfSession)
+        sessions = self._querySnapshot(request.websafeConferenceKey, [
+            SessionQueryForm(field='TYPE_OF_SESSION', operator='EQ', value=request.typeOfSession)])
 
         # Return a set of SessionForm objects per session
         return SessionForms(items=[session.toForm() for session in sessions])
 
+    @endpoints.method(SESSION_QUERY_POST_REQUEST,
+                      SessionForms,
+                      path='conference/{websafeConferenceKey}/sessions/query',
+                      http_method='POST',
+                      name='queryConferenceSessions')
+    @ratelimit.limit('read')
+    def queryConferenceSessions(self, request):
+        """Query for sessions of a conference; any number of inequalities is allowed."""
+        sessions = self._querySnapshot(request.websafeConferenceKey, request.filters)
+        return SessionForms(items=[session.toForm() for session in sessions])
+
+    def _querySnapshot(self, websafeConferenceKey, filters):
+        """Return the sessions of a conference matching every filter, in key order.
+            Note:
+                The filters are evaluated as vectorized masks over the conference's
+                columnar session snapshot (see `snapshot.py`), so any number of
+                inequalities is allowed. Only the matching sessions are loaded.
+        """
+        # NumPy is only loaded by instances serving session queries
+        import snapshot
+        inequality_filters, filters = self._formatFilters(filters, SESSION_FIELDS)
+        # `filters` only holds the first inequality, the snapshot handles them all
+        filters = [filtr for filtr in filters if filtr['operator'] == '='] + inequality_filters
+        for filtr in filters:
+            self._parseFilter(Session, filtr)
+
+        # get Conference object from request; bail if not found
+        conf = self._getConference(websafeConferenceKey)
+        snap = snapshot.load(conf.key)
+        rows = snapshot.query(snap, [(filtr['field'], filtr['operator'], filtr['value']) for filtr in filters])
+        return [session for session in ndb.get_multi(snapshot.select(snap, conf.key, rows)) if session]
+
     @endpoints.method(SESSION_BY_SPEAKER_GET_REQUEST,
                       SessionForms,
                       path='sessions/speaker/{speaker}',
                       http_method='GET',
                       name='getSessionsBySpeaker')
+    @ratelimit.limit('read')
     def getSessionsBySpeaker(self, request):
         """Given a speaker, return all sessions given by this particular speaker, across all conferences"""
 
@@ -614,21 +927,17 @@ class ConferenceApi(remote.Service):
     def _createSessionObject(self, sessionForm):
         """Create Session object, returning SessionForm."""
         # make sure user is authenticated
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user, p_key = self._getUserKey()
 
         # get the conference
-        conf = ndb.Key(urlsafe=sessionForm.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException('No conference found with key: %s' % sessionForm.conferenceKey)
+        conf = self._getConference(sessionForm.websafeConferenceKey)
 
         # check ownership
-        if getUserId(user) != conf.organizerUserId:
+        if p_key.id() != conf.organizerUserId:
             raise endpoints.ForbiddenException('Only the organizer of this conference can add sessions.')
 
         # copy SessionForm/ProtoRPC Message into dict
-        data = formToDict(sessionForm, exclude=('websafeKey', 'websafeConferenceKey'))
+        data = formToDict(sessionForm, exclude=('websafeKey', 'websafeConferenceKey', 'idempotencyKey'))
         # check required fields
         for key in Session.required_fields_schema:
             if not data[key]:
@@ -660,12 +969,11 @@ class ConferenceApi(remote.Service):
         # Add session to datastore
         session = Session(**data)
         session.put()
+        hotcache.invalidate(conf.key)
+        hotcache.invalidate(conf.key, 'sessions')
 
-        # Add a task to check and update new featured speaker
-        taskqueue.add(
-            params={'websafeConferenceKey': conf.key.urlsafe(), 'speaker': session.speaker.name},
-            url='/tasks/set_featured_speaker'
-        )
+        # Add a (coalesced) task to check and update new featured speaker
+        tasks.add(tasks.featuredSpeakerTask(conf.key, session.speaker.name))
 
         return session.toForm()
 
@@ -674,6 +982,9 @@ class ConferenceApi(remote.Service):
                       path='conference/sessions/{websafeConferenceKey}',
                       http_method='POST',
                       name='createSession')
+    @ratelimit.limit('write')
+    @idempotency.idempotent(SessionForm)
+    @tasks.flushTasks
     def createSession(self, request):
         """Creates a session, open to the organizer of the conference"""
         return self._createSessionObject(request)
@@ -683,7 +994,8 @@ class ConferenceApi(remote.Service):
                       path='profile/wishlist/{websafeSessionKey}',
                       http_method='POST',
                       name='addSessionToWishlist')
-    @ndb.transactional(xg=True)
+    @ratelimit.limit('write')
+    @contention.transactional(xg=True, group=_profileGroup)
     def addSessionToWishlist(self, request):
         """Adds the given session to the user's wishlist"""
         # get user Profile
@@ -707,7 +1019,8 @@ class ConferenceApi(remote.Service):
                       path='profile/wishlist/{websafeSessionKey}',
                       http_method='DELETE',
                       name='removeSessionFromWishlist')
-    @ndb.transactional()
+    @ratelimit.limit('write')
+    @contention.transactional(group=_profileGroup)
     def removeSessionFromWishlist(self, request):
         """Deletes the given session from user's wish list"""
         # get user Profile
@@ -726,12 +1039,13 @@ class ConferenceApi(remote.Service):
                       path='profile/wishlist/all',
                       http_method='GET',
                       name='getSessionsInWishlist')
+    @ratelimit.limit('read')
     def getSessionsInWishlist(self, request):
         """Returns sessions in user's wish list"""
         # get user Profile
         prof = self._getProfileFromUser()
-        # get all sessions in user's wishlist
-        sessions = ndb.get_multi(prof.wishList)
+        # get all sessions in user's wishlist, skipping deleted sessions not yet scrubbed from it
+        sessions = [session for session in ndb.get_multi(prof.wishList) if session]
         # return a set of `SessionForm` objects
         return SessionForms(items=[session.toForm() for session in sessions])
 
@@ -814,6 +1128,7 @@ class ConferenceApi(remote.Service):
                       path='querySessions',
                       http_method='POST',
                       name='querySessions')
+    @ratelimit.limit('read')
     def querySessions(self, request):
         """Query for sessions."""
         # use `SESSION_FIELDS` to construct query.
@@ -825,10 +1140,84 @@ class ConferenceApi(remote.Service):
                       path='conference/featured_speakers/get',
                       http_method='GET',
                       name='getFeaturedSpeaker')
+    @ratelimit.limit('read')
     def getFeaturedSpeaker(self, request):
         """Returns the featured speakers and their registered sessions from memcache."""
         return StringMessage(data=memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY) or "")
 
 
+    # - - - Batch - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _decodeBatchItem(self, item):
+        """Return (request, keys, error) for a batch item: its request message and the entity keys it
+        references, or the BatchResultForm of the error when it can't be run.
+        """
+        def error(message):
+            return None, [], BatchResultForm(method=item.method, status=httplib.BAD_REQUEST, error=message)
+
+        if item.method not in BATCH_METHODS:
+            return error('Method %s can not be called in a batch' % item.method)
+        container = BATCH_METHODS[item.method][0]
+        try:
+            call = protojson.decode_message(getattr(container, 'combined_message_class', container),
+                                            item.params or '{}')
+            call.check_initialized()
+        except (ValueError, messages.Error) as e:
+            return error('Invalid params: %s' % e)
+
+        keys = []
+        for field in ('websafeConferenceKey', 'websafeSessionKey'):
+            websafeKey = getattr(call, field, None)
+            if websafeKey:
+                try:
+                    key = ndb.Key(urlsafe=websafeKey)
+                except (TypeError, ProtocolBufferDecodeError):
+                    return error('Invalid %s: %s' % (field, websafeKey))
+                # a conference's parent is its organizer, a session's parent is its conference
+                keys.extend(k for k in (key, key.parent()) if k)
+        return call, keys, None
+
+    @endpoints.method(BatchRequestForm,
+                      BatchResultForms,
+                      path='batch',
+                      http_method='POST',
+                      name='batch')
+    @ratelimit.limit('read')
+    def batch(self, request):
+        """Run several read-only methods in one request and return their results, in order.
+            Note:
+                The calls run one after another, not in parallel: the methods
+                are synchronous. Every conference, session and Profile the
+                calls reference is loaded up front with one batched get, so
+                the calls are served from ndb's in-context cache, and the
+                client saves a round trip per call. Each call still draws from
+                the caller's read rate limit.
+        """
+        if len(request.items) > BATCH_MAX_ITEMS:
+            raise endpoints.BadRequestException('A batch holds at most %d calls' % BATCH_MAX_ITEMS)
+        cost = sum(BATCH_METHODS[item.method][1] for item in request.items if item.method in BATCH_METHODS)
+        if cost > BATCH_MAX_COST:
+            raise endpoints.BadRequestException('Batch cost %d is over the limit of %d' % (cost, BATCH_MAX_COST))
+
+        decoded = [self._decodeBatchItem(item) for item in request.items]
+        keys = set(key for call, keys, error in decoded for key in keys)
+        if endpoints.get_current_user():
+            keys.add(self._getUserKey()[1])
+        ndb.get_multi(list(keys))
+
+        results = []
+        for item, (call, keys, error) in zip(request.items, decoded):
+            if error:
+                results.append(error)
+                continue
+            try:
+                response = getattr(self, item.method)(call)
+            except endpoints.ServiceException as e:
+                results.append(BatchResultForm(method=item.method, status=e.http_status, error=str(e)))
+            else:
+                results.append(BatchResultForm(method=item.method, status=httplib.OK,
+                                               result=protojson.encode_message(response)))
+        return BatchResultForms(items=results)
+
 
 api = endpoints.api_server([ConferenceApi])  # register API
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+contention.py -- Instrumented transactions with a jittered retry policy
+
+`transactional` replaces `@ndb.transactional` on the endpoint write paths.
+It runs every attempt with ndb's own retries off and retries collisions
+(`TransactionFailedError`) itself. Before each retry it sleeps for a random
+time between 0 and an exponentially growing backoff ("full jitter"), so
+registrations colliding on a hot conference spread out instead of
+retrying in lockstep. The number of retries and the backoff are set per
+method in `settings.TRANSACTION_RETRIES`.
+
+Each call records its attempts, collisions, failures (retries exhausted)
+and, when it retried, the time spent retrying. The counters live in
+time-bucketed, sharded memcache keys, like `metrics.py`'s. A collision also
+counts against the root of the entity group it is reported under, so
+`getReport()` can list the hottest entity groups.
+
+"""
+
+import functools
+import random
+import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from settings import TRANSACTION_RETRIES
+import metrics
+
+MEMCACHE_CONTENTION_NAMESPACE = 'CONTENTION'
+CONTENTION_BUCKET_SECONDS = 60
+CONTENTION_SHARDS = 4
+# minutes covered by `getReport()`, and entity groups it lists
+CONTENTION_WINDOW = 60
+HOT_GROUPS = 10
+# seconds the counters are kept in memcache, past the report window
+CONTENTION_TTL = (CONTENTION_WINDOW + 5) * 60
+COUNTERS = ('calls', 'attempts', 'collisions', 'failures', 'retried') + \
+    tuple('retry_latency_%d' % i for i in range(len(metrics.LATENCY_BUCKETS) + 1))
+
+# names of the instrumented methods, in definition order
+NAMES = []
+
+
+def _timeBucket(now=None):
+    return int((now or time.time()) // CONTENTION_BUCKET_SECONDS)
+
+
+def _key(bucket, name, shard, counter):
+    return '%d:%s:%d:%s' % (bucket, name, shard, counter)
+
+
+def _groupKey(bucket, name, websafeKey):
+    return '%d:group:%s:%s' % (bucket, name, websafeKey)
+
+
+def _touchedKey(bucket, n=None):
+    key = '%d:touched' % bucket
+    return key if n is None else '%s:%d' % (key, n)
+
+
+def backoff(name, attempt):
+    """Return the seconds to sleep before retry number `attempt` (1, 2, ...) of method `name`."""
+    retries, first, cap = TRANSACTION_RETRIES.get(name, TRANSACTION_RETRIES['default'])
+    return random.uniform(0, min(cap, first * 2 ** (attempt - 1)))
+
+
+def record(name, attempts, collisions, failed, retryLatency, group=None, now=None):
+    """Flush the counters of one call to memcache.
+
+    :param retryLatency: milliseconds spent after the first collision
+    :param group: key reported for the collisions, whose root entity is counted
+    """
+    bucket, shard = _timeBucket(now), random.randint(0, CONTENTION_SHARDS - 1)
+    deltas = {_key(bucket, name, shard, 'calls'): 1, _key(bucket, name, shard, 'attempts'): attempts}
+    if collisions:
+        deltas[_key(bucket, name, shard, 'collisions')] = collisions
+        deltas[_key(bucket, name, shard, 'retried')] = 1
+        deltas[_key(bucket, name, shard, 'retry_latency_%d' % metrics.latencyBucket(retryLatency))] = 1
+        if failed:
+            deltas[_key(bucket, name, shard, 'failures')] = 1
+        if group:
+            while group.parent():
+                group = group.parent()
+            deltas[_groupKey(bucket, name, group.urlsafe())] = collisions
+    # `offset_multi` and `incr` can't set an expiry, so the counters are created with one first
+    initial = dict.fromkeys(deltas, 0)
+    if group and collisions:
+        initial[_touchedKey(bucket)] = 0
+    memcache.add_multi(initial, time=CONTENTION_TTL, namespace=MEMCACHE_CONTENTION_NAMESPACE)
+    counts = memcache.offset_multi(deltas, namespace=MEMCACHE_CONTENTION_NAMESPACE, initial_value=0)
+
+    if group and collisions and counts.get(_groupKey(bucket, name, group.urlsafe())) == collisions:
+        # first collisions of this group in this bucket
+        n = memcache.incr(_touchedKey(bucket), namespace=MEMCACHE_CONTENTION_NAMESPACE, initial_value=0)
+        if n:
+            memcache.set(_touchedKey(bucket, n), (name, group.urlsafe()), time=CONTENTION_TTL,
+                         namespace=MEMCACHE_CONTENTION_NAMESPACE)
+
+
+def transactional(xg=False, group=None):
+    """Decorator running a method in an instrumented transaction (see the module docstring).
+
+    :param xg: whether the transaction spans several entity groups
+    :param group: function of the method's arguments returning the key collisions are reported under
+    """
+    def decorator(func):
+        name = func.__name__
+        NAMES.append(name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if ndb.in_transaction():
+                # joined to the caller's transaction, which is instrumented itself
+                return func(*args, **kwargs)
+            retries = TRANSACTION_RETRIES.get(name, TRANSACTION_RETRIES['default'])[0]
+            attempts = collisions = 0
+            firstCollision = None
+            try:
+                while True:
+                    attempts += 1
+                    try:
+                        return ndb.transaction(lambda: func(*args, **kwargs), retries=0, xg=xg)
+                    except datastore_errors.TransactionFailedError:
+                        collisions += 1
+                        firstCollision = firstCollision or time.time()
+                        if collisions > retries:
+                            raise
+                    time.sleep(backoff(name, collisions))
+            finally:
+                failed = collisions > retries
+                retryLatency = (time.time() - firstCollision) * 1000 if firstCollision else 0
+                record(name, attempts, collisions, failed, retryLatency,
+                       group(*args, **kwargs) if group and collisions else None)
+        return wrapper
+    return decorator
+
+
+def getReport(names=None, minutes=CONTENTION_WINDOW, now=None):
+    """Merge the sharded counters of the last `minutes`.
+
+    Returns (stats, groups): `stats` maps each method that was called to its
+    `calls`, `attempts`, `collisions`, `failures`, `retried` and the `p50`,
+    `p95` and `p99` retry latencies; `groups` lists the hottest entity groups
+    as (collisions, method, websafe key), hottest first.
+    """
+    names = names or NAMES
+    newest = _timeBucket(now)
+    buckets = range(newest, newest - (minutes * 60 // CONTENTION_BUCKET_SECONDS), -1)
+    keys = [_key(b, name, shard, counter)
+            for name in names for counter in COUNTERS for b in buckets for shard in range(CONTENTION_SHARDS)]
+    keys += [_touchedKey(b) for b in buckets]
+    values = memcache.get_multi(keys, namespace=MEMCACHE_CONTENTION_NAMESPACE)
+
+    stats = {}
+    for name in names:
+        totals = dict((counter, sum(int(values.get(_key(b, name, shard, counter), 0))
+                                    for b in buckets for shard in range(CONTENTION_SHARDS)))
+                      for counter in COUNTERS)
+        if not totals['calls']:
+            continue
+        histogram = [totals['retry_latency_%d' % i] for i in range(len(metrics.LATENCY_BUCKETS) + 1)]
+        for p in (50, 95, 99):
+            totals['p%d' % p] = metrics.percentile(histogram, p)
+        stats[name] = totals
+
+    # the groups that collided, then their collision counts
+    touched = [_touchedKey(b, n) for b in buckets for n in range(1, int(values.get(_touchedKey(b), 0)) + 1)]
+    entries = memcache.get_multi(touched, namespace=MEMCACHE_CONTENTION_NAMESPACE)
+    groupKeys = dict((_groupKey(int(key.split(':')[0]), name, websafeKey), (name, websafeKey))
+                     for key, (name, websafeKey) in entries.items())
+    counts = memcache.get_multi(groupKeys.keys(), namespace=MEMCACHE_CONTENTION_NAMESPACE)
+    groups = {}
+    for key, group in groupKeys.items():
+        groups[group] = groups.get(group, 0) + int(counts.get(key, 0))
+    hottest = sorted(((count, name, websafeKey) for (name, websafeKey), count in groups.items()), reverse=True)
+    return stats, hottest[:HOT_GROUPS]
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+deletion.py -- Cascading conference deletion in chained background batches
+
+`deleteConference` only marks a conference as deleted. The cleanup then
+runs as a chain of tasks, one batch per task:
+
+    sessions    delete the conference's sessions and scrub them from wishlists
+    profiles    scrub the conference from `conferenceKeysToAttend`
+    descendants delete the remaining descendants (registration events, stats)
+    waitlist    delete the conference's waitlist and its entries
+    conference  drop it from the trending scores and the recommendation
+                model, and delete the conference itself
+
+Progress (stage, cursor and counters) is saved in a `ConferenceDeletion`
+entity in the same transaction that enqueues the next task, so the chain
+never breaks and a restarted task resumes from the last saved batch.
+Every task carries the batch number it expects, and a batch is only saved
+when the progress is still the one it read, so duplicated or stale tasks
+are dropped and only one chain runs at a time.
+
+"""
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import ConferenceDeletion
+from models import Profile
+from models import Session
+import tasks
+import trending
+import waitlist
+
+# sessions deleted per batch; also the number of keys in the wishlist IN() query (max 30)
+SESSION_BATCH_SIZE = 30
+# profiles scrubbed per batch
+PROFILE_BATCH_SIZE = 100
+# descendant and waitlist entities deleted per batch
+ENTITY_BATCH_SIZE = 500
+
+
+def progressKey(conf_key):
+    """Return the key of the cleanup progress entity of `conf_key`."""
+    return ndb.Key(ConferenceDeletion, 'progress', parent=conf_key)
+
+
+@ndb.transactional()
+def _scrubProfile(p_key, conf_key=None, session_keys=()):
+    """Remove `conf_key` and `session_keys` from a single Profile."""
+    prof = p_key.get()
+    if not prof:
+        return False
+    session_keys = set(session_keys)
+    attending = [key for key in prof.conferenceKeysToAttend if key != conf_key]
+    wishList = [key for key in prof.wishList if key not in session_keys]
+    if len(attending) == len(prof.conferenceKeysToAttend) and len(wishList) == len(prof.wishList):
+        # already scrubbed (e.g. the batch is being retried)
+        return False
+    prof.conferenceKeysToAttend = attending
+    prof.wishList = wishList
+    prof.put()
+    return True
+
+
+def _deleteSessions(conf_key, cursor):
+    """Delete a batch of sessions, scrubbing them from wishlists first."""
+    keys, cursor, more = Session.query(ancestor=conf_key).fetch_page(
+        SESSION_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    if keys:
+        for p_key in Profile.query(Profile.wishList.IN(keys)).fetch(keys_only=True):
+            _scrubProfile(p_key, session_keys=keys)
+        ndb.delete_multi(keys)
+    return len(keys), cursor, more
+
+
+def _scrubProfiles(conf_key, cursor):
+    """Remove the conference from a batch of attendees' profiles."""
+    keys, cursor, more = Profile.query(Profile.conferenceKeysToAttend == conf_key).fetch_page(
+        PROFILE_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    scrubbed = sum(1 for p_key in keys if _scrubProfile(p_key, conf_key=conf_key))
+    return scrubbed, cursor, more
+
+
+def _deleteDescendants(ancestor_key, cursor, keep=()):
+    """Delete a batch of the entities under `ancestor_key` (itself included), except the `keep` keys."""
+    keys, cursor, more = ndb.Query(ancestor=ancestor_key).fetch_page(
+        ENTITY_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    keys = [key for key in keys if key not in keep]
+    ndb.delete_multi(keys)
+    return len(keys), cursor, more
+
+
+@ndb.transactional()
+def _saveProgress(conf_key, read, stage, cursor, sessionsDeleted=0, profilesScrubbed=0, entitiesDeleted=0):
+    """Save the progress of a batch and enqueue the next one in one transaction.
+    Returns None, saving nothing, when the progress changed since it was `read`.
+    """
+    progress = progressKey(conf_key).get()
+    if (progress.batch, progress.stage, progress.cursor) != (read.batch, read.stage, read.cursor):
+        # another task chain already saved this batch
+        return None
+    progress.batch += 1
+    progress.stage = stage
+    progress.cursor = cursor.urlsafe() if cursor else None
+    progress.sessionsDeleted += sessionsDeleted
+    progress.profilesScrubbed += profilesScrubbed
+    progress.entitiesDeleted += entitiesDeleted
+    if stage == 'done':
+        conf_key.delete()
+    else:
+        tasks.deleteConferenceTask(conf_key, progress.batch).add(transactional=True)
+    progress.put()
+    return progress
+
+
+def processBatch(conf_key, batch):
+    """Run cleanup batch `batch` of a deleted conference and chain the following one.
+    Returns the updated `ConferenceDeletion`, or None when there is nothing to do or the task is stale.
+    """
+    progress = progressKey(conf_key).get()
+    if not progress or progress.stage == 'done' or progress.batch != batch:
+        return None
+    cursor = Cursor(urlsafe=progress.cursor) if progress.cursor else None
+
+    if progress.stage == 'sessions':
+        count, cursor, more = _deleteSessions(conf_key, cursor)
+        if more:
+            return _saveProgress(conf_key, progress, 'sessions', cursor, sessionsDeleted=count)
+        return _saveProgress(conf_key, progress, 'profiles', None, sessionsDeleted=count)
+
+    if progress.stage == 'profiles':
+        count, cursor, more = _scrubProfiles(conf_key, cursor)
+        if more:
+            return _saveProgress(conf_key, progress, 'profiles', cursor, profilesScrubbed=count)
+        return _saveProgress(conf_key, progress, 'descendants', None, profilesScrubbed=count)
+
+    if progress.stage == 'descendants':
+        # the progress entity survives the conference, the conference goes last
+        count, cursor, more = _deleteDescendants(conf_key, cursor, keep=(conf_key, progress.key))
+        if more:
+            return _saveProgress(conf_key, progress, 'descendants', cursor, entitiesDeleted=count)
+        return _saveProgress(conf_key, progress, 'waitlist', None, entitiesDeleted=count)
+
+    if progress.stage == 'waitlist':
+        count, cursor, more = _deleteDescendants(waitlist.waitlistKey(conf_key), cursor)
+        if more:
+            return _saveProgress(conf_key, progress, 'waitlist', cursor, entitiesDeleted=count)
+        return _saveProgress(conf_key, progress, 'conference', None, entitiesDeleted=count)
+
+    # stage == 'conference'
+    # NumPy is only loaded by the instances running this stage
+    import recommendations
+    trending.forget(conf_key)
+    recommendations.forget(conf_key)
+    return _saveProgress(conf_key, progress, 'done', None)
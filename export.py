@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+export.py -- Streaming JSONL export of conferences, sessions and profiles
+
+An export splits every kind into key-range shards (sampled with the
+`__scatter__` property) and exports them in parallel. Each shard is a
+chain of tasks, and every task streams one batch of entities as JSONL,
+optionally gzip-compressed, into its own part file in a pluggable sink.
+Each part is recorded in an `ExportPart` root entity of its own, so the
+shards never commit to a common entity group; the `ExportJob` is only
+updated when a shard finishes. When the last shard finishes, a manifest
+with per-part counts and md5 checksums is written next to the parts.
+
+    <export id>/<kind>/shard-<shard>-part-<part>.jsonl[.gz]
+    <export id>/manifest.json
+
+"""
+
+import datetime
+import gzip
+import hashlib
+import json
+import os
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ExportJob
+from models import ExportPart
+from models import Profile
+from models import Session
+import tasks
+
+EXPORT_KINDS = (Conference, Session, Profile)
+DEFAULT_SHARDS = 4
+# entities written per task (and per part file)
+EXPORT_BATCH_SIZE = 1000
+# scatter samples fetched per shard when computing key ranges
+SCATTER_OVERSAMPLING = 32
+# root directory of `LocalSink`, for the dev server and tests
+EXPORT_LOCAL_ROOT = os.environ.get('EXPORT_LOCAL_ROOT', '/tmp/conference-export')
+
+
+class LocalSink(object):
+    """Writes export files to the local filesystem (not writable on App Engine)."""
+
+    def __init__(self, root=None):
+        self.root = root or EXPORT_LOCAL_ROOT
+
+    @classmethod
+    def check(cls):
+        """Raise ValueError if export files can't be written."""
+        try:
+            if not os.path.isdir(EXPORT_LOCAL_ROOT):
+                os.makedirs(EXPORT_LOCAL_ROOT)
+        except OSError as e:
+            raise ValueError('The local sink can\'t write to %s: %s' % (EXPORT_LOCAL_ROOT, e))
+
+    def open(self, path):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return open(path, 'wb')
+
+
+class GcsSink(object):
+    """Writes export files to Google Cloud Storage.
+    Needs the GCS client library, installed into lib/ (see appengine_config.py).
+    """
+
+    @classmethod
+    def check(cls):
+        """Raise ValueError if the GCS client library isn't installed."""
+        try:
+            import cloudstorage  # noqa -- only checks that the library is installed
+        except ImportError:
+            raise ValueError('The gcs sink needs the GCS client library: '
+                             'pip install -t lib GoogleAppEngineCloudStorageClient')
+
+    def __init__(self, bucket=None):
+        from google.appengine.api import app_identity
+        self.bucket = bucket or app_identity.get_default_gcs_bucket_name()
+
+    def open(self, path):
+        import cloudstorage
+        return cloudstorage.open('/%s/%s' % (self.bucket, path), 'w')
+
+
+SINKS = {
+    'local': LocalSink,
+    'gcs': GcsSink,
+}
+
+
+class _ChecksumWriter(object):
+    """File wrapper counting and hashing the bytes written through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.bytes = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.bytes += len(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        pass
+
+
+def _jsonDefault(value):
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    if isinstance(value, (datetime.date, datetime.time, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def toRecord(entity):
+    """Return the JSON line of an entity."""
+    record = entity.to_dict()
+    record['websafeKey'] = entity.key.urlsafe()
+    return json.dumps(record, default=_jsonDefault, sort_keys=True)
+
+
+def _model(kind):
+    return ndb.Model._lookup_model(kind)
+
+
+def keyRanges(kind, shards):
+    """Split `kind` into at most `shards` key ranges, returned as (lower, upper) pairs of keys.
+    `None` stands for an open bound.
+    """
+    model = _model(kind)
+    samples = model.query().order(ndb.GenericProperty('__scatter__')).fetch(
+        shards * SCATTER_OVERSAMPLING, keys_only=True)
+    samples.sort()
+    # pick evenly spaced split points from the sorted samples
+    splits = []
+    for i in range(1, shards):
+        split = samples[i * len(samples) // shards] if samples else None
+        if split and split not in splits:
+            splits.append(split)
+    bounds = [None] + splits + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def start(export_id, kinds=None, shards=DEFAULT_SHARDS, sink='gcs', compress=True):
+    """Start an export of `kinds` (default: conferences, sessions and profiles).
+    Raises ValueError when `sink` is unknown or can't be used, before any task is enqueued.
+    """
+    if sink not in SINKS:
+        raise ValueError('Unknown sink: %s' % sink)
+    SINKS[sink].check()
+    kinds = kinds or [model._get_kind() for model in EXPORT_KINDS]
+    ranges = dict((kind, keyRanges(kind, shards)) for kind in kinds)
+    job = ExportJob(id=export_id, kinds=kinds, sink=sink, compress=compress,
+                    pendingShards=sum(len(r) for r in ranges.values()))
+    job.put()
+    for kind in kinds:
+        for shard, (lower, upper) in enumerate(ranges[kind]):
+            tasks.add(tasks.exportTask(export_id, kind, shard,
+                                       lower=lower.urlsafe() if lower else None,
+                                       upper=upper.urlsafe() if upper else None))
+    tasks.flush()
+    return job
+
+
+def partKey(export_id, kind, shard, part):
+    return ndb.Key(ExportPart, '%s-%s-%d-%d' % (export_id, kind, shard, part))
+
+
+def partPath(job, kind, shard, part):
+    return '%s/%s/shard-%d-part-%d.jsonl%s' % (job.key.id(), kind, shard, part, '.gz' if job.compress else '')
+
+
+def _writePart(job, kind, shard, part, entities):
+    """Stream `entities` to a part file and return its ExportPart (not yet saved)."""
+    path = partPath(job, kind, shard, part)
+    fileobj = SINKS[job.sink]().open(path)
+    writer = _ChecksumWriter(fileobj)
+    out = gzip.GzipFile(filename='', mode='wb', fileobj=writer) if job.compress else writer
+    for entity in entities:
+        out.write(toRecord(entity) + '\n')
+    if job.compress:
+        out.close()
+    fileobj.close()
+    return ExportPart(key=partKey(job.key.id(), kind, shard, part), kind=kind, shard=shard,
+                      part=part, path=path, count=len(entities), bytes=writer.bytes,
+                      md5=writer.md5.hexdigest())
+
+
+def exportBatch(export_id, kind, shard, part, lower=None, upper=None, cursor=None):
+    """Export one batch of a shard and chain the next one.
+    `lower`, `upper` and `cursor` are websafe strings, as passed by the task.
+    """
+    job = ndb.Key(ExportJob, export_id).get()
+    if not job:
+        return None
+    model = _model(kind)
+    q = model.query()
+    if lower:
+        q = q.filter(model.key >= ndb.Key(urlsafe=lower))
+    if upper:
+        q = q.filter(model.key < ndb.Key(urlsafe=upper))
+    entities, next_cursor, more = q.order(model.key).fetch_page(
+        EXPORT_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    exportPart = _writePart(job, kind, shard, part, entities)
+    if more:
+        _savePart(exportPart, tasks.exportTask(
+            export_id, kind, shard, part + 1, lower, upper, next_cursor.urlsafe()))
+        return job
+    job = _finishShard(job.key, exportPart)
+    if job.status == 'done':
+        # written after the commit, so the manifest sees every part.
+        # A retried task rewrites its part and the manifest, both are idempotent.
+        _writeManifest(job)
+    return job
+
+
+@ndb.transactional()
+def _savePart(exportPart, nextTask):
+    """Record a written part and enqueue the next batch of its shard."""
+    exists = exportPart.key.get()
+    exportPart.put()
+    if not exists:
+        # a retried task was already chained
+        nextTask.add(transactional=True)
+
+
+@ndb.transactional(xg=True)
+def _finishShard(job_key, exportPart):
+    """Record the last part of a shard and count the shard as finished."""
+    job = job_key.get()
+    exists = exportPart.key.get()
+    exportPart.put()
+    if exists:
+        # the task is being retried, its shard was already counted
+        return job
+    job.finishedShards.append('%s:%d:%d' % (exportPart.kind, exportPart.shard, exportPart.part))
+    job.pendingShards -= 1
+    if job.pendingShards <= 0:
+        job.status = 'done'
+        job.finished = datetime.datetime.now()
+        job.manifestPath = '%s/manifest.json' % job.key.id()
+    job.put()
+    return job
+
+
+def manifest(job):
+    """Return the manifest of an export: counts and checksums of every part of its finished shards."""
+    result = {'exportId': job.key.id(), 'compress': job.compress, 'kinds': {}}
+    for kind in job.kinds:
+        result['kinds'][kind] = {'count': 0, 'parts': []}
+    keys = []
+    for finished in job.finishedShards:
+        kind, shard, lastPart = finished.rsplit(':', 2)
+        keys += [partKey(job.key.id(), kind, int(shard), part) for part in range(int(lastPart) + 1)]
+    # parts are root entities, read by key rather than with an eventually consistent query
+    parts = [part for part in ndb.get_multi(keys) if part]
+    for part in sorted(parts, key=lambda p: (p.kind, p.shard, p.part)):
+        result['kinds'][part.kind]['count'] += part.count
+        result['kinds'][part.kind]['parts'].append({
+            'path': part.path, 'shard': part.shard, 'part': part.part,
+            'count': part.count, 'bytes': part.bytes, 'md5': part.md5})
+    return result
+
+
+def _writeManifest(job):
+    fileobj = SINKS[job.sink]().open(job.manifestPath)
+    fileobj.write(json.dumps(manifest(job), indent=2, sort_keys=True))
+    fileobj.close()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+hotcache.py -- In-process cache of the hottest conference forms
+
+A few conferences get most of the `getConference` and
+`getConferenceSessions` traffic during a big event. Their forms are kept
+in a size-bounded, thread-safe LRU on each instance, with a short TTL.
+
+Every cached form is stamped with the conference's version, a memcache
+counter bumped after each write to the conference or its sessions. A
+request reads the version (one memcache RPC) and serves the form from
+memory if the version still matches, so writes are seen right away by
+every instance. Changes made outside the API, such as a new organizer
+display name, are picked up when the entry expires.
+
+"""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+MEMCACHE_VERSION_NAMESPACE = 'HOTCACHE'
+# maximum number of forms kept per instance, and their time to live (seconds)
+HOT_CACHE_SIZE = 500
+HOT_CACHE_TTL = 30
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache whose entries expire and carry a version."""
+
+    def __init__(self, maxSize, ttl):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (expires, version, value), least recently used first
+        self._entries = collections.OrderedDict()
+        self._counters = dict.fromkeys(('hits', 'misses', 'evictions', 'expirations', 'stale'), 0)
+
+    def get(self, key, version, now=None):
+        """Return the value cached for `key` at `version`, or None."""
+        now = now or time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            expires, entryVersion, value = entry
+            if expires <= now:
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            if entryVersion != version:
+                self._counters['stale'] += 1
+                self._counters['misses'] += 1
+                return None
+            # re-insert as the most recently used entry
+            self._entries[key] = entry
+            self._counters['hits'] += 1
+            return value
+
+    def put(self, key, version, value, now=None):
+        """Cache `value` for `key` at `version`, evicting the least recently used entries."""
+        now = now or time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, version, value)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            for counter in self._counters:
+                self._counters[counter] = 0
+
+    def stats(self):
+        """Return the counters and the current size of the cache."""
+        with self._lock:
+            stats = dict(self._counters, size=len(self._entries), maxSize=self.maxSize)
+        lookups = stats['hits'] + stats['misses']
+        stats['hitRatio'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+
+
+CACHE = LRUCache(HOT_CACHE_SIZE, HOT_CACHE_TTL)
+
+
+def _versionKey(conf_key, scope):
+    return conf_key.urlsafe() if scope is None else '%s:%s' % (scope, conf_key.urlsafe())
+
+
+def version(conf_key, scope=None):
+    """Return the current version of a conference, or None if memcache is unavailable.
+    A `scope` (e.g. 'sessions') is a separate version, bumped only by the writes that invalidate it.
+    """
+    key = _versionKey(conf_key, scope)
+    value = memcache.get(key, namespace=MEMCACHE_VERSION_NAMESPACE)
+    if value is None:
+        # a counter evicted from memcache restarts from the current time,
+        # so it never repeats a version an instance may still hold
+        value = int(time.time() * 1000)
+        if not memcache.add(key, value, namespace=MEMCACHE_VERSION_NAMESPACE):
+            value = memcache.get(key, namespace=MEMCACHE_VERSION_NAMESPACE)
+    return value
+
+
+def invalidate(conf_key, scope=None):
+    """Bump the version of a conference (or of its `scope`) once the current transaction (if any) commits."""
+    ndb.get_context().call_on_commit(
+        lambda: memcache.incr(_versionKey(conf_key, scope), namespace=MEMCACHE_VERSION_NAMESPACE))
+
+
+def getOrBuild(name, conf_key, build, scope=None):
+    """Return the form `name` of a conference from the cache, or `build()` and cache it.
+    The form is valid while the version of the conference (or of its `scope`) doesn't change.
+    """
+    currentVersion = version(conf_key, scope)
+    key = (name, conf_key.urlsafe())
+    value = CACHE.get(key, currentVersion)
+    if value is None:
+        value = build()
+        if currentVersion is not None:
+            CACHE.put(key, currentVersion, value)
+    return value
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+idempotency.py -- Idempotency keys for retried write methods
+
+Clients on flaky networks retry `createConference`, `createSession` and
+`registerForConference`. A request may carry an `idempotencyKey`; the
+first response for a key is saved, and retries with the same key get it
+back instead of creating another conference or session:
+
+    memcache    <user id>:<method>:<key> -> JSON response
+    datastore   IdempotencyRecord(id=<same>), the response until it expires
+
+A retry is answered by one memcache get; the datastore record covers
+evictions. Keys are scoped by user and method, so they never collide
+across users. A retry that arrives while the first request is still
+running is rejected with HTTP 409, and may be retried again.
+
+"""
+
+import datetime
+import functools
+
+import endpoints
+from protorpc import protojson
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import ConflictException
+from models import IdempotencyRecord
+
+MEMCACHE_IDEMPOTENCY_NAMESPACE = 'IDEMPOTENCY'
+# seconds a response is kept for retries
+IDEMPOTENCY_TTL = 24 * 60 * 60
+# seconds a request holds its key while it runs
+PENDING_TTL = 60
+PENDING = '__pending__'
+# longest idempotency key accepted
+MAX_KEY_LENGTH = 128
+# expired records deleted per `expire()` call
+EXPIRE_BATCH_SIZE = 500
+
+
+def _lookup(recordKey):
+    """Return the saved JSON response of `recordKey`, PENDING while it runs, or None."""
+    cached = memcache.get(recordKey.id(), namespace=MEMCACHE_IDEMPOTENCY_NAMESPACE)
+    if cached is not None:
+        return cached
+    # hold the key, so a concurrent retry doesn't redo the work
+    if not memcache.add(recordKey.id(), PENDING, time=PENDING_TTL, namespace=MEMCACHE_IDEMPOTENCY_NAMESPACE):
+        return memcache.get(recordKey.id(), namespace=MEMCACHE_IDEMPOTENCY_NAMESPACE) or PENDING
+    record = recordKey.get()
+    if record and record.expires > datetime.datetime.utcnow():
+        # evicted from memcache
+        memcache.set(recordKey.id(), record.response, time=IDEMPOTENCY_TTL, namespace=MEMCACHE_IDEMPOTENCY_NAMESPACE)
+        return record.response
+    return None
+
+
+def _save(recordKey, response):
+    """Save the JSON `response` of `recordKey` for retries."""
+    IdempotencyRecord(key=recordKey, response=response,
+                      expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=IDEMPOTENCY_TTL)).put()
+    memcache.set(recordKey.id(), response, time=IDEMPOTENCY_TTL, namespace=MEMCACHE_IDEMPOTENCY_NAMESPACE)
+
+
+def idempotent(responseClass):
+    """Decorator returning the saved `responseClass` response of a request's `idempotencyKey`, if any.
+    Requests without a key run as usual. Responses are only saved when the method succeeds.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(service, request):
+            idempotencyKey = getattr(request, 'idempotencyKey', None)
+            if not idempotencyKey:
+                return func(service, request)
+            if len(idempotencyKey) > MAX_KEY_LENGTH:
+                raise endpoints.BadRequestException('Idempotency keys are at most %d characters' % MAX_KEY_LENGTH)
+            user, p_key = service._getUserKey()
+            recordKey = ndb.Key(IdempotencyRecord, '%s:%s:%s' % (p_key.id(), func.__name__, idempotencyKey))
+
+            cached = _lookup(recordKey)
+            if cached == PENDING:
+                raise ConflictException('A request with idempotency key %s is in progress' % idempotencyKey)
+            if cached is not None:
+                return protojson.decode_message(responseClass, cached)
+            try:
+                response = func(service, request)
+            except Exception:
+                # let the client retry with the same key
+                memcache.delete(recordKey.id(), namespace=MEMCACHE_IDEMPOTENCY_NAMESPACE)
+                raise
+            _save(recordKey, protojson.encode_message(response))
+            return response
+        return wrapper
+    return decorator
+
+
+def expire(now=None):
+    """Delete a batch of expired records. Returns the number of records deleted."""
+    now = now or datetime.datetime.utcnow()
+    keys = IdempotencyRecord.query(IdempotencyRecord.expires < now).fetch(EXPIRE_BATCH_SIZE, keys_only=True)
+    ndb.delete_multi(keys)
+    return len(keys)
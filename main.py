@@ -12,20 +12,116 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import datetime
+import json
+import logging
+import time
+
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail, memcache
 from google.appengine.ext import ndb
-from conference import ConferenceApi, MEMCACHE_FEATURED_SPEAKER_KEY
-from models import Session, Speaker
+import background
+
+# Task and cron instances only load what their handler needs: the
+# Endpoints API (conference.py) and the other modules are imported by the
+# handlers that use them.
+
+
+# conferences whose forms are loaded into the hot cache of a new instance
+WARMUP_HOT_CONFERENCES = 20
+
+
+def ms(value):
+    """Format a latency percentile of the reports; None is over the largest latency bucket."""
+    import metrics
+    return '%dms' % value if value is not None else '>%dms' % metrics.LATENCY_BUCKETS[-1]
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Prepare a new instance before it serves user requests.
+        Note:
+            This module imports the API and the models lazily, so the
+            warmup imports them: importing conference.py loads endpoints
+            and protorpc and builds the API server. The most popular
+            conferences (the trending ones, then those with the fewest
+            seats left) are then loaded into the hot cache.
+        """
+        start = time.time()
+        import endpoints
+        from conference import ConferenceApi
+        from models import Conference
+        import trending
+        background.cacheAnnouncement()
+
+        api = ConferenceApi()
+        keys = trending.top(WARMUP_HOT_CONFERENCES)
+        # then the conferences filling up; sold-out ones are trending or long full,
+        # and conferences without a limit have no seats to count
+        for conf in Conference.query(Conference.seatsAvailable > 0).order(Conference.seatsAvailable).fetch(
+                WARMUP_HOT_CONFERENCES):
+            if len(keys) < WARMUP_HOT_CONFERENCES and not conf.deleted and conf.key not in keys:
+                keys.append(conf.key)
+        for key in keys:
+            try:
+                api._conferenceForm(key.urlsafe())
+                api._sessionForms(key.urlsafe())
+            except endpoints.NotFoundException:
+                # deleted conference
+                pass
+        logging.info('Warmup finished in %dms, %d conferences cached', (time.time() - start) * 1000, len(keys))
+        self.response.set_status(200)
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
-        ConferenceApi._cacheAnnouncement()
+        background.cacheAnnouncement()
+        self.response.set_status(204)
+
+class RecomputeRecommendationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild the topic model used by getRecommendedConferences."""
+        import recommendations
+        model = recommendations.recompute()
+        logging.info('Recommendations recomputed: %d conferences, %d topics',
+                     len(model.conferenceKeys), len(model.topics))
+        self.response.set_status(204)
+
+
+class FlushTrendingHandler(webapp2.RequestHandler):
+    def get(self):
+        """Fold the last minutes of registration counters into the trending scores."""
+        import trending
+        trending.flush()
+        self.response.set_status(204)
+
+
+class RollupRegistrationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Fold the registration event log into the per-conference daily stats."""
+        import analytics
+        analytics.rollup()
         self.response.set_status(204)
 
+
+class RebuildCatalogHandler(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild the in-memory conference catalog used by searchConferences."""
+        import catalog
+        entity = catalog.rebuild()
+        logging.info('Conference catalog rebuilt: %d conferences', len(entity.conferences))
+        self.response.set_status(204)
+
+
+class ExpireIdempotencyKeysHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete the expired responses saved for idempotency keys."""
+        import idempotency
+        count = idempotency.expire()
+        logging.info('Expired %d idempotency records', count)
+        self.response.set_status(204)
+
+
 class SetFeaturedSpeaker(webapp2.RequestHandler):
     def post(self):
         """Set featured speaker in Memcache.
@@ -38,38 +134,298 @@ class SetFeaturedSpeaker(webapp2.RequestHandler):
                 - speaker
                     The possibly new featured speaker
         """
+        background.setFeaturedSpeaker(ndb.Key(urlsafe=self.request.get('websafeConferenceKey')),
+                                      self.request.get('speaker'))
+        self.response.set_status(204)
+
 
-        # get conference key
-        key = ndb.Key(urlsafe=self.request.get('websafeConferenceKey'))
-        speaker = Speaker(name=self.request.get('speaker'))
-        # get all sessions registered to this conference filtered by speaker
-        featured_sessions = Session.query(ancestor=key).filter(Session.speaker == speaker).fetch()
+class SendConfirmationEmailHandler(webapp2.RequestHandler):
+    def post(self):
+        """Queue email confirming Conference creation in the outbox.
+            POST params:
+                - websafeConferenceKey
+                    The conference that was created
+        """
+        background.queueConfirmationEmail(ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
 
-        # If speaker is registered to more than one session, update featured speaker
-        if len(featured_sessions) > 1:
-            session_names = [session.name for session in featured_sessions]
-            message = speaker.name + ': ' + ', '.join(session_names)
-            memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, message)
 
+class DeleteConferenceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run the next cleanup batch of a deleted conference.
+            POST params:
+                - websafeConferenceKey
+                    The deleted conference
+                - batch
+                    The batch number the task expects; stale tasks are dropped
+        """
+        import deletion
+        deletion.processBatch(ndb.Key(urlsafe=self.request.get('websafeConferenceKey')),
+                              int(self.request.get('batch', 0)))
         self.response.set_status(204)
 
 
-class SendConfirmationEmailHandler(webapp2.RequestHandler):
+class PromoteWaitlistHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
-            self.request.get('email'),                  # to
-            'You created a new Conference!',            # subj
-            'Hi, you have created a following '         # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
+        """Promote waiters into the free seats of a conference.
+            POST params:
+                - websafeConferenceKey
+                    The conference a seat was freed in
+        """
+        import waitlist
+        waitlist.promote(ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
+        self.response.set_status(204)
+
+
+class MigrateHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one batch of a schema migration.
+            POST params:
+                - name
+                    The migration's name
+                - batch
+                    The batch number the migration is expected to be at
+        """
+        import migrations
+        migrations.runBatch(self.request.get('name'), int(self.request.get('batch')))
+        self.response.set_status(204)
+
+
+class MigrationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show the registered migrations and their checkpoints."""
+        import migrations
+        from models import MigrationState
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('%-30s %-12s %3s %-8s %6s %10s %10s\n' % (
+            'migration', 'kind', 'v', 'status', 'batch', 'processed', 'changed'))
+        for mig in sorted(migrations.MIGRATIONS.values(), key=lambda m: (m.kind, m.version)):
+            state = ndb.Key(MigrationState, mig.name).get()
+            self.response.write('%-30s %-12s %3d %-8s %6s %10s %10s\n' % (
+                mig.name, mig.kind, mig.version, state.status if state else 'new',
+                state.batch if state else '-', state.processed if state else '-',
+                state.changed if state else '-'))
+
+    def post(self):
+        """Start, pause or resume a migration.
+            POST params:
+                - action
+                    start, pause or resume
+                - name
+                    The migration's name
+                - batchSize, countdown (optional)
+                    Rate limit: entities per batch and seconds between batches
+        """
+        import migrations
+        name, action = self.request.get('name'), self.request.get('action')
+        rate = {}
+        if self.request.get('batchSize'):
+            rate['batchSize'] = int(self.request.get('batchSize'))
+        if self.request.get('countdown'):
+            rate['countdown'] = int(self.request.get('countdown'))
+        try:
+            if action == 'start':
+                migrations.start(name, **rate)
+            elif action == 'pause':
+                migrations.pause(name)
+            elif action == 'resume':
+                migrations.resume(name, **rate)
+            else:
+                self.abort(400, 'Unknown action: %s' % action)
+        except migrations.MigrationError as e:
+            self.abort(409, str(e))
+        self.redirect('/admin/migrations')
+
+
+class ExportHandler(webapp2.RequestHandler):
+    def post(self):
+        """Export one batch of an export shard.
+            POST params:
+                - exportId, kind, shard, part
+                    The batch to export
+                - lower, upper, cursor (optional)
+                    The shard's key range and the position within it
+        """
+        import export
+        export.exportBatch(
+            self.request.get('exportId'),
+            self.request.get('kind'),
+            int(self.request.get('shard')),
+            int(self.request.get('part')),
+            lower=self.request.get('lower') or None,
+            upper=self.request.get('upper') or None,
+            cursor=self.request.get('cursor') or None
         )
+        self.response.set_status(204)
+
+
+class ExportAdminHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show the manifest of an export (?exportId=) or the list of exports."""
+        import export
+        from models import ExportJob
+        self.response.headers['Content-Type'] = 'application/json'
+        if self.request.get('exportId'):
+            exportJob = ndb.Key(ExportJob, self.request.get('exportId')).get()
+            if not exportJob:
+                self.abort(404)
+            self.response.write(json.dumps(export.manifest(exportJob), indent=2, sort_keys=True))
+            return
+        jobs = ExportJob.query().order(-ExportJob.started).fetch(20)
+        self.response.write(json.dumps([{'exportId': job.key.id(), 'status': job.status, 'sink': job.sink,
+                                         'pendingShards': job.pendingShards, 'manifest': job.manifestPath}
+                                        for job in jobs], indent=2))
+
+    def post(self):
+        """Start an export.
+            POST params (all optional):
+                - exportId
+                    Defaults to the current UTC time
+                - kinds
+                    Comma separated kinds. Defaults to Conference, Session and Profile
+                - shards, sink (local or gcs), compress (0 or 1)
+                    The sink defaults to gcs; a sink that can't be used is rejected with 400
+        """
+        import export
+        export_id = self.request.get('exportId') or datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        kinds = [kind for kind in self.request.get('kinds', '').split(',') if kind]
+        try:
+            export.start(
+                export_id,
+                kinds=kinds or None,
+                shards=int(self.request.get('shards', export.DEFAULT_SHARDS)),
+                sink=self.request.get('sink', 'gcs'),
+                compress=self.request.get('compress', '1') == '1'
+            )
+        except ValueError as e:
+            self.abort(400, str(e))
+        self.redirect('/admin/export?exportId=' + export_id)
 
 
-app = webapp2.WSGIApplication([
+class DrainOutboxHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send a rate-limited batch of emails from the outbox."""
+        import outbox
+        outbox.drain()
+        self.response.set_status(204)
+
+
+class OutboxStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show outbox depth and throughput."""
+        import outbox
+        stats = outbox.stats()
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('depth: %(depth)d\n'
+                            'emails sent (last hour): %(sent)d\n'
+                            'entries sent (last hour): %(entries)d\n'
+                            'emails per minute: %(sent_per_minute).2f\n' % stats)
+
+
+class MetricsReportHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show latency percentiles and RPC counts per endpoint."""
+        import hotcache
+        import metrics
+        from conference import ConferenceApi
+        names = ['ConferenceApi.' + name for name in sorted(ConferenceApi.all_remote_methods())]
+        names += [route[0] for route in ROUTES]
+        report = metrics.getReport(names)
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        for window in metrics.METRICS_WINDOWS:
+            self.response.write('--- last %d minutes ---\n' % window)
+            self.response.write('%-45s %7s %8s %8s %8s %6s %6s %6s %6s\n' % (
+                'endpoint', 'calls', 'p50', 'p95', 'p99', 'ds', 'mc', 'read', 'write'))
+            for name in sorted(report):
+                stats = report[name][window]
+                if not stats['calls']:
+                    continue
+                self.response.write('%-45s %7d %8s %8s %8s %6.1f %6.1f %6.1f %6.1f\n' % (
+                    name, stats['calls'], ms(stats['p50']), ms(stats['p95']), ms(stats['p99']),
+                    stats['datastore_rpcs'], stats['memcache_rpcs'],
+                    stats['entities_read'], stats['entities_written']))
+            self.response.write('\n')
+
+        cache = hotcache.CACHE.stats()
+        self.response.write('--- hot object cache (this instance) ---\n')
+        self.response.write('size %(size)d/%(maxSize)d, hits %(hits)d, misses %(misses)d (hit ratio %(hitRatio).0f%%), '
+                            'evictions %(evictions)d, expirations %(expirations)d, stale %(stale)d\n'
+                            % dict(cache, hitRatio=cache['hitRatio'] * 100))
+
+
+class ContentionReportHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show transaction attempts, collisions and retry latencies per method, and the hottest entity groups."""
+        import contention
+        import conference  # noqa -- its instrumented methods register themselves in contention.NAMES
+        stats, groups = contention.getReport()
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('--- last %d minutes ---\n' % contention.CONTENTION_WINDOW)
+        self.response.write('%-30s %7s %8s %10s %8s %8s %8s %8s %8s\n' % (
+            'method', 'calls', 'attempts', 'collisions', 'failures', 'retried', 'p50', 'p95', 'p99'))
+        for name in sorted(stats):
+            s = stats[name]
+            self.response.write('%-30s %7d %8d %10d %8d %8d %8s %8s %8s\n' % (
+                name, s['calls'], s['attempts'], s['collisions'], s['failures'], s['retried'],
+                ms(s['p50']) if s['retried'] else '-', ms(s['p95']) if s['retried'] else '-',
+                ms(s['p99']) if s['retried'] else '-'))
+        self.response.write('\n--- hottest entity groups ---\n')
+        for collisions, name, websafeKey in groups:
+            self.response.write('%6d  %-30s %s\n' % (collisions, name, websafeKey))
+
+
+class ProfileReportHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show the top functions of the sampled profiles per endpoint.
+        Optional parameters: `endpoint`, `sort` (cumtime, tottime or calls) and `limit`.
+        """
+        import profiler
+        from conference import ConferenceApi
+        names = ['ConferenceApi.' + name for name in sorted(ConferenceApi.all_remote_methods())]
+        names += [route[0] for route in ROUTES]
+        if self.request.get('endpoint'):
+            names = [self.request.get('endpoint')]
+        sort = self.request.get('sort', 'cumtime')
+        if sort not in profiler.SORT_KEYS:
+            self.abort(400, 'sort must be one of %s' % ', '.join(sorted(profiler.SORT_KEYS)))
+        report = profiler.getReport(names, sort=sort, limit=self.request.get_range('limit', 1, 200, 30))
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        for name in sorted(report):
+            profiles, rows = report[name]
+            self.response.write('--- %s: %d profiles, by %s ---\n' % (name, profiles, sort))
+            self.response.write('%12s %10s %10s %10s %10s  %s\n' % (
+                'ncalls', 'tottime', 'percall', 'cumtime', 'percall', 'function'))
+            for function, cc, nc, tt, ct in rows:
+                # pstats' format: total calls/primitive calls for recursive functions
+                calls = '%d/%d' % (nc, cc) if nc != cc else '%d' % nc
+                self.response.write('%12s %10.4f %10.4f %10.4f %10.4f  %s\n' % (
+                    calls, tt, tt / nc if nc else 0.0, ct, ct / cc if cc else 0.0, function))
+            self.response.write('\n')
+
+
+ROUTES = [
+    ('/_ah/warmup', WarmupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/drain_outbox', DrainOutboxHandler),
+    ('/crons/recompute_recommendations', RecomputeRecommendationsHandler),
+    ('/crons/flush_trending', FlushTrendingHandler),
+    ('/crons/rollup_registrations', RollupRegistrationsHandler),
+    ('/crons/rebuild_catalog', RebuildCatalogHandler),
+    ('/crons/expire_idempotency_keys', ExpireIdempotencyKeysHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/set_featured_speaker', SetFeaturedSpeaker)
-], debug=True)
+    ('/tasks/set_featured_speaker', SetFeaturedSpeaker),
+    ('/tasks/delete_conference', DeleteConferenceHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/migrate', MigrateHandler),
+    ('/tasks/export', ExportHandler),
+    ('/admin/metrics', MetricsReportHandler),
+    ('/admin/contention', ContentionReportHandler),
+    ('/admin/profiles', ProfileReportHandler),
+    ('/admin/outbox', OutboxStatsHandler),
+    ('/admin/migrations', MigrationsHandler),
+    ('/admin/export', ExportAdminHandler)
+]
+
+app = webapp2.WSGIApplication(ROUTES, debug=True)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+metrics.py -- Always-on per-endpoint latency and RPC metrics
+
+Every request passing through `metrics_wsgi_middleware` records its
+latency and the number of datastore/memcache RPCs and entities it read
+and wrote. Counters are flushed to memcache at the end of the request in
+time-bucketed, sharded keys and merged back by `getReport()`.
+
+"""
+
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+MEMCACHE_METRICS_PREFIX = 'METRICS:'
+# width of a time bucket and number of shards per bucket
+METRICS_BUCKET_SECONDS = 60
+METRICS_SHARDS = 4
+# sliding windows (in minutes) shown by the report
+METRICS_WINDOWS = (5, 60)
+# seconds the counters are kept in memcache, past the largest window
+METRICS_TTL = (max(METRICS_WINDOWS) + 5) * 60
+# upper bounds (ms) of the latency histogram; the last bucket is open-ended
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+RPC_COUNTERS = ('datastore_rpcs', 'memcache_rpcs', 'entities_read', 'entities_written')
+COUNTERS = ('calls',) + RPC_COUNTERS + tuple('latency_%d' % i for i in range(len(LATENCY_BUCKETS) + 1))
+SPI_PREFIX = '/_ah/spi/'
+
+_local = threading.local()
+
+
+def _rpcHook(service, call, request, response):
+    """Post-call hook counting RPCs for the request recorded on this thread."""
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        return
+    if service == 'memcache':
+        counters['memcache_rpcs'] += 1
+    elif service == 'datastore_v3':
+        counters['datastore_rpcs'] += 1
+        if call == 'Get':
+            counters['entities_read'] += request.key_size()
+        elif call in ('RunQuery', 'Next') and not response.keys_only():
+            # keys-only results carry no entity data
+            counters['entities_read'] += response.result_size()
+        elif call == 'Put':
+            counters['entities_written'] += request.entity_size()
+        elif call == 'Delete':
+            counters['entities_written'] += request.key_size()
+
+
+def startRecording():
+    """Start counting RPCs made by the current thread."""
+    # `Append` is a no-op when the hook is already installed. It is checked on
+    # every request because the testbed swaps the apiproxy between tests.
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('metrics', _rpcHook)
+    _local.counters = dict.fromkeys(RPC_COUNTERS, 0)
+
+
+def stopRecording():
+    """Stop counting RPCs and return the counters of the current thread."""
+    counters = getattr(_local, 'counters', None) or dict.fromkeys(RPC_COUNTERS, 0)
+    _local.counters = None
+    return counters
+
+
+def endpointName(environ):
+    """Return the name metrics are recorded under for a WSGI request."""
+    path = environ.get('PATH_INFO', '')
+    if path.startswith(SPI_PREFIX):
+        # e.g. /_ah/spi/ConferenceApi.getConference -> ConferenceApi.getConference
+        return path[len(SPI_PREFIX):]
+    return path
+
+
+def latencyBucket(latency):
+    """Return the index of the histogram bucket for `latency` (ms)."""
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if latency <= bound:
+            return i
+    return len(LATENCY_BUCKETS)
+
+
+def _timeBucket(now=None):
+    return int((now or time.time()) // METRICS_BUCKET_SECONDS)
+
+
+def _key(bucket, name, shard, counter):
+    return '%d:%s:%d:%s' % (bucket, name, shard, counter)
+
+
+def record(name, latency, counters, now=None):
+    """Flush the metrics of one request to memcache (an add and an increment RPC).
+
+    :param name: endpoint name. (see `endpointName()`)
+    :param latency: request latency in milliseconds
+    :param counters: RPC counters returned by `stopRecording()`
+    """
+    bucket, shard = _timeBucket(now), random.randint(0, METRICS_SHARDS - 1)
+    deltas = {_key(bucket, name, shard, 'calls'): 1,
+              _key(bucket, name, shard, 'latency_%d' % latencyBucket(latency)): 1}
+    for counter in RPC_COUNTERS:
+        if counters.get(counter):
+            deltas[_key(bucket, name, shard, counter)] = counters[counter]
+    # `offset_multi` can't set an expiry, so the counters are created with one first
+    memcache.add_multi(dict.fromkeys(deltas, 0), time=METRICS_TTL, key_prefix=MEMCACHE_METRICS_PREFIX)
+    memcache.offset_multi(deltas, key_prefix=MEMCACHE_METRICS_PREFIX, initial_value=0)
+
+
+def metrics_wsgi_middleware(app):
+    """Wrap a WSGI application so every request is recorded."""
+    def wsgi_app(environ, start_response):
+        startRecording()
+        start = time.time()
+        try:
+            return app(environ, start_response)
+        finally:
+            counters = stopRecording()
+            record(endpointName(environ), (time.time() - start) * 1000, counters)
+    return wsgi_app
+
+
+def percentile(histogram, p):
+    """Return the upper bound (ms) of the bucket holding the `p` percentile.
+    Returns None when it falls in the open-ended bucket or there is no data.
+    """
+    total = sum(histogram)
+    if not total:
+        return None
+    running = 0
+    for i, count in enumerate(histogram):
+        running += count
+        if running >= total * p / 100.0:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else None
+    return None
+
+
+def _fetch(names, counters, minutes, now=None):
+    """Return {name: {counter: [value per time bucket, newest first]}}."""
+    newest = _timeBucket(now)
+    buckets = range(newest, newest - (minutes * 60 // METRICS_BUCKET_SECONDS), -1)
+    keys = [_key(b, name, shard, counter)
+            for name in names for counter in counters for b in buckets for shard in range(METRICS_SHARDS)]
+    values = memcache.get_multi(keys, key_prefix=MEMCACHE_METRICS_PREFIX)
+    result = {}
+    for name in names:
+        result[name] = {}
+        for counter in counters:
+            result[name][counter] = [
+                sum(int(values.get(_key(b, name, shard, counter), 0)) for shard in range(METRICS_SHARDS))
+                for b in buckets]
+    return result
+
+
+def getReport(names, windows=METRICS_WINDOWS, now=None):
+    """Merge the sharded counters of `names` over sliding windows.
+
+    Returns a dict mapping each name that received calls to a dict of
+    `{window: stats}`, where stats holds `calls`, `p50`, `p95`, `p99` and the
+    average RPC/entity counts per call.
+    """
+    largest = max(windows)
+    # only fetch histograms for endpoints that were actually called
+    calls = _fetch(names, ('calls',), largest, now)
+    names = [name for name in names if sum(calls[name]['calls'])]
+    data = _fetch(names, COUNTERS, largest, now)
+
+    report = {}
+    for name in names:
+        report[name] = {}
+        for window in windows:
+            width = window * 60 // METRICS_BUCKET_SECONDS
+            totals = dict((counter, sum(data[name][counter][:width])) for counter in COUNTERS)
+            histogram = [totals['latency_%d' % i] for i in range(len(LATENCY_BUCKETS) + 1)]
+            stats = {'calls': totals['calls']}
+            for p in (50, 95, 99):
+                stats['p%d' % p] = percentile(histogram, p)
+            for counter in RPC_COUNTERS:
+                stats[counter] = float(totals[counter]) / totals['calls'] if totals['calls'] else 0.0
+            report[name][window] = stats
+    return report
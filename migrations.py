@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""
+migrations.py -- Resumable schema migrations for Conference, Session and Profile
+
+A migration is a versioned function registered with `@migration(Model, version)`.
+It receives an entity and returns True when it changed it. The runner walks
+the kind with a keys-only cursor and chains each batch as a task. A batch
+is loaded with one `get_multi`; the entities the migration changes are
+then re-read and written in their own transactions, run concurrently, so
+a write that commits meanwhile (e.g. a registration) is never overwritten.
+
+The checkpoint (cursor, batch number, counters) is kept in a `MigrationState`
+entity. It is saved in the same transaction that enqueues the next batch,
+so a migration can be paused, resumed and rate-limited (batch size and
+countdown between batches). Every task carries the batch number it
+expects, so duplicated or stale tasks are dropped.
+
+"""
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import MigrationState
+import tasks
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_COUNTDOWN = 0
+
+# migration name -> Migration
+MIGRATIONS = {}
+
+
+class MigrationError(Exception):
+    """MigrationError -- raised when a migration can't be started or resumed"""
+
+
+class Migration(object):
+    """A registered, versioned migration function for one kind."""
+
+    def __init__(self, name, model, version, func):
+        self.name = name
+        self.model = model
+        self.version = version
+        self.func = func
+
+    @property
+    def kind(self):
+        return self.model._get_kind()
+
+
+def migration(model, version):
+    """Decorator registering `func(entity) -> bool` as migration `version` of `model`."""
+    def decorator(func):
+        if func.__name__ in MIGRATIONS:
+            raise MigrationError('Migration %s is already registered' % func.__name__)
+        MIGRATIONS[func.__name__] = Migration(func.__name__, model, version, func)
+        return func
+    return decorator
+
+
+def _getMigration(name):
+    try:
+        return MIGRATIONS[name]
+    except KeyError:
+        raise MigrationError('Unknown migration: %s' % name)
+
+
+@ndb.transactional(xg=True)
+def start(name, batchSize=DEFAULT_BATCH_SIZE, countdown=DEFAULT_COUNTDOWN):
+    """Start migration `name`.
+    Migrations of a kind run one at a time and in version order. The states
+    of the other migrations are read in the transaction that saves this one,
+    so two concurrent starts can't both pass the check.
+    """
+    mig = _getMigration(name)
+    for other in MIGRATIONS.values():
+        if other.kind != mig.kind or other is mig:
+            continue
+        state = ndb.Key(MigrationState, other.name).get()
+        if state and state.status != 'done':
+            raise MigrationError('Migration %s of %s has not finished' % (other.name, mig.kind))
+        if other.version < mig.version and not state:
+            raise MigrationError('Migration %s must run before %s' % (other.name, name))
+    key = ndb.Key(MigrationState, mig.name)
+    if key.get():
+        raise MigrationError('Migration %s was already started' % mig.name)
+    state = MigrationState(key=key, kind=mig.kind, version=mig.version, batchSize=batchSize, countdown=countdown)
+    state.put()
+    tasks.migrationTask(mig.name, state.batch).add(transactional=True)
+    return state
+
+
+@ndb.transactional()
+def pause(name):
+    """Pause migration `name` after its current batch."""
+    state = ndb.Key(MigrationState, name).get()
+    if not state or state.status != 'running':
+        raise MigrationError('Migration %s is not running' % name)
+    state.status = 'paused'
+    state.put()
+    return state
+
+
+@ndb.transactional()
+def resume(name, batchSize=None, countdown=None):
+    """Resume a paused migration from its checkpoint, optionally changing its rate."""
+    state = ndb.Key(MigrationState, name).get()
+    if not state or state.status != 'paused':
+        raise MigrationError('Migration %s is not paused' % name)
+    state.status = 'running'
+    if batchSize:
+        state.batchSize = batchSize
+    if countdown is not None:
+        state.countdown = countdown
+    # a new batch number invalidates any task left over from before the pause
+    state.batch += 1
+    state.put()
+    tasks.migrationTask(name, state.batch).add(transactional=True)
+    return state
+
+
+@ndb.transactional()
+def _saveCheckpoint(name, batch, cursor, more, processed, changed):
+    state = ndb.Key(MigrationState, name).get()
+    if state.batch != batch:
+        # another task already handled this batch
+        return state
+    state.batch += 1
+    state.cursor = cursor.urlsafe() if cursor else None
+    state.processed += processed
+    state.changed += changed
+    if not more:
+        state.status = 'done'
+    elif state.status == 'running':
+        tasks.migrationTask(name, state.batch, state.countdown).add(transactional=True)
+    state.put()
+    return state
+
+
+def _migrateAsync(mig, key):
+    """Apply `mig` to the entity of `key`, re-read in its own transaction.
+    Returns a future of True when the entity was changed.
+    """
+    @ndb.tasklet
+    def txn():
+        entity = yield key.get_async()
+        if not entity or not mig.func(entity):
+            # deleted, or already migrated by a concurrent write
+            raise ndb.Return(False)
+        yield entity.put_async()
+        raise ndb.Return(True)
+    return ndb.transaction_async(txn)
+
+
+def runBatch(name, batch):
+    """Migrate the next batch of migration `name`.
+    Returns the updated `MigrationState`, or None if the task is stale or the migration isn't running.
+    """
+    mig = _getMigration(name)
+    state = ndb.Key(MigrationState, name).get()
+    if not state or state.status != 'running' or state.batch != batch:
+        return None
+
+    cursor = Cursor(urlsafe=state.cursor) if state.cursor else None
+    keys, cursor, more = mig.model.query().fetch_page(state.batchSize, keys_only=True, start_cursor=cursor)
+    # find the entities to change with one batched get, on copies that are never written
+    entities = [entity for entity in ndb.get_multi(keys) if entity]
+    candidates = [entity.key for entity in entities if mig.func(entity)]
+    # then migrate them, each in its own transaction, all at once
+    futures = [_migrateAsync(mig, key) for key in candidates]
+    changed = len([future for future in futures if future.get_result()])
+    return _saveCheckpoint(name, batch, cursor, more, len(entities), changed)
+
+
+# - - - Migrations - - - - - - - - - - - - - - - - - - - - - - - -
+
+@migration(Conference, 1)
+def backfillConferenceMonth(conf):
+    """Set `month` from `startDate` on conferences created without it."""
+    if conf.startDate and conf.month != conf.startDate.month:
+        conf.month = conf.startDate.month
+        return True
+    return False
+
+
+@migration(Conference, 2)
+def backfillConferenceDeleted(conf):
+    """Store `deleted=False` explicitly, so it can be used in equality filters."""
+    if 'deleted' not in conf._values:
+        conf.deleted = False
+        return True
+    return False
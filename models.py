@@ -60,6 +60,24 @@ class Profile(ndb.Model):
     conferenceKeysToAttend = ndb.KeyProperty(kind='Conference', repeated=True)
     wishList = ndb.KeyProperty(kind='Session', repeated=True)
 
+    @classmethod
+    def getOrCreate(cls, user, user_id):
+        """Return the Profile for `user`, creating it if it doesn't exist.
+            Note:
+                Returning users are served by `Key.get()`, which checks ndb's
+                in-context cache and memcache before the datastore. Only
+                first-time users pay for the transactional `get_or_insert`.
+        """
+        profile = ndb.Key(cls, user_id).get()
+        if profile is None:
+            profile = cls.get_or_insert(
+                user_id,
+                displayName=user.nickname(),
+                mainEmail=user.email(),
+                teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
+            )
+        return profile
+
     def toForm(self):
         form = ProfileForm(
             displayName=self.displayName,
@@ -105,6 +123,8 @@ class Conference(ndb.Model):
     endDate = ndb.DateProperty(required=True)
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    # set by `deleteConference`; the conference is removed by a background cleanup
+    deleted = ndb.BooleanProperty(default=False)
 
     @property
     def sessions(self):
@@ -129,6 +149,53 @@ class Conference(ndb.Model):
         return form
 
 
+class ConferenceDeletion(ndb.Model):
+    """ConferenceDeletion -- progress of a deleted conference's background cleanup.
+    Stored as a child of the conference, so it survives the conference itself.
+    """
+    stage = ndb.StringProperty(default='sessions')  # sessions -> profiles -> descendants -> waitlist -> conference -> done
+    # number of the batch the next task runs; tasks of other batches are stale
+    batch = ndb.IntegerProperty(default=0, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    sessionsDeleted = ndb.IntegerProperty(default=0, indexed=False)
+    profilesScrubbed = ndb.IntegerProperty(default=0, indexed=False)
+    entitiesDeleted = ndb.IntegerProperty(default=0, indexed=False)  # other descendants and waitlist entities
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class RegistrationEvent(ndb.Model):
+    """RegistrationEvent -- a registration (+1) or unregistration (-1), waiting for the rollup (child of Conference)"""
+    delta = ndb.IntegerProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class ConferenceStats(ndb.Model):
+    """ConferenceStats -- rolled up registrations of a conference (keyed 'stats', child of Conference)"""
+    days = ndb.JsonProperty()  # 'YYYY-MM-DD' -> [registrations, cancellations]
+    baseline = ndb.IntegerProperty(default=0, indexed=False)  # attendees registered before the event log
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class Waitlist(ndb.Model):
+    """Waitlist -- FIFO waitlist of a sold-out conference (keyed by the conference's websafe key).
+    A root entity, so joining never writes to the conference's entity group.
+    """
+    tail = ndb.IntegerProperty(default=0, indexed=False)  # sequence number of the last waiter
+    head = ndb.IntegerProperty(default=0, indexed=False)  # sequence number of the last promoted (or skipped) waiter
+
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- a waiter, keyed by sequence number (child of Waitlist, never updated)"""
+    userId = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class WaitlistMember(ndb.Model):
+    """WaitlistMember -- sequence number of a user's entry (keyed by user id, child of Waitlist)"""
+    sequence = ndb.IntegerProperty(indexed=False)
+
+
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
     name = messages.StringField(1)
@@ -143,6 +210,7 @@ class ConferenceForm(messages.Message):
     endDate = messages.StringField(10)  # DateTimeField()
     websafeKey = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    idempotencyKey = messages.StringField(13)  # inbound only, see `idempotency.py`
 
 
 class ConferenceForms(messages.Message):
@@ -161,6 +229,78 @@ class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
 
+
+class TopicModel(ndb.Model):
+    """TopicModel -- conferences x topics score matrix used for recommendations (keyed 'latest')"""
+    topics = ndb.StringProperty(repeated=True, indexed=False)
+    conferenceKeys = ndb.KeyProperty(repeated=True, indexed=False)
+    matrix = ndb.BlobProperty(compressed=True)  # float32, one row per conference
+    computed = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class TrendingScores(ndb.Model):
+    """TrendingScores -- decayed registration scores of the trending conferences (keyed 'latest')"""
+    scores = ndb.JsonProperty(compressed=True)  # websafe conference key -> score
+    top = ndb.JsonProperty()  # websafe conference keys, hottest first
+    flushedMinute = ndb.IntegerProperty(indexed=False)  # last minute folded into the scores
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class ConferenceCatalog(ndb.Model):
+    """ConferenceCatalog -- bitmap indexes of every conference, used by searchConferences (keyed 'latest')"""
+    conferences = ndb.JsonProperty(compressed=True)  # websafe keys, one row per conference, by name
+    bitmaps = ndb.JsonProperty(compressed=True)  # field -> value -> bitmap of rows
+    columns = ndb.JsonProperty(compressed=True)  # field -> [sorted values, their rows]
+    computed = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class DailyRegistrationsForm(messages.Message):
+    """DailyRegistrationsForm -- registrations of a conference on one day outbound form message"""
+    date = messages.StringField(1)
+    registrations = messages.IntegerField(2)
+    cancellations = messages.IntegerField(3)
+    attendees = messages.IntegerField(4)  # at the end of the day
+    fillRate = messages.FloatField(5)  # attendees / maxAttendees
+
+
+class ConferenceStatsForm(messages.Message):
+    """ConferenceStatsForm -- registration time series of a conference outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    maxAttendees = messages.IntegerField(2)
+    attendees = messages.IntegerField(3)
+    days = messages.MessageField(DailyRegistrationsForm, 4, repeated=True)
+
+
+class BatchItemForm(messages.Message):
+    """BatchItemForm -- one call of a batch inbound form message"""
+    method = messages.StringField(1, required=True)
+    params = messages.StringField(2)  # JSON object of the method's request fields
+
+
+class BatchRequestForm(messages.Message):
+    """BatchRequestForm -- multiple BatchItemForm inbound form message"""
+    items = messages.MessageField(BatchItemForm, 1, repeated=True)
+
+
+class BatchResultForm(messages.Message):
+    """BatchResultForm -- result of one call of a batch outbound form message"""
+    method = messages.StringField(1)
+    status = messages.IntegerField(2)  # HTTP status the call would have returned
+    result = messages.StringField(3)  # JSON response, when the call succeeded
+    error = messages.StringField(4)
+
+
+class BatchResultForms(messages.Message):
+    """BatchResultForms -- multiple BatchResultForm outbound form message"""
+    items = messages.MessageField(BatchResultForm, 1, repeated=True)
+
+
+class WaitlistForm(messages.Message):
+    """WaitlistForm -- user's position in a conference waitlist outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    position = messages.IntegerField(2)  # 1 is next in line, 0 when not waiting
+
+
 class Speaker(ndb.Model):
     """Speaker -- Speaker object"""
     name = ndb.StringProperty(required=True)
@@ -202,6 +342,7 @@ class SessionForm(messages.Message):
     typeOfSession = messages.StringField(6)
     date = messages.StringField(7)
     startTime = messages.StringField(8)
+    idempotencyKey = messages.StringField(9)  # inbound only, see `idempotency.py`
 
 
 class SessionForms(messages.Message):
@@ -209,6 +350,15 @@ class SessionForms(messages.Message):
     items = messages.MessageField(SessionForm, 1, repeated=True)
 
 
+class ConferenceDetailForm(messages.Message):
+    """ConferenceDetailForm -- conference detail page outbound form message"""
+    conference = messages.MessageField(ConferenceForm, 1)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+    isAttending = messages.BooleanField(3)
+    wishlistSessionKeys = messages.StringField(4, repeated=True)  # the conference's sessions in the user's wishlist
+    featuredSpeaker = messages.StringField(5)
+
+
 class SessionQueryForm(messages.Message):
     """SessionQueryForm -- Session query inbound form message"""
     field = messages.StringField(1)
@@ -219,3 +369,58 @@ class SessionQueryForm(messages.Message):
 class SessionQueryForms(messages.Message):
     """SessionQueryForms -- multiple SessionQueryForm inbound form message"""
     filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+
+
+class IdempotencyRecord(ndb.Model):
+    """IdempotencyRecord -- saved response of a request with an idempotency key (keyed by user, method and key)"""
+    response = ndb.TextProperty()  # JSON
+    expires = ndb.DateTimeProperty()
+
+
+class OutboxMail(ndb.Model):
+    """OutboxMail -- email waiting to be sent by the outbox drain"""
+    to = ndb.StringProperty(required=True)
+    subject = ndb.StringProperty(required=True, indexed=False)
+    body = ndb.TextProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    sent = ndb.DateTimeProperty()  # None while pending
+
+
+class MigrationState(ndb.Model):
+    """MigrationState -- persisted checkpoint of a schema migration (keyed by migration name)"""
+    kind = ndb.StringProperty(required=True)
+    version = ndb.IntegerProperty(required=True)
+    status = ndb.StringProperty(default='running')  # running <-> paused -> done
+    cursor = ndb.StringProperty(indexed=False)
+    batch = ndb.IntegerProperty(default=0, indexed=False)
+    batchSize = ndb.IntegerProperty(default=100, indexed=False)
+    countdown = ndb.IntegerProperty(default=0, indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    changed = ndb.IntegerProperty(default=0, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+
+class ExportJob(ndb.Model):
+    """ExportJob -- JSONL export of one or more kinds (keyed by export id)"""
+    kinds = ndb.StringProperty(repeated=True, indexed=False)
+    sink = ndb.StringProperty(default='local', indexed=False)
+    compress = ndb.BooleanProperty(default=True, indexed=False)
+    pendingShards = ndb.IntegerProperty(default=0, indexed=False)
+    # '<kind>:<shard>:<last part>' of each finished shard
+    finishedShards = ndb.StringProperty(repeated=True, indexed=False)
+    status = ndb.StringProperty(default='running')  # running -> done
+    manifestPath = ndb.StringProperty(indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+
+class ExportPart(ndb.Model):
+    """ExportPart -- one file written by an export shard (keyed by export id, kind, shard and part)"""
+    kind = ndb.StringProperty(required=True)
+    shard = ndb.IntegerProperty(required=True)
+    part = ndb.IntegerProperty(required=True)
+    path = ndb.StringProperty(required=True, indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    bytes = ndb.IntegerProperty(default=0, indexed=False)
+    md5 = ndb.StringProperty(indexed=False)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+outbox.py -- Rate-limited, batched mail outbox
+
+Emails are written to the `OutboxMail` kind instead of being sent right
+away. The drain cron sends them in rate-limited batches, merging all
+pending emails to the same recipient into a single digest.
+
+Each entry is marked as sent, in a transaction, before its email goes out,
+and entries already marked are skipped. Sent entries are kept for
+OUTBOX_SENT_TTL, so a retried `queueConfirmation` finds the sent entry
+instead of queueing the email again.
+
+"""
+
+import datetime
+import logging
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import OutboxMail
+
+# maximum number of emails sent by a single drain run (the cron runs every minute)
+MAIL_DRAIN_BATCH_SIZE = 50
+# maximum number of outbox entries examined by a single drain run
+MAIL_FETCH_LIMIT = 500
+MEMCACHE_OUTBOX_PREFIX = 'OUTBOX:'
+MEMCACHE_OUTBOX_LOCK_KEY = 'DRAIN_LOCK'
+# minutes covered by `stats()`, and seconds its counters are kept
+STATS_MINUTES = 60
+STATS_TTL = (STATS_MINUTES + 5) * 60
+# how long sent entries are kept to dedupe retried confirmations
+OUTBOX_SENT_TTL = datetime.timedelta(days=7)
+CONFIRMATION_SUBJECT = 'You created a new Conference!'
+CONFIRMATION_TPL = 'Hi, you have created a following conference:\r\n\r\n%s'
+DIGEST_SUBJECT = 'You created %d new Conferences!'
+DIGEST_TPL = 'Hi, you have created the following conferences:\r\n\r\n%s'
+
+
+def queueConfirmation(conf, prof):
+    """Add the creation confirmation of `conf` to the outbox.
+    The entry is keyed by the conference, so retried tasks don't send duplicates.
+    """
+    return OutboxMail.get_or_insert(
+        'confirmation:%s' % conf.key.urlsafe(),
+        to=prof.mainEmail,
+        subject=CONFIRMATION_SUBJECT,
+        body=str(conf.toForm(prof.displayName))
+    )
+
+
+def _sender():
+    return 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+
+
+def _minute(now=None):
+    return int((now or time.time()) // 60)
+
+
+def _markAsync(key, sent):
+    """Mark the entry of `key` as sent (or back as pending when `sent` is None) in a transaction.
+    Returns a future of True when the entry changed, False when it is gone or already marked.
+    """
+    @ndb.tasklet
+    def txn():
+        entry = yield key.get_async()
+        if not entry or (entry.sent is None) == (sent is None):
+            raise ndb.Return(False)
+        entry.sent = sent
+        yield entry.put_async()
+        raise ndb.Return(True)
+    return ndb.transaction_async(txn)
+
+
+def _claim(group):
+    """Mark the entries of `group` as sent and return those that were still pending."""
+    now = datetime.datetime.now()
+    futures = [_markAsync(entry.key, now) for entry in group]
+    return [entry for entry, future in zip(group, futures) if future.get_result()]
+
+
+def drain(batch_size=MAIL_DRAIN_BATCH_SIZE, digest=True):
+    """Send up to `batch_size` emails from the outbox, oldest first.
+
+    :param digest: when true, every pending entry for a recipient is merged
+        into a single email. Otherwise every entry is sent on its own.
+
+    Returns the number of emails sent.
+    """
+    # only one drain at a time, so entries aren't sent twice
+    if not memcache.add(MEMCACHE_OUTBOX_LOCK_KEY, 1, time=60, namespace=MEMCACHE_OUTBOX_PREFIX):
+        return 0
+    try:
+        entries = OutboxMail.query(OutboxMail.sent == None).order(OutboxMail.created).fetch(MAIL_FETCH_LIMIT)
+        # group entries by recipient, keeping the oldest recipients first
+        groups = []
+        if digest:
+            byRecipient = {}
+            for entry in entries:
+                if entry.to not in byRecipient:
+                    byRecipient[entry.to] = []
+                    groups.append(byRecipient[entry.to])
+                byRecipient[entry.to].append(entry)
+        else:
+            groups = [[entry] for entry in entries]
+
+        sent = []
+        for group in groups[:batch_size]:
+            # skip entries another drain or an earlier run already sent
+            group = _claim(group)
+            if not group:
+                continue
+            if len(group) == 1:
+                subject, body = group[0].subject, group[0].body
+            else:
+                subject = DIGEST_SUBJECT % len(group)
+                body = DIGEST_TPL % '\r\n\r\n'.join(entry.body for entry in group)
+            try:
+                mail.send_mail(_sender(), group[0].to, subject, body)
+            except Exception:
+                # put the entries back in the outbox, the next drain retries them
+                logging.exception('Failed to send outbox mail to %s', group[0].to)
+                for future in [_markAsync(entry.key, None) for entry in group]:
+                    future.get_result()
+                continue
+            sent.append(group)
+
+        if sent:
+            minute = _minute()
+            deltas = {'sent:%d' % minute: len(sent), 'entries:%d' % minute: sum(len(group) for group in sent)}
+            # `offset_multi` can't set an expiry, so the counters are created with one first
+            memcache.add_multi(dict.fromkeys(deltas, 0), time=STATS_TTL, namespace=MEMCACHE_OUTBOX_PREFIX)
+            memcache.offset_multi(deltas, namespace=MEMCACHE_OUTBOX_PREFIX, initial_value=0)
+
+        # forget the entries sent long ago
+        cutoff = datetime.datetime.now() - OUTBOX_SENT_TTL
+        ndb.delete_multi(OutboxMail.query(OutboxMail.sent < cutoff).fetch(MAIL_FETCH_LIMIT, keys_only=True))
+        return len(sent)
+    finally:
+        memcache.delete(MEMCACHE_OUTBOX_LOCK_KEY, namespace=MEMCACHE_OUTBOX_PREFIX)
+
+
+def stats(minutes=STATS_MINUTES, now=None):
+    """Return the outbox depth and the emails/entries sent over the last `minutes`."""
+    newest = _minute(now)
+    keys = ['%s:%d' % (counter, minute) for counter in ('sent', 'entries')
+            for minute in range(newest - minutes + 1, newest + 1)]
+    values = memcache.get_multi(keys, namespace=MEMCACHE_OUTBOX_PREFIX)
+    sent = sum(int(v) for k, v in values.items() if k.startswith('sent:'))
+    entries = sum(int(v) for k, v in values.items() if k.startswith('entries:'))
+    return {
+        'depth': OutboxMail.query(OutboxMail.sent == None).count(),
+        'sent': sent,
+        'entries': entries,
+        'sent_per_minute': float(sent) / minutes,
+    }
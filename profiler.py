@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+profiler.py -- Sampling cProfile hook for production requests
+
+Appstats and `metrics.py` show the RPCs of an endpoint, not the Python
+frames that burn its CPU. `profiler_wsgi_middleware` runs 1 in N requests
+of each endpoint under cProfile, N being set per endpoint in
+`settings.PROFILE_SAMPLE_RATES` (0, the default, turns profiling off).
+An admin can also profile a single request by sending the
+`X-Profile-Request` header.
+
+Each profile is trimmed to its top functions and stored in one of a ring
+of memcache slots per endpoint:
+
+    <endpoint>:seq          number of profiles taken
+    <endpoint>:<n>          {function: (primitive calls, calls, tottime, cumtime)}
+
+`getReport()` merges the slots of an endpoint into the top functions of
+its last PROFILE_SLOTS profiles.
+
+"""
+
+import cProfile
+import pstats
+import random
+
+from google.appengine.api import memcache
+from google.appengine.api import oauth
+from google.appengine.api import users
+
+from settings import PROFILE_SAMPLE_RATES
+import metrics
+
+MEMCACHE_PROFILE_NAMESPACE = 'PROFILE'
+# profiles kept per endpoint, and for how long (seconds)
+PROFILE_SLOTS = 20
+PROFILE_TTL = 24 * 60 * 60
+# functions kept per profile, by cumulative and by own time
+PROFILE_TOP_FUNCTIONS = 50
+PROFILE_HEADER = 'HTTP_X_PROFILE_REQUEST'
+EMAIL_SCOPE = 'https://www.googleapis.com/auth/userinfo.email'
+SORT_KEYS = {
+    'calls': 1,
+    'tottime': 2,
+    'cumtime': 3,
+}
+
+
+def _seqKey(name):
+    return '%s:seq' % name
+
+
+def _slotKey(name, n):
+    return '%s:%d' % (name, n % PROFILE_SLOTS)
+
+
+def _isAdmin():
+    """Return True if the current user, signed in by cookie or OAuth, is an admin of the app."""
+    if users.is_current_user_admin():
+        return True
+    try:
+        return oauth.is_current_user_admin(EMAIL_SCOPE)
+    except oauth.Error:
+        return False
+
+
+def shouldProfile(name, environ):
+    """Return True if the request `environ` of endpoint `name` is to be profiled."""
+    if environ.get(PROFILE_HEADER) and _isAdmin():
+        return True
+    rate = PROFILE_SAMPLE_RATES.get(name, PROFILE_SAMPLE_RATES['default'])
+    return bool(rate) and random.randint(1, rate) == 1
+
+
+def functionName(function):
+    """Return the pstats-style name of a (file, line, function) tuple."""
+    filename, line, func = function
+    if filename == '~':
+        # built-in functions
+        return func
+    return '%s:%d(%s)' % (filename, line, func)
+
+
+def summarize(profile):
+    """Return the top functions of a `cProfile.Profile` as {name: (primitive calls, calls, tottime, cumtime)}."""
+    stats = pstats.Stats(profile).stats
+    rows = dict((functionName(function), (cc, nc, tt, ct)) for function, (cc, nc, tt, ct, callers) in stats.items())
+    top = set()
+    for i in (SORT_KEYS['cumtime'], SORT_KEYS['tottime']):
+        top.update(sorted(rows, key=lambda name: rows[name][i], reverse=True)[:PROFILE_TOP_FUNCTIONS])
+    return dict((name, rows[name]) for name in top)
+
+
+def record(name, summary):
+    """Store the `summary` of one profile of endpoint `name` in the next slot of its ring."""
+    n = memcache.incr(_seqKey(name), namespace=MEMCACHE_PROFILE_NAMESPACE, initial_value=0)
+    if n:
+        memcache.set(_slotKey(name, n), summary, time=PROFILE_TTL, namespace=MEMCACHE_PROFILE_NAMESPACE)
+
+
+def profiler_wsgi_middleware(app):
+    """Wrap a WSGI application so sampled requests are profiled."""
+    def wsgi_app(environ, start_response):
+        name = metrics.endpointName(environ)
+        if not shouldProfile(name, environ):
+            return app(environ, start_response)
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return app(environ, start_response)
+        finally:
+            profile.disable()
+            record(name, summarize(profile))
+    return wsgi_app
+
+
+def getReport(names, sort='cumtime', limit=30):
+    """Merge the stored profiles of `names`.
+
+    Returns a dict mapping each profiled name to (profiles, rows), where
+    rows are the top `limit` functions by `sort` ('cumtime', 'tottime' or
+    'calls') as (name, primitive calls, calls, tottime, cumtime), summed
+    over the profiles.
+    """
+    seqs = memcache.get_multi([_seqKey(name) for name in names], namespace=MEMCACHE_PROFILE_NAMESPACE)
+    names = [name for name in names if int(seqs.get(_seqKey(name), 0))]
+    keys = [_slotKey(name, n) for name in names for n in range(PROFILE_SLOTS)]
+    slots = memcache.get_multi(keys, namespace=MEMCACHE_PROFILE_NAMESPACE)
+
+    report = {}
+    for name in names:
+        summaries = [slots[key] for key in (_slotKey(name, n) for n in range(PROFILE_SLOTS)) if key in slots]
+        if not summaries:
+            continue
+        merged = {}
+        for summary in summaries:
+            for function, row in summary.items():
+                merged[function] = tuple(a + b for a, b in zip(merged.get(function, (0, 0, 0.0, 0.0)), row))
+        rows = sorted(merged.items(), key=lambda item: item[1][SORT_KEYS[sort]], reverse=True)[:limit]
+        report[name] = (len(summaries), [(function,) + row for function, row in rows])
+    return report
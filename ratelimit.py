@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+ratelimit.py -- Per-user rate limits for the conference API
+
+Endpoint methods decorated with `@limit(methodClass)` draw from a bucket
+per user and method class (read, write, registration). A bucket holds
+`tokens` calls per `period` seconds, refilled continuously: calls are
+counted with an atomic memcache `incr` on the key of the current time
+slice, and the previous slice's count is weighted by the part of it
+still inside the sliding window.
+
+    RATELIMIT:<method class>:<user>:<time slice>
+
+Calls over the limit raise `TooManyRequestsException`, carrying the number
+of seconds after which the call would be accepted and after which the
+bucket is full again. Endpoints can't set a Retry-After header, so both
+are also in the error message. Rejected calls count too, so a client that
+ignores `retryAfter` stays throttled.
+
+"""
+
+import functools
+import math
+import os
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+from settings import RATE_LIMITS
+
+MEMCACHE_RATELIMIT_PREFIX = 'RATELIMIT:'
+
+
+class TooManyRequestsException(endpoints.ServiceException):
+    """TooManyRequestsException -- exception mapped to HTTP 429 response"""
+    http_status = 429
+
+    def __init__(self, methodClass, retryAfter, refillAfter):
+        super(TooManyRequestsException, self).__init__(
+            'Rate limit exceeded for %s requests. Retry after %d seconds; the limit refills in %d seconds.'
+            % (methodClass, retryAfter, refillAfter))
+        self.retryAfter = retryAfter
+        self.refillAfter = refillAfter
+
+
+def _identity():
+    """Return the id rate limits are counted under: the user's email, or the client's address."""
+    user = endpoints.get_current_user()
+    if user:
+        return user.email()
+    return 'ip:%s' % os.environ.get('REMOTE_ADDR', '')
+
+
+def _key(methodClass, identity, timeSlice):
+    return '%s:%s:%d' % (methodClass, identity, timeSlice)
+
+
+def consume(methodClass, identity, now=None):
+    """Take a token from the bucket of `identity`.
+    Returns 0 when the call is allowed, otherwise the seconds until it would be.
+    """
+    if RATE_LIMITS.get(methodClass) is None:
+        return 0
+    tokens, period = RATE_LIMITS[methodClass]
+    now = now or time.time()
+    timeSlice, elapsed = divmod(now, period)
+    timeSlice = int(timeSlice)
+
+    client = memcache.Client()
+    current = _key(methodClass, identity, timeSlice)
+    previous = _key(methodClass, identity, timeSlice - 1)
+    # both RPCs run in parallel
+    incrRpc = client.offset_multi_async({current: 1}, key_prefix=MEMCACHE_RATELIMIT_PREFIX, initial_value=0)
+    prevRpc = client.get_multi_async([previous], key_prefix=MEMCACHE_RATELIMIT_PREFIX)
+    count = incrRpc.get_result().get(current)
+    prevCount = int(prevRpc.get_result().get(previous, 0))
+    if count is None:
+        # memcache is unavailable, don't turn it into an outage
+        return 0
+
+    used = count + prevCount * (1 - float(elapsed) / period)
+    if used <= tokens:
+        return 0
+    if count >= tokens or not prevCount:
+        # the current slice alone is over the limit, wait for the next one
+        retryAfter = period - elapsed
+    else:
+        # wait until enough of the previous slice leaves the window
+        retryAfter = period * (1 - float(tokens - count) / prevCount) - elapsed
+    return max(1, int(math.ceil(retryAfter)))
+
+
+def refillAfter(methodClass, now=None):
+    """Return the seconds until the calls counted now have left the window, refilling the bucket."""
+    period = RATE_LIMITS[methodClass][1]
+    now = now or time.time()
+    return int(math.ceil(2 * period - now % period))
+
+
+def limit(methodClass):
+    """Decorator enforcing the `methodClass` rate limit (see `settings.RATE_LIMITS`) on an endpoint method."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            now = time.time()
+            retryAfter = consume(methodClass, _identity(), now)
+            if retryAfter:
+                raise TooManyRequestsException(methodClass, retryAfter, refillAfter(methodClass, now))
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+recommendations.py -- Topic-similarity recommendations of upcoming conferences
+
+A cron job builds, with NumPy, a conferences x topics score matrix for the
+upcoming conferences:
+
+    tfidf    TF-IDF weights of each conference's topics, rows L2-normalized
+    cooc     topic co-occurrence, cooc[i, j] = P(topic j | topic i)
+    matrix   tfidf . cooc^T
+
+and stores it as a compressed float32 blob in a single `TopicModel`
+entity. Topics are free-form, so only the RECOMMENDATION_MAX_TOPICS most
+frequent ones are kept, and the matrix is capped at MATRIX_MAX_BYTES to
+stay under the 1MB entity limit. A user is described by the topic counts `u` of the conferences
+they attend and of their wishlisted sessions' conferences. Scoring every
+conference is then one matrix-vector product, `matrix . u`: related
+topics (those that co-occur with the user's topics) count too.
+
+"""
+
+import datetime
+import time
+
+import numpy as np
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import TopicModel
+
+MODEL_KEY = ndb.Key(TopicModel, 'latest')
+# upcoming conferences and topics (the most frequent) kept in the model
+RECOMMENDATION_MAX_CONFERENCES = 2000
+RECOMMENDATION_MAX_TOPICS = 64
+# bytes of the float32 matrix (rows x topics x 4); the entity limit is 1MB
+MATRIX_MAX_BYTES = 600 * 1024
+# conferences returned by `recommend()`
+RECOMMENDATIONS = 10
+# seconds an instance serves its decoded model before checking for a newer one
+MODEL_CHECK_SECONDS = 60
+
+# (time checked, computed, model, matrix, topic index) of the model this instance serves
+_decoded = {}
+
+
+def buildMatrix(topicLists, maxTopics=RECOMMENDATION_MAX_TOPICS):
+    """Return (topics, matrix) for the conferences with topics `topicLists`.
+    Only the `maxTopics` topics found in the most conferences are kept.
+    """
+    frequency = {}
+    for topicList in topicLists:
+        for topic in set(topicList):
+            frequency[topic] = frequency.get(topic, 0) + 1
+    topics = sorted(sorted(frequency, key=lambda topic: (-frequency[topic], topic))[:maxTopics])
+    index = dict((topic, i) for i, topic in enumerate(topics))
+    incidence = np.zeros((len(topicLists), len(topics)), dtype=np.float32)
+    for row, topicList in enumerate(topicLists):
+        incidence[row, [index[topic] for topic in topicList if topic in index]] = 1
+    if not incidence.size:
+        return topics, incidence
+
+    # rare topics tell more about a conference than common ones
+    idf = np.log((1.0 + len(topicLists)) / (1.0 + incidence.sum(axis=0))) + 1
+    tfidf = incidence * idf
+    norms = np.sqrt((tfidf ** 2).sum(axis=1))
+    norms[norms == 0] = 1
+    tfidf /= norms[:, np.newaxis]
+
+    cooc = incidence.T.dot(incidence)
+    cooc /= np.maximum(cooc.diagonal(), 1)[:, np.newaxis]
+    return topics, tfidf.dot(cooc.T).astype(np.float32)
+
+
+def recompute(today=None):
+    """Rebuild the model from the upcoming conferences and return it."""
+    today = today or datetime.date.today()
+    conferences = Conference.query(Conference.startDate >= today).order(Conference.startDate).fetch(
+        RECOMMENDATION_MAX_CONFERENCES)
+    conferences = [conf for conf in conferences if conf.topics and not conf.deleted]
+    topics, matrix = buildMatrix([conf.topics for conf in conferences])
+    # conferences without a kept topic never score; the soonest ones are kept within the size limit
+    rows = [row for row in range(len(conferences)) if matrix[row].any()]
+    rows = rows[:MATRIX_MAX_BYTES // (4 * max(len(topics), 1))]
+    conferences, matrix = [conferences[row] for row in rows], matrix[rows]
+    model = TopicModel(key=MODEL_KEY, topics=topics, conferenceKeys=[conf.key for conf in conferences],
+                       matrix=matrix.tostring())
+    model.put()
+    # this instance serves the new model right away
+    _decoded.pop('latest', None)
+    return model
+
+
+@ndb.transactional()
+def forget(conf_key):
+    """Drop the row of `conf_key` (e.g. a deleted conference) from the model."""
+    model = MODEL_KEY.get()
+    if not model or conf_key not in model.conferenceKeys:
+        return
+    row = model.conferenceKeys.index(conf_key)
+    matrix = np.frombuffer(model.matrix, dtype=np.float32).reshape((len(model.conferenceKeys), len(model.topics)))
+    model.matrix = np.delete(matrix, row, axis=0).tostring()
+    del model.conferenceKeys[row]
+    model.put()
+    ndb.get_context().call_on_commit(lambda: _decoded.pop('latest', None))
+
+
+def _load(now=None):
+    """Return (model, matrix, topic index) from memory.
+    The model is read again every MODEL_CHECK_SECONDS, and decoded only when it changed.
+    """
+    now = now or time.time()
+    decoded = _decoded.get('latest')
+    if decoded and now - decoded[0] < MODEL_CHECK_SECONDS:
+        return decoded[2:]
+    model = MODEL_KEY.get()
+    if not model:
+        decoded = (now, None, None, None, None)
+    elif decoded is None or decoded[1] != model.computed:
+        shape = (len(model.conferenceKeys), len(model.topics))
+        matrix = np.frombuffer(model.matrix, dtype=np.float32).reshape(shape) if model.matrix else np.zeros(shape)
+        index = dict((topic, i) for i, topic in enumerate(model.topics))
+        decoded = (now, model.computed, model, matrix, index)
+    else:
+        decoded = (now,) + decoded[1:]
+    _decoded['latest'] = decoded
+    return decoded[2:]
+
+
+def recommend(prof, limit=RECOMMENDATIONS):
+    """Return the keys of the upcoming conferences best matching the topics of `prof`, best first.
+    Conferences the user attends are left out.
+    """
+    model, matrix, index = _load()
+    if model is None or not matrix.size:
+        return []
+    # a session's parent is its conference
+    keys = set(prof.conferenceKeysToAttend) | set(key.parent() for key in prof.wishList)
+    u = np.zeros(len(model.topics), dtype=np.float32)
+    for conf in ndb.get_multi(list(keys)):
+        for topic in (conf.topics if conf else []):
+            if topic in index:
+                u[index[topic]] += 1
+    if not u.any():
+        return []
+
+    scores = matrix.dot(u)
+    attending = set(prof.conferenceKeysToAttend)
+    result = []
+    for i in np.argsort(-scores, kind='mergesort'):
+        if scores[i] <= 0 or len(result) == limit:
+            break
+        if model.conferenceKeys[i] not in attending:
+            result.append(model.conferenceKeys[i])
+    return result
@@ -16,3 +16,30 @@ WEB_CLIENT_ID = 'replace with Web client ID'
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Per-user rate limits of the conference API, as (calls, seconds) per method
+# class. See `ratelimit.py`; None disables a class.
+RATE_LIMITS = {
+    'read': (600, 60),
+    'write': (60, 60),
+    'registration': (20, 60),
+}
+
+# Limits of a `batch` call: the number of calls it holds and their total
+# cost (see `BATCH_METHODS` in `conference.py`).
+BATCH_MAX_ITEMS = 20
+BATCH_MAX_COST = 40
+
+# Retry policy of the instrumented transactions, as (retries, first backoff,
+# max backoff) per method, backoffs in seconds. See `contention.py`.
+TRANSACTION_RETRIES = {
+    'default': (3, 0.01, 0.5),
+    '_conferenceRegistration': (5, 0.02, 1.0),
+}
+
+# Requests profiled by cProfile, as 1 in N requests per endpoint (e.g.
+# 'ConferenceApi.queryConferences': 100); 0 turns profiling off. See
+# `profiler.py`.
+PROFILE_SAMPLE_RATES = {
+    'default': 0,
+}
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+snapshot.py -- Columnar snapshot of a conference's sessions
+
+Session queries scoped to one conference are answered from a snapshot
+of its sessions, cached in memcache as NumPy columns with one row per
+session, in key order:
+
+    ids             session ids (keys are rebuilt under the conference)
+    startTime       minutes since midnight
+    duration        minutes
+    date            date ordinals
+    typeOfSession   codes into sorted vocabularies, so inequalities on
+    speaker         strings compare codes too
+    name
+
+Each filter becomes a boolean mask over a column, and a query ANDs the
+masks of its filters, as the datastore does. A query costs a few vectorized comparisons however many
+inequalities it has, where the datastore allows only one.
+
+The snapshot carries the conference's 'sessions' version (see
+`hotcache.py`), which is bumped after each session write. A snapshot of an
+older version is rebuilt with one ancestor query.
+
+"""
+
+import bisect
+import operator
+
+import numpy as np
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Session
+import hotcache
+
+MEMCACHE_SNAPSHOT_NAMESPACE = 'SNAPSHOT'
+# string columns, stored as codes into their vocabularies
+CODED_COLUMNS = ('typeOfSession', 'speaker', 'name')
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def build(conf_key):
+    """Return the snapshot of the sessions of `conf_key`."""
+    sessions = Session.query(ancestor=conf_key).fetch()
+    snap = {
+        'ids': [session.key.id() for session in sessions],
+        'startTime': np.array([session.startTime.hour * 60 + session.startTime.minute for session in sessions],
+                              dtype=np.int32),
+        'duration': np.array([session.duration for session in sessions], dtype=np.int32),
+        'date': np.array([session.date.toordinal() for session in sessions], dtype=np.int32),
+    }
+    values = {
+        'typeOfSession': [session.typeOfSession for session in sessions],
+        'speaker': [session.speaker.name for session in sessions],
+        'name': [session.name for session in sessions],
+    }
+    for column in CODED_COLUMNS:
+        vocabulary = sorted(set(values[column]))
+        index = dict((value, code) for code, value in enumerate(vocabulary))
+        snap[column + 'Vocabulary'] = vocabulary
+        snap[column] = np.array([index[value] for value in values[column]], dtype=np.int32)
+    return snap
+
+
+def load(conf_key):
+    """Return the snapshot of the sessions of `conf_key`, from memcache when it is current."""
+    currentVersion = hotcache.version(conf_key, 'sessions')
+    key = conf_key.urlsafe()
+    snap = memcache.get(key, namespace=MEMCACHE_SNAPSHOT_NAMESPACE)
+    if snap is None or snap['version'] != currentVersion:
+        snap = build(conf_key)
+        snap['version'] = currentVersion
+        if currentVersion is not None:
+            memcache.set(key, snap, namespace=MEMCACHE_SNAPSHOT_NAMESPACE)
+    return snap
+
+
+def mask(snap, field, op, value):
+    """Return the boolean mask of the sessions whose `field` compares to `value` with operator `op` ('=', '<', ...).
+    `value` is a date for 'date', a time for 'startTime', and an int or string for the other fields.
+    """
+    column = snap[field]
+    if field == 'date':
+        return OPERATORS[op](column, value.toordinal())
+    if field == 'startTime':
+        return OPERATORS[op](column, value.hour * 60 + value.minute)
+    if field not in CODED_COLUMNS:
+        return OPERATORS[op](column, value)
+
+    # codes follow the sorted vocabulary, so string comparisons become code comparisons
+    vocabulary = snap[field + 'Vocabulary']
+    left, right = bisect.bisect_left(vocabulary, value), bisect.bisect_right(vocabulary, value)
+    if op in ('=', '!='):
+        # `value` has the code `left` if it is in the vocabulary at all
+        matches = column == left if left < right else np.zeros(len(column), dtype=bool)
+        return matches if op == '=' else ~matches
+    if op == '<':
+        return column < left
+    if op == '<=':
+        return column < right
+    if op == '>':
+        return column >= right
+    return column >= left
+
+
+def select(snap, conf_key, rows):
+    """Return the keys of the sessions selected by the boolean mask `rows`, in key order."""
+    return [ndb.Key(Session, snap['ids'][i], parent=conf_key) for i in np.flatnonzero(rows)]
+
+
+def query(snap, filters):
+    """Return the boolean mask of the sessions matching every (field, operator, value) filter."""
+    rows = np.ones(len(snap['ids']), dtype=bool)
+    for field, op, value in filters:
+        rows &= mask(snap, field, op, value)
+    return rows
@@ -550,16 +550,21 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
     $scope.conference = {};
 
+    $scope.sessions = [];
+
+    $scope.wishlistSessionKeys = [];
+
     $scope.isUserAttending = false;
 
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Invokes the conference.getConferenceDetail method and sets the returned conference, its sessions,
+     * the user's registration state and the featured speaker in the $scope.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
+        gapi.client.conference.getConferenceDetail({
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
@@ -567,40 +572,39 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 if (resp.error) {
                     // The request has failed.
                     var errorMessage = resp.error.message || '';
-                    $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeKey
+                    $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeConferenceKey
                         + ' ' + errorMessage;
                     $scope.alertStatus = 'warning';
                     $log.error($scope.messages);
                 } else {
                     // The request has succeeded.
+                    var detail = resp.result;
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
-                }
-            });
-        });
-
-        $scope.loading = true;
-        // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // Failed to get a user profile.
-                } else {
-                    var profile = resp.result;
-                    for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                        if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
-                            // The user is attending the conference.
-                            $scope.alertStatus = 'info';
-                            $scope.messages = 'You are attending this conference';
-                            $scope.isUserAttending = true;
-                        }
+                    $scope.conference = detail.conference;
+                    $scope.sessions = detail.sessions || [];
+                    $scope.wishlistSessionKeys = detail.wishlistSessionKeys || [];
+                    $scope.featuredSpeaker = detail.featuredSpeaker;
+                    if (detail.isAttending) {
+                        // The user is attending the conference.
+                        $scope.alertStatus = 'info';
+                        $scope.messages = 'You are attending this conference';
+                        $scope.isUserAttending = true;
                     }
                 }
             });
         });
     };
 
+    /**
+     * Returns true if the session is in the user's wishlist.
+     *
+     * @param session
+     * @returns {boolean}
+     */
+    $scope.isInWishlist = function (session) {
+        return $scope.wishlistSessionKeys.indexOf(session.websafeKey) != -1;
+    };
+
 
     /**
      * Invokes the conference.registerForConference method.
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+tasks.py -- In-request task buffer for the conference API
+
+Tasks added during a request are buffered and enqueued together with one
+batched `Queue.add_async` when the request's endpoint method returns.
+Named tasks are coalesced: the buffer drops duplicates, and the task
+queue rejects names that were already enqueued.
+
+"""
+
+import functools
+import hashlib
+import logging
+import threading
+import time
+
+from google.appengine.api import taskqueue
+
+# maximum number of tasks accepted by a single `Queue.add` call
+MAX_TASKS_PER_ADD = taskqueue.MAX_TASKS_PER_ADD
+# featured speaker tasks for the same conference & speaker are coalesced within this window
+FEATURED_SPEAKER_COALESCE_SECONDS = 10
+
+SEND_CONFIRMATION_EMAIL_URL = '/tasks/send_confirmation_email'
+SET_FEATURED_SPEAKER_URL = '/tasks/set_featured_speaker'
+DELETE_CONFERENCE_URL = '/tasks/delete_conference'
+MIGRATE_URL = '/tasks/migrate'
+EXPORT_URL = '/tasks/export'
+PROMOTE_WAITLIST_URL = '/tasks/promote_waitlist'
+
+_local = threading.local()
+
+
+def _buffer():
+    if getattr(_local, 'tasks', None) is None:
+        _local.tasks = []
+    return _local.tasks
+
+
+def add(task):
+    """Buffer `task` until `flush()`. Named tasks already in the buffer are dropped."""
+    tasks = _buffer()
+    if task.name and any(t.name == task.name for t in tasks):
+        return
+    tasks.append(task)
+
+
+def discard():
+    """Drop every buffered task."""
+    _local.tasks = None
+
+
+def flush(queue_name='default'):
+    """Enqueue every buffered task using batched asynchronous adds."""
+    tasks = _buffer()
+    discard()
+    if not tasks:
+        return
+    queue = taskqueue.Queue(queue_name)
+    rpcs = [queue.add_async(tasks[i:i + MAX_TASKS_PER_ADD]) for i in range(0, len(tasks), MAX_TASKS_PER_ADD)]
+    for rpc in rpcs:
+        try:
+            rpc.get_result()
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # a coalesced task is already pending (or ran); the other tasks were added
+            logging.debug('Skipped tasks that were already enqueued')
+
+
+def flushTasks(func):
+    """Decorator flushing the task buffer when an endpoint method returns.
+    Tasks buffered by a method that raises are discarded.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            discard()
+            raise
+        flush()
+        return result
+    return wrapper
+
+
+def confirmationEmailTask(conf_key):
+    """Return the task emailing the organizer of `conf_key`."""
+    return taskqueue.Task(url=SEND_CONFIRMATION_EMAIL_URL,
+                          params={'websafeConferenceKey': conf_key.urlsafe()})
+
+
+def featuredSpeakerTask(conf_key, speaker, now=None):
+    """Return the task checking whether `speaker` is featured in `conf_key`.
+
+    The task is named after the conference, the speaker and the current
+    coalescing window and runs once the window closes, so creating many
+    sessions for the same speaker enqueues a single recompute.
+    """
+    window = int((now or time.time()) // FEATURED_SPEAKER_COALESCE_SECONDS)
+    digest = hashlib.md5('%s:%s' % (conf_key.urlsafe(), speaker.encode('utf-8'))).hexdigest()
+    return taskqueue.Task(url=SET_FEATURED_SPEAKER_URL,
+                          name='featured-speaker-%s-%d' % (digest, window),
+                          countdown=FEATURED_SPEAKER_COALESCE_SECONDS,
+                          params={'websafeConferenceKey': conf_key.urlsafe(), 'speaker': speaker})
+
+
+def deleteConferenceTask(conf_key, batch):
+    """Return the task running cleanup batch `batch` of a deleted conference."""
+    return taskqueue.Task(url=DELETE_CONFERENCE_URL,
+                          params={'websafeConferenceKey': conf_key.urlsafe(), 'batch': batch})
+
+
+def promoteWaitlistTask(conf_key):
+    """Return the task promoting waiters of `conf_key` into its free seats."""
+    return taskqueue.Task(url=PROMOTE_WAITLIST_URL,
+                          params={'websafeConferenceKey': conf_key.urlsafe()})
+
+
+def migrationTask(name, batch, countdown=0):
+    """Return the task running batch number `batch` of migration `name`."""
+    return taskqueue.Task(url=MIGRATE_URL, countdown=countdown,
+                          params={'name': name, 'batch': batch})
+
+
+def exportTask(export_id, kind, shard, part=0, lower=None, upper=None, cursor=None):
+    """Return the task exporting part `part` of shard `shard` of `kind`.
+    `lower`/`upper` are the websafe keys bounding the shard's key range.
+    """
+    params = {'exportId': export_id, 'kind': kind, 'shard': shard, 'part': part}
+    for name, value in (('lower', lower), ('upper', upper), ('cursor', cursor)):
+        if value:
+            params[name] = value
+    return taskqueue.Task(url=EXPORT_URL, params=params)
@@ -1,7 +1,11 @@
 import unittest
+import webapp2
+import collections
+import contextlib
 import datetime
 import os
 from os.path import dirname
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import users
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
@@ -16,6 +20,8 @@ from models import (
 )
 
 from utils import getUserId
+import catalog
+import hotcache
 
 _parentDir = os.path.realpath(dirname(dirname(__file__)))
 
@@ -44,15 +50,55 @@ class BaseEndpointAPITestCase(unittest.TestCase):
         self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
         self.testbed.init_mail_stub()
 
+        # Count every datastore and memcache round trip so tests can assert RPC budgets.
+        # The hook is installed on the testbed's own apiproxy, so it goes away on deactivate().
+        self.rpcCounts = collections.Counter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpc_counter', self._countRpc)
+
         # Clear ndb's in-context cache between tests.
         # This prevents data from leaking between tests.
         # Alternatively, you could disable caching by
         # using ndb.get_context().set_cache_policy(False)
         ndb.get_context().clear_cache()
+        # the in-process hot cache and catalog outlive the testbed, clear them as well
+        hotcache.CACHE.clear()
+        catalog._loaded.clear()
 
     def tearDown(self):
         self.testbed.deactivate()
 
+    def _countRpc(self, service, call, request, response):
+        self.rpcCounts[service] += 1
+
+    @contextlib.contextmanager
+    def countRpcs(self, clear_cache=True):
+        """ Counts the datastore and memcache RPCs made inside the `with` block.
+            Yields a dict that is filled with `datastore` and `memcache` counts on exit.
+            When `clear_cache` is true, ndb's in-context cache, the hot cache and memcache are cleared first,
+            so every measurement starts from the same cold state.
+        """
+        if clear_cache:
+            ndb.get_context().clear_cache()
+            hotcache.CACHE.clear()
+            memcache.flush_all()
+        counts = {}
+        before = self.rpcCounts.copy()
+        yield counts
+        counts['datastore'] = self.rpcCounts['datastore_v3'] - before['datastore_v3']
+        counts['memcache'] = self.rpcCounts['memcache'] - before['memcache']
+
+    @contextlib.contextmanager
+    def assertRpcBudget(self, datastore=None, memcache=None):
+        """ Fails if the `with` block makes more datastore or memcache RPCs than the given budget """
+        with self.countRpcs() as counts:
+            yield counts
+        if datastore is not None:
+            assert counts['datastore'] <= datastore, \
+                'Exceeded datastore RPC budget: %d > %d' % (counts['datastore'], datastore)
+        if memcache is not None:
+            assert counts['memcache'] <= memcache, \
+                'Exceeded memcache RPC budget: %d > %d' % (counts['memcache'], memcache)
+
     def initDatabase(self):
         """ Adds database fixtures """
         _profiles = [
@@ -151,6 +197,24 @@ class BaseEndpointAPITestCase(unittest.TestCase):
                 session['key'] = ndb.Key(Session, c_id, parent=conf.key)
                 Session(**session).put()
 
+    def runTasks(self, app, url=None):
+        """ Runs queued tasks (optionally only those for `url`) against `app` until the queue is empty.
+            Returns the number of tasks that were run.
+        """
+        count = 0
+        tasks = self.taskqueue_stub.get_filtered_tasks(url=url)
+        while tasks:
+            for task in tasks:
+                self.taskqueue_stub.DeleteTask('default', task.name)
+                request = webapp2.Request.blank(task.url + '?' + task.payload)
+                request.method = task.method
+                response = request.get_response(app)
+                assert response.status_int in (200, 204), \
+                    'Task %s failed with status %d' % (task.url, response.status_int)
+                count += 1
+            tasks = self.taskqueue_stub.get_filtered_tasks(url=url)
+        return count
+
     def login(self, email='test1@test.com', is_admin=False):
         """ Logs in user (using simulation). If no arguments are given, logs in using default user `test1@test.com` """
         self.testbed.setup_env(
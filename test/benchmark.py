@@ -0,0 +1,379 @@
+"""
+benchmark.py -- Conference API benchmarks on top of the testbed stubs
+
+Generates deterministic synthetic datasets of increasing size, runs every
+`ConferenceApi` method against them and reports ops/sec, RPCs per call and
+peak memory. Results can be saved as a baseline and later runs are checked
+against it.
+
+    python test/benchmark.py --sizes 100,1000 --baseline test/benchmark_baseline.json --update
+    python test/benchmark.py --sizes 100,1000 --baseline test/benchmark_baseline.json
+    python test/benchmark.py --sizes 100,1000 --cache-hits
+    python test/benchmark.py --startup
+
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import random
+import os
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+import runner
+from base import BaseEndpointAPITestCase
+from google.appengine.ext import ndb
+from protorpc import message_types
+
+from conference import (
+    ConferenceApi,
+    CONF_GET_REQUEST,
+    SESSION_BY_TYPE_GET_REQUEST,
+    SESSION_BY_SPEAKER_GET_REQUEST,
+)
+from models import (
+    Profile,
+    Conference,
+    ConferenceQueryForm,
+    ConferenceQueryForms,
+    Session,
+    SessionQueryForm,
+    SessionQueryForms,
+    Speaker
+)
+import metrics
+import ratelimit
+
+DEFAULT_SIZES = (10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5)
+DEFAULT_REPEAT = 20
+# a run regresses when ops/sec drops by more than this fraction of the baseline
+OPS_TOLERANCE = 0.25
+# RPC counts are deterministic, any increase over the baseline is a regression
+RPC_TOLERANCE = 0
+
+CITIES = ('London', 'Baton Rouge', 'Paris', 'Tokyo', 'Sao Paulo', 'Berlin')
+TOPICS = ('programming', 'web design', 'web performance', 'misc', 'mobile', 'cloud')
+SESSION_TYPES = ('workshop', 'lecture', 'keynote', 'educational', 'fun')
+SPEAKERS = 50
+BATCH_SIZE = 500
+
+# WSGI applications whose cold import time is measured by --startup
+STARTUP_APPS = ('main.app', 'conference.api')
+STARTUP_SCRIPT = ('import sys, time, runner\n'
+                  'before = len(sys.modules)\n'
+                  'start = time.time()\n'
+                  'import %(module)s\n'
+                  '%(module)s.%(attr)s\n'
+                  'print time.time() - start, len(sys.modules) - before\n')
+
+
+class ConferenceBenchmark(BaseEndpointAPITestCase):
+    """ Reuses the testbed stubs of `BaseEndpointAPITestCase`. """
+
+    def runTest(self):
+        """Not a test. The benchmark is driven by `measure()`."""
+
+    def setUp(self):
+        super(ConferenceBenchmark, self).setUp()
+        # keep the rate limiter in the measured path, but never throttle the benchmark user
+        self.rateLimits = dict(ratelimit.RATE_LIMITS)
+        for methodClass in ratelimit.RATE_LIMITS:
+            ratelimit.RATE_LIMITS[methodClass] = (sys.maxint, 60)
+
+    def tearDown(self):
+        ratelimit.RATE_LIMITS.update(self.rateLimits)
+        super(ConferenceBenchmark, self).tearDown()
+
+    def populate(self, size, seed=0):
+        """ Adds `size` conferences and `size` sessions, deterministically generated from `seed` """
+        rand = random.Random(seed)
+        baseDate = datetime.date(2015, 1, 1)
+
+        profiles = [Profile(key=ndb.Key(Profile, 'user%d@test.com' % i), displayName='user %d' % i,
+                            mainEmail='user%d@test.com' % i) for i in range(max(3, size // 10))]
+        ndb.put_multi(profiles)
+
+        conferences = []
+        for i in range(size):
+            startDate = baseDate + datetime.timedelta(days=rand.randint(0, 364))
+            maxAttendees = rand.randint(1, 500)
+            organizer = profiles[rand.randint(0, len(profiles) - 1)]
+            conferences.append(Conference(
+                key=ndb.Key(Conference, i + 1, parent=organizer.key),
+                name='conference %d' % i,
+                organizerUserId=organizer.key.id(),
+                topics=rand.sample(TOPICS, rand.randint(1, 3)),
+                city=rand.choice(CITIES),
+                startDate=startDate,
+                month=startDate.month,
+                endDate=startDate + datetime.timedelta(days=rand.randint(0, 10)),
+                maxAttendees=maxAttendees,
+                seatsAvailable=rand.randint(0, maxAttendees)
+            ))
+        self._putInBatches(conferences)
+
+        sessions = []
+        for i in range(size):
+            conf = conferences[rand.randint(0, size - 1)]
+            sessions.append(Session(
+                key=ndb.Key(Session, i + 1, parent=conf.key),
+                name='session %d' % i,
+                speaker=Speaker(name='speaker %d' % rand.randint(0, SPEAKERS - 1)),
+                duration=rand.choice((30, 45, 60, 90, 120)),
+                typeOfSession=rand.choice(SESSION_TYPES),
+                date=conf.startDate,
+                startTime=datetime.time(hour=rand.randint(6, 22), minute=rand.choice((0, 15, 30, 45)))
+            ))
+        self._putInBatches(sessions)
+
+        # give the benchmark user some registrations and a wish list
+        user = profiles[0]
+        user.conferenceKeysToAttend = [c.key for c in rand.sample(conferences, min(10, size))]
+        user.wishList = [s.key for s in rand.sample(sessions, min(10, size))]
+        user.put()
+        return user, conferences, sessions
+
+    def _putInBatches(self, entities):
+        for i in range(0, len(entities), BATCH_SIZE):
+            ndb.put_multi(entities[i:i + BATCH_SIZE])
+
+    def cases(self, user, conferences, sessions):
+        """ Returns a list of (name, callable) pairs, one per API method """
+        conf = conferences[0]
+        session = sessions[0]
+        confRequest = CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=conf.key.urlsafe())
+        void = message_types.VoidMessage()
+        # register and unregister in the same call so every repetition starts from the same state
+        regConf = next(c for c in conferences if c.seatsAvailable > 0 and c.key not in user.conferenceKeysToAttend)
+        regRequest = CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=regConf.key.urlsafe())
+
+        def registration(api):
+            api.registerForConference(regRequest)
+            api.unregisterFromConference(regRequest)
+
+        return [
+            ('getProfile', lambda api: api.getProfile(void)),
+            ('getConference', lambda api: api.getConference(confRequest)),
+            ('getConferencesCreated', lambda api: api.getConferencesCreated(void)),
+            ('getConferencesToAttend', lambda api: api.getConferencesToAttend(void)),
+            ('getConferenceSessions', lambda api: api.getConferenceSessions(confRequest)),
+            ('getConferenceSessionsByType', lambda api: api.getConferenceSessionsByType(
+                SESSION_BY_TYPE_GET_REQUEST.combined_message_class(
+                    websafeConferenceKey=conf.key.urlsafe(), typeOfSession=session.typeOfSession))),
+            ('getSessionsBySpeaker', lambda api: api.getSessionsBySpeaker(
+                SESSION_BY_SPEAKER_GET_REQUEST.combined_message_class(speaker=session.speaker.name))),
+            ('getSessionsInWishlist', lambda api: api.getSessionsInWishlist(void)),
+            ('queryConferences', lambda api: api.queryConferences(ConferenceQueryForms(filters=[
+                ConferenceQueryForm(field='CITY', operator='EQ', value='London'),
+                ConferenceQueryForm(field='MONTH', operator='GT', value='6'),
+                ConferenceQueryForm(field='MAX_ATTENDEES', operator='LT', value='100')]))),
+            ('querySessions', lambda api: api.querySessions(SessionQueryForms(filters=[
+                SessionQueryForm(field='TYPE_OF_SESSION', operator='NE', value='workshop'),
+                SessionQueryForm(field='START_TIME', operator='LT', value='19:00'),
+                SessionQueryForm(field='DURATION', operator='LTEQ', value='60')]))),
+            ('registerForConference+unregister', registration),
+            ('getAnnouncement', lambda api: api.getAnnouncement(void)),
+            ('getFeaturedSpeaker', lambda api: api.getFeaturedSpeaker(void)),
+        ]
+
+    def measure(self, size, repeat=DEFAULT_REPEAT):
+        """ Returns {case name: {'ops_per_sec', 'rpcs', 'entities_read'}} for a dataset of `size` """
+        user, conferences, sessions = self.populate(size)
+        self.login(email=user.mainEmail)
+        results = {}
+        for name, case in self.cases(user, conferences, sessions):
+            elapsed, rpcs, reads = 0.0, 0, 0
+            for i in range(repeat):
+                # every call simulates a new request: new service instance, empty context cache
+                ndb.get_context().clear_cache()
+                api = ConferenceApi()
+                metrics.startRecording()
+                start = time.time()
+                case(api)
+                elapsed += time.time() - start
+                counters = metrics.stopRecording()
+                rpcs += counters['datastore_rpcs'] + counters['memcache_rpcs']
+                reads += counters['entities_read']
+            results[name] = {
+                'ops_per_sec': repeat / elapsed if elapsed else float('inf'),
+                'rpcs': float(rpcs) / repeat,
+                'entities_read': float(reads) / repeat,
+            }
+        results['_peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return results
+
+    def cacheHitRatios(self, size):
+        """ Compares the cache-hit ratio of the keys-only listing endpoints against full-entity queries.
+            Returns {listing: {'keys_only': ratio, 'full_entity': ratio}}, where ratio is the share of the
+            returned entities that did not have to be read from the datastore on a warm (second) request.
+        """
+        user, conferences, sessions = self.populate(size)
+        self.login(email=user.mainEmail)
+        void = message_types.VoidMessage()
+        london = ConferenceQueryForms(filters=[ConferenceQueryForm(field='CITY', operator='EQ', value='London')])
+        lectures = SessionQueryForms(filters=[SessionQueryForm(field='TYPE_OF_SESSION', operator='EQ',
+                                                               value='lecture')])
+        listings = [
+            ('getConferencesCreated', lambda: ConferenceApi().getConferencesCreated(void).items,
+             lambda: Conference.query(ancestor=user.key).fetch()),
+            ('queryConferences', lambda: ConferenceApi().queryConferences(london).items,
+             lambda: Conference.query(Conference.city == 'London').order(Conference.name).fetch()),
+            ('querySessions', lambda: ConferenceApi().querySessions(lectures).items,
+             lambda: Session.query(Session.typeOfSession == 'lecture').order(Session.typeOfSession).fetch()),
+        ]
+
+        def hitRatio(listing):
+            listing()  # warm up memcache
+            ndb.get_context().clear_cache()
+            metrics.startRecording()
+            items = listing()
+            read = metrics.stopRecording()['entities_read']
+            return 1 - float(read) / len(items) if items else 1.0
+
+        return dict((name, {'keys_only': hitRatio(api), 'full_entity': hitRatio(full)})
+                    for name, api, full in listings)
+
+
+def measureInChild(size, repeat):
+    """ Runs the benchmark for `size` in a fresh testbed, in a forked process.
+        The peak RSS of a process never goes down, but a forked child starts from its parent's
+        current RSS, so each size reports its own peak rather than the largest one so far.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        status = 1
+        try:
+            bench = ConferenceBenchmark()
+            bench.setUp()
+            try:
+                results = bench.measure(size, repeat)
+            finally:
+                bench.tearDown()
+            with os.fdopen(write, 'w') as f:
+                json.dump(results, f)
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(write)
+    with os.fdopen(read) as f:
+        output = f.read()
+    if os.waitpid(pid, 0)[1]:
+        raise RuntimeError('benchmark of size %d failed' % size)
+    return json.loads(output)
+
+
+def runBenchmarks(sizes, repeat=DEFAULT_REPEAT):
+    """ Runs the benchmark for every size in its own process """
+    return dict((str(size), measureInChild(size, repeat)) for size in sizes)
+
+
+def runCacheHitBenchmarks(sizes):
+    """ Runs the cache-hit comparison for every size in a fresh testbed """
+    results = {}
+    for size in sizes:
+        bench = ConferenceBenchmark()
+        bench.setUp()
+        try:
+            results[str(size)] = bench.cacheHitRatios(size)
+        finally:
+            bench.tearDown()
+    return results
+
+
+def importCost(app, repeat):
+    """ Imports `app` (module.attribute) in `repeat` fresh interpreters.
+        Returns the median import time in ms and the number of modules it loaded.
+    """
+    module, attr = app.split('.')
+    times = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT % {'module': module, 'attr': attr}],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds, modules = output.split()[-2:]
+        times.append(float(seconds) * 1000)
+    return sorted(times)[len(times) // 2], int(modules)
+
+
+def findRegressions(results, baseline, ops_tolerance=OPS_TOLERANCE, rpc_tolerance=RPC_TOLERANCE):
+    """ Returns a list of messages describing every regression against `baseline` """
+    regressions = []
+    for size, cases in sorted(results.items()):
+        for name, stats in sorted(cases.items()):
+            base = baseline.get(size, {}).get(name)
+            if name.startswith('_') or not base:
+                continue
+            if stats['ops_per_sec'] < base['ops_per_sec'] * (1 - ops_tolerance):
+                regressions.append('%s@%s: %.1f ops/sec (baseline %.1f)' % (
+                    name, size, stats['ops_per_sec'], base['ops_per_sec']))
+            if stats['rpcs'] > base['rpcs'] * (1 + rpc_tolerance):
+                regressions.append('%s@%s: %.1f RPCs/call (baseline %.1f)' % (
+                    name, size, stats['rpcs'], base['rpcs']))
+    return regressions
+
+
+def printResults(results):
+    for size, cases in sorted(results.items(), key=lambda item: int(item[0])):
+        print '--- %s conferences / %s sessions (peak memory %d KB) ---' % (size, size, cases['_peak_memory_kb'])
+        print '%-35s %12s %10s %10s' % ('method', 'ops/sec', 'RPCs', 'read')
+        for name, stats in sorted(cases.items()):
+            if name.startswith('_'):
+                continue
+            print '%-35s %12.1f %10.1f %10.1f' % (name, stats['ops_per_sec'], stats['rpcs'], stats['entities_read'])
+        print
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the Conference API.')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma separated dataset sizes (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='calls per method (default: %(default)s)')
+    parser.add_argument('--baseline', help='baseline file to compare against (or write with --update)')
+    parser.add_argument('--update', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--cache-hits', action='store_true',
+                        help='compare cache-hit ratios of keys-only listings against full-entity queries')
+    parser.add_argument('--startup', action='store_true',
+                        help='measure the cold import time of the task handlers against the Endpoints API')
+    args = parser.parse_args(argv)
+
+    # suppress warnings during benchmark
+    logging.getLogger().setLevel(logging.ERROR)
+    if args.startup:
+        print '%-20s %12s %8s' % ('app', 'import (ms)', 'modules')
+        for app in STARTUP_APPS:
+            print '%-20s %12.1f %8d' % ((app,) + importCost(app, args.repeat))
+        return 0
+    if args.cache_hits:
+        for size, listings in sorted(runCacheHitBenchmarks([int(s) for s in args.sizes.split(',')]).items(),
+                                     key=lambda item: int(item[0])):
+            print '--- %s conferences / %s sessions: warm cache-hit ratio ---' % (size, size)
+            print '%-25s %10s %12s' % ('listing', 'keys-only', 'full-entity')
+            for name, ratios in sorted(listings.items()):
+                print '%-25s %9.0f%% %11.0f%%' % (name, ratios['keys_only'] * 100, ratios['full_entity'] * 100)
+            print
+        return 0
+    results = runBenchmarks([int(s) for s in args.sizes.split(',')], args.repeat)
+    printResults(results)
+
+    if args.baseline and args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            regressions = findRegressions(results, json.load(f))
+        for regression in regressions:
+            print 'REGRESSION: ' + regression
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,10 +1,22 @@
 import datetime
+import gzip
+import hashlib
+import json
+import os
 import pprint
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 import runner
+import endpoints
 from endpoints import UnauthorizedException, ForbiddenException, BadRequestException, get_current_user
 from base import BaseEndpointAPITestCase
 from utils import formToDict
+from google.appengine.api import datastore_errors
 from google.appengine.api import users
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
@@ -14,10 +26,12 @@ from protorpc import message_types
 from conference import (
     ConferenceApi,
     CONF_GET_REQUEST,
+    CONF_REGISTER_REQUEST,
     SESSION_POST_REQUEST,
     SESSION_BY_TYPE_GET_REQUEST,
     SESSION_BY_SPEAKER_GET_REQUEST,
     SESSION_WISHLIST_POST_REQUEST,
+    SESSION_QUERY_POST_REQUEST,
     MEMCACHE_ANNOUNCEMENTS_KEY,
     MEMCACHE_FEATURED_SPEAKER_KEY,
     CONF_POST_REQUEST,
@@ -28,12 +42,15 @@ from conference import (
 from models import (
     Profile,
     ProfileMiniForm,
+    BatchItemForm,
+    BatchRequestForm,
     ProfileForm,
     StringMessage,
     BooleanMessage,
     Conference,
     ConferenceForm,
     ConferenceForms,
+    ConferenceStats,
     ConferenceQueryForm,
     ConferenceQueryForms,
     TeeShirtSize,
@@ -43,9 +60,29 @@ from models import (
     SessionQueryForm,
     SessionQueryForms,
     ConflictException,
-    Speaker
+    MigrationState,
+    RegistrationEvent,
+    Speaker,
+    TrendingScores
 )
 import main
+import analytics
+import catalog
+import contention
+import deletion
+import export
+import hotcache
+import idempotency
+import metrics
+import migrations
+import outbox
+import profiler
+import ratelimit
+import recommendations
+import snapshot
+import tasks
+import trending
+import waitlist
 import webapp2
 
 
@@ -98,6 +135,36 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         assert len(r_sessions) == 1, 'returned an invalid number of sessions'
         assert r_sessions[0].name == 'Google App Engine', 'returned an invalid session'
 
+    def testListingsReadThroughCache(self):
+        """ TEST: Listing endpoints load entities by key, so warm requests don't read them from the datastore """
+        self.initDatabase()
+        self.login()
+        form = SessionQueryForms(filters=[
+            SessionQueryForm(field='TYPE_OF_SESSION', operator='NE', value='workshop'),
+            SessionQueryForm(field='START_TIME', operator='LT', value='19:00')
+        ])
+        listings = [
+            lambda: self.api.getConferencesCreated(message_types.VoidMessage()),
+            lambda: self.api.queryConferences(ConferenceQueryForms()),
+            lambda: self.api.querySessions(form),
+        ]
+        for listing in listings:
+            cold = listing()
+            # simulate a new request: empty context cache, warm memcache
+            ndb.get_context().clear_cache()
+            metrics.startRecording()
+            warm = listing()
+            counters = metrics.stopRecording()
+            assert len(warm.items) == len(cold.items) > 0, 'Returned an invalid number of items'
+            assert counters['entities_read'] == 0, 'Read %d entities from the datastore' % counters['entities_read']
+
+        # listings are never stale: they see writes made through the entity cache
+        conf = Conference.query(Conference.name == 'room #2').get()
+        conf.seatsAvailable = 0
+        conf.put()
+        r = self.api.queryConferences(ConferenceQueryForms())
+        assert [c.seatsAvailable for c in r.items if c.name == 'room #2'] == [0], 'Returned a stale conference'
+
     def testQueryConferences(self):
         self.initDatabase()
         form = ConferenceQueryForms()
@@ -108,7 +175,9 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         form.filters = [
             ConferenceQueryForm(field='CITY', operator='EQ', value='London')
         ]
-        r = self.api.queryConferences(form)
+        # one query plus one batched get for the organizers
+        with self.assertRpcBudget(datastore=3):
+            r = self.api.queryConferences(form)
         conferences = r.items
         assert len(conferences) == 1, 'Returned an invalid number of conferences'
         assert conferences[0].city == 'London', 'Returned an invalid conference'
@@ -118,6 +187,42 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         r = self.api.queryConferences(form)
         assert len(r.items) == Conference.query().count(), 'Returned an invalid number of conferences'
 
+    def testSearchConferences(self):
+        """ TEST: Any combination of conference filters is answered from the in-memory catalog """
+        self.initDatabase()
+
+        def search(*filters):
+            form = ConferenceQueryForms(filters=[ConferenceQueryForm(field=field, operator=operator, value=value)
+                                                 for field, operator, value in filters])
+            return [conf.name for conf in self.api.searchConferences(form).items]
+
+        # without a catalog the datastore is queried
+        assert search(('TOPIC', 'EQ', 'programming')) == ['room #1', 'room #3'], 'Returned invalid conferences'
+
+        catalog.rebuild()
+        small = (('TOPIC', 'EQ', 'programming'), ('MAX_ATTENDEES', 'LT', '50'), ('SEATS_AVAILABLE', 'GT', '1'))
+        assert search(*small) == ['room #3'], 'Returned invalid conferences'
+        assert search(('TOPIC', 'EQ', 'web performance'), ('CITY', 'NE', 'London')) == ['room #2'], \
+            'Returned invalid conferences'
+        assert search(('TOPIC', 'GTEQ', 'p'), ('SEATS_AVAILABLE', 'LTEQ', '6')) == ['room #2', 'room #3'], \
+            'Returned invalid conferences'
+        assert len(search()) == Conference.query().count(), 'Returned an invalid number of conferences'
+
+        # conferences that changed since the rebuild are checked again
+        conf = Conference.query(Conference.name == 'room #3').get()
+        conf.seatsAvailable = 1
+        conf.put()
+        assert search(*small) == [], 'Returned a conference that no longer matches'
+        conf.seatsAvailable = 6
+        conf.put()
+        # new conferences are found after the next rebuild
+        Conference(parent=conf.key.parent(), name='room #0', organizerUserId='test1@test.com',
+                   topics=['programming'], startDate=conf.startDate, endDate=conf.endDate,
+                   maxAttendees=10, seatsAvailable=10).put()
+        assert search(*small) == ['room #3'], 'Returned invalid conferences'
+        catalog.rebuild()
+        assert search(*small) == ['room #0', 'room #3'], 'Failed to rebuild the catalog'
+
     def testGetConferenceSessionsByType(self):
         """ TEST: Return all sessions of a specified type for a given conference"""
         self.initDatabase()
@@ -132,6 +237,37 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         assert len(r_sessions) == 1, 'returned an invalid number of sessions'
         assert r_sessions[0].typeOfSession == 'fun', 'returned an invalid session'
 
+    def testQueryConferenceSessions(self):
+        """ TEST: Any number of inequalities on a conference's sessions is answered from its snapshot"""
+        self.initDatabase()
+        conf = Conference.query(Conference.name == 'room #4').get()
+
+        def query(*filters):
+            container = SESSION_QUERY_POST_REQUEST.combined_message_class(
+                websafeConferenceKey=conf.key.urlsafe(),
+                filters=[SessionQueryForm(field=field, operator=operator, value=value)
+                         for field, operator, value in filters])
+            return sorted(session.name for session in self.api.queryConferenceSessions(container).items)
+
+        nonWorkshops = (('TYPE_OF_SESSION', 'NE', 'workshop'), ('START_TIME', 'LT', '19:00'),
+                        ('DURATION', 'LTEQ', '60'))
+        assert query(*nonWorkshops) == ['Google App Engine', 'Intro to Poker'], 'returned invalid sessions'
+        assert query(('NAME', 'GT', 'H'), ('SPEAKER', 'EQ', 'Bill Gates')) == ['My Workshop 1', 'My Workshop 2'], \
+            'returned invalid sessions'
+        assert query(('DATE', 'EQ', str(conf.startDate)), ('START_TIME', 'GT', '06:00'),
+                     ('START_TIME', 'LT', '10:00')) == ['Google App Engine', 'My Workshop 2'], 'returned invalid sessions'
+        assert query(('SPEAKER', 'EQ', 'nobody')) == [], 'returned invalid sessions'
+        assert memcache.get(conf.key.urlsafe(), namespace=snapshot.MEMCACHE_SNAPSHOT_NAMESPACE), \
+            'Failed to cache the snapshot'
+
+        # a new session rebuilds the snapshot
+        self.login(email='test2@test.com')
+        self.api.createSession(SESSION_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=conf.key.urlsafe(), name='Blackjack', speaker='joker', typeOfSession='fun',
+            date=str(conf.startDate), startTime='09:00', duration=30))
+        assert query(*nonWorkshops) == ['Blackjack', 'Google App Engine', 'Intro to Poker'], \
+            'Failed to rebuild the snapshot'
+
     def testGetSessionsBySpeaker(self):
         """ TEST: Return all sessions by a particular speaker"""
         self.initDatabase()
@@ -257,6 +393,11 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         assert len(r.items) == 1, "Returned an invalid number of sessions"
         assert r.items[0].websafeKey == session.key.urlsafe(), "Returned an invalid session"
 
+        # a deleted session that cleanup hasn't scrubbed from the wish list yet is skipped
+        session.key.delete()
+        r = self.api.getSessionsInWishlist(message_types.VoidMessage())
+        assert len(r.items) == 0, "Returned a deleted session"
+
     def testGetProfile(self):
         """ TEST: Get user's profile  """
         self.initDatabase()
@@ -283,6 +424,24 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         for websafeKey in r.conferenceKeysToAttend:
             assert websafeKey in websafeKeys, 'Returned an invalid key'
 
+    def testProfileContext(self):
+        """ TEST: Current user's Profile is created once and memoized per request """
+        self.initDatabase()
+        self.login(email='new@test.com')
+        assert ndb.Key(Profile, 'new@test.com').get() is None, \
+            "This shouldn't fail. Maybe someone messed with database fixture"
+
+        # first call creates the profile
+        r = self.api.getProfile(message_types.VoidMessage())
+        assert r.mainEmail == 'new@test.com', 'Returned an invalid user profile'
+        assert Profile.query().count() == 4, 'Failed to create profile for new user'
+
+        # later calls in the same request reuse the memoized key and cached entity
+        prof = self.api._getProfileFromUser()
+        assert prof is self.api._getProfileFromUser(), 'Profile was loaded more than once'
+        assert self.api._profileKeys == {'new@test.com': prof.key}, 'Failed to memoize profile key'
+        assert Profile.query().count() == 4, 'Returning user should not create another profile'
+
     def testCreateConference(self):
         """ TEST: Create new conference."""
         self.initDatabase()
@@ -325,6 +484,44 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
             'Failed to add conference to datastore'
         assert r.name == 'New Conference', 'Returned an invalid conference'
 
+    def testIdempotencyKeys(self):
+        """ TEST: Retries with an idempotency key return the first response instead of redoing the work """
+        self.initDatabase()
+        self.login()
+        today = str(datetime.date.today())
+        form = dict(name='Retried Conference', startDate=today, endDate=today, maxAttendees=10)
+        first = self.api.createConference(ConferenceForm(idempotencyKey='create-1', **form))
+        retry = self.api.createConference(ConferenceForm(idempotencyKey='create-1', **form))
+        assert retry.websafeKey == first.websafeKey, 'Returned a different conference'
+        # the datastore record answers when memcache lost the response
+        memcache.flush_all()
+        retry = self.api.createConference(ConferenceForm(idempotencyKey='create-1', **form))
+        assert retry.websafeKey == first.websafeKey, 'Returned a different conference'
+        assert Conference.query(Conference.name == 'Retried Conference').count() == 1, 'Created a duplicate'
+        assert len(self.taskqueue_stub.get_filtered_tasks(url=tasks.SEND_CONFIRMATION_EMAIL_URL)) == 1, \
+            'Queued a duplicate confirmation email'
+
+        # failed requests are not saved, and a request in progress holds its key
+        with self.assertRaises(BadRequestException):
+            self.api.createConference(ConferenceForm(idempotencyKey='create-2', name='Retried Conference'))
+        memcache.add('%s:createConference:create-3' % self.getUserId(), idempotency.PENDING,
+                     namespace=idempotency.MEMCACHE_IDEMPOTENCY_NAMESPACE)
+        with self.assertRaises(ConflictException):
+            self.api.createConference(ConferenceForm(idempotencyKey='create-3', **form))
+        self.api.createConference(ConferenceForm(idempotencyKey='create-2', **form))
+        assert Conference.query(Conference.name == 'Retried Conference').count() == 2, 'Failed to create'
+
+        # a retried registration succeeds instead of failing as already registered
+        self.login(email='test2@test.com')
+        container = CONF_REGISTER_REQUEST.combined_message_class(websafeConferenceKey=first.websafeKey,
+                                                                 idempotencyKey='register-1')
+        assert self.api.registerForConference(container).data, 'Failed to register'
+        assert self.api.registerForConference(container).data, 'Failed to return the saved response'
+        assert ndb.Key(urlsafe=first.websafeKey).get().seatsAvailable == 9, 'Registered twice'
+
+        assert idempotency.expire(now=datetime.datetime.utcnow() + datetime.timedelta(days=2)) == 3, \
+            'Failed to expire the saved responses'
+
     def testUpdateConference(self):
         """ TEST: Update conference w/provided fields & return w/updated info """
         self.initDatabase()
@@ -361,6 +558,97 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         r = self.api.getConference(container)
         assert r.websafeKey == conf.key.urlsafe(), 'Returned an invalid conference'
 
+    def testGetConferenceDetail(self):
+        """ TEST: Return a conference with its sessions and the user's state in one response """
+        self.initDatabase()
+        conf = Conference.query(Conference.name == 'room #1').get()
+        session = conf.sessions.get()
+        container = CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=conf.key.urlsafe())
+        memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, 'speaker: PHP, Python')
+
+        # signed-out visitors get the conference without registration state
+        r = self.api.getConferenceDetail(container)
+        assert r.conference.websafeKey == conf.key.urlsafe(), 'Returned an invalid conference'
+        assert r.conference.organizerDisplayName == 'Luiz', 'Returned an invalid organizer'
+        assert len(r.sessions) == conf.sessions.count(), 'Returned an invalid number of sessions'
+        assert not r.isAttending and not r.wishlistSessionKeys, 'Returned the state of a signed-out visitor'
+        assert r.featuredSpeaker == 'speaker: PHP, Python', 'Returned an invalid featured speaker'
+
+        self.login(email='test2@test.com')
+        self.api.registerForConference(container)
+        self.api.addSessionToWishlist(SESSION_WISHLIST_POST_REQUEST.combined_message_class(
+            websafeSessionKey=session.key.urlsafe()))
+        r = self.api.getConferenceDetail(container)
+        assert r.isAttending, 'Failed to return the registration'
+        assert r.wishlistSessionKeys == [session.key.urlsafe()], 'Failed to return the wishlist'
+
+        self.login()
+        self.api.deleteConference(container)
+        with self.assertRaises(endpoints.NotFoundException):
+            self.api.getConferenceDetail(container)
+
+    def testHotCache(self):
+        """ TEST: Popular conference forms are served from memory until the conference changes """
+        self.initDatabase()
+        self.login()
+        conf = Conference.query(ancestor=ndb.Key(Profile, self.getUserId())).get()
+        container = CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=conf.key.urlsafe())
+
+        self.api.getConference(container)
+        self.api.getConferenceSessions(container)
+        # a new request on the same instance only checks the conference's version
+        ndb.get_context().clear_cache()
+        with self.countRpcs(clear_cache=False) as counts:
+            r = self.api.getConference(container)
+            self.api.getConferenceSessions(container)
+        assert counts['datastore'] == 0, 'Read a cached conference from the datastore'
+        assert hotcache.CACHE.stats()['hits'] == 2, 'Failed to serve the forms from the hot cache'
+
+        # writes bump the version, so no instance serves the old form
+        self.login(email='test2@test.com')
+        self.api.registerForConference(container)
+        assert self.api.getConference(container).seatsAvailable == r.seatsAvailable - 1, 'Returned a stale conference'
+        assert hotcache.CACHE.stats()['stale'] == 1, 'Failed to detect a stale entry'
+        # registrations don't change the sessions, their form is still served from memory
+        self.api.getConferenceSessions(container)
+        assert hotcache.CACHE.stats()['hits'] == 3, 'Dropped the cached sessions on a registration'
+
+        # entries are evicted least recently used first, and expire after their TTL
+        cache = hotcache.LRUCache(maxSize=2, ttl=30)
+        cache.put('a', 1, 'A', now=100)
+        cache.put('b', 1, 'B', now=100)
+        assert cache.get('a', 1, now=110) == 'A', 'Failed to return a cached value'
+        cache.put('c', 1, 'C', now=110)
+        assert cache.get('b', 1, now=110) is None, 'Failed to evict the least recently used entry'
+        assert cache.get('a', 1, now=131) is None, 'Failed to expire an entry'
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['evictions'], stats['expirations']) == (1, 2, 1, 1), \
+            'Invalid cache counters: %s' % stats
+
+    def testLightweightTaskHandlers(self):
+        """ TEST: Importing the task and cron handlers doesn't load the Endpoints API """
+        script = 'import sys, runner, main; print "conference" in sys.modules'
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert output.split()[-1] == 'False', 'main.py imported conference.py'
+
+    def testWarmup(self):
+        """ TEST: The warmup request loads the most popular conferences into the hot cache """
+        self.initDatabase()
+        # deleted conferences are left out
+        deleted = Conference.query(Conference.name == 'room #4').get()
+        deleted.deleted = True
+        deleted.put()
+        response = webapp2.Request.blank('/_ah/warmup').get_response(main.app)
+        assert response.status_int == 200, 'Warmup failed'
+        count = Conference.query().count() - 1
+        assert hotcache.CACHE.stats()['size'] == 2 * count, 'Failed to prime the hot cache'
+
+        # the first user request is served from the hot cache
+        conf = Conference.query(Conference.name == 'room #1').get()
+        container = CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=conf.key.urlsafe())
+        self.api.getConference(container)
+        assert hotcache.CACHE.stats()['hits'] == 1, 'Failed to serve a primed conference'
+
     def testGetConferencesCreated(self):
         """ TEST: Return conferences created by user """
         self.initDatabase()
@@ -394,7 +682,9 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         prof.conferenceKeysToAttend.append(key)
         prof.put()
 
-        r = self.api.getConferencesToAttend(message_types.VoidMessage())
+        # profile, conferences and organizers are each fetched with a single batched get
+        with self.assertRpcBudget(datastore=3):
+            r = self.api.getConferencesToAttend(message_types.VoidMessage())
         assert len(r.items) == count + 1, 'Returned an invalid number of conferences'
         assert r.items[0].websafeKey == key.urlsafe(), 'Returned an invalid websafeKey'
 
@@ -479,6 +769,330 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         assert len(prof.conferenceKeysToAttend) == 0, "Failed to remove conference from user's conferenceKeysToAttend"
         assert conf.seatsAvailable == 2, 'Failed to increment available seats'
 
+    def testRecommendedConferences(self):
+        """ TEST: Conferences are ranked by similarity to the topics of the user's conferences """
+        self.initDatabase()
+        # the decoded model is kept in memory across requests (and tests)
+        recommendations._decoded.clear()
+        self.login()
+        void = message_types.VoidMessage()
+        assert len(self.api.getRecommendedConferences(void).items) == 0, 'Recommended conferences without a model'
+
+        recommendations.recompute(today=datetime.date(2015, 1, 1))
+        # room #2 is about web performance, which room #1 covers and often comes with programming (room #3)
+        prof = ndb.Key(Profile, self.getUserId()).get()
+        prof.conferenceKeysToAttend = [Conference.query(Conference.name == 'room #2').get().key]
+        prof.put()
+        r = self.api.getRecommendedConferences(void)
+        assert [conf.name for conf in r.items] == ['room #1', 'room #3'], 'Returned invalid recommendations'
+
+        # scores are a single product of the precomputed matrix and the user's topic counts
+        topics, matrix = recommendations.buildMatrix([['a', 'b'], ['b'], ['c']])
+        assert topics == ['a', 'b', 'c'] and matrix.shape == (3, 3), 'Built an invalid matrix'
+        scores = matrix.dot([1, 0, 0])
+        assert scores[0] > scores[1] > scores[2] == 0, 'Invalid scores: %s' % scores
+
+        # only the most frequent topics are kept, so the matrix fits in one entity
+        topics, matrix = recommendations.buildMatrix([['a', 'b'], ['b'], ['c', 'b'], ['c']], maxTopics=2)
+        assert topics == ['b', 'c'] and matrix.shape == (4, 2), 'Failed to cap the topics'
+
+    def testTrendingConferences(self):
+        """ TEST: Conferences are ranked by their decayed registration velocity """
+        self.initDatabase()
+        void = message_types.VoidMessage()
+        assert len(self.api.getTrendingConferences(void).items) == 0, 'Returned trending conferences without data'
+
+        room1 = Conference.query(Conference.name == 'room #1').get()
+        room3 = Conference.query(Conference.name == 'room #3').get()
+        for email, conf in (('test1@test.com', room1), ('test2@test.com', room3), ('test3@test.com', room3)):
+            self.login(email=email)
+            self.api.registerForConference(CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=conf.key.urlsafe()))
+        # the current minute is folded once it's complete
+        trending.flush(now=time.time() + 60)
+        r = self.api.getTrendingConferences(void)
+        assert [conf.name for conf in r.items] == ['room #3', 'room #1'], 'Returned invalid trending conferences'
+
+        # older registrations weigh less: 2 registrations 100 minutes ago < 1 registration now
+        start = time.time() + 3600
+        for i in range(2):
+            trending.record(room1.key, now=start)
+        trending.flush(now=start + 60)
+        trending.record(room3.key, now=start + 6000)
+        state = trending.flush(now=start + 6060)
+        assert state.scores[room1.key.urlsafe()] < state.scores[room3.key.urlsafe()], 'Failed to decay scores'
+
+    def testConferenceStats(self):
+        """ TEST: Registrations are logged and rolled up into the organizer's daily stats """
+        self.initDatabase()
+        conf = Conference.query(Conference.name == 'room #1').get()
+        container = CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=conf.key.urlsafe())
+        for email in ('test2@test.com', 'test3@test.com'):
+            self.login(email=email)
+            self.api.registerForConference(container)
+        self.api.unregisterFromConference(container)
+        assert RegistrationEvent.query(ancestor=conf.key).count() == 3, 'Failed to log the registrations'
+
+        assert analytics.rollup() == 3, 'Failed to roll up the events'
+        assert RegistrationEvent.query(ancestor=conf.key).count() == 0, 'Failed to delete rolled up events'
+        # only the organizer sees the stats
+        with self.assertRaises(ForbiddenException):
+            self.api.getConferenceStats(container)
+        self.login()
+        with self.assertRaises(endpoints.NotFoundException):
+            self.api.getConferenceStats(CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=ndb.Key(Conference, 999999, parent=conf.key.parent()).urlsafe()))
+        r = self.api.getConferenceStats(container)
+        assert r.attendees == 1 and len(r.days) == 1, 'Returned invalid stats'
+        day = r.days[0]
+        assert (day.registrations, day.cancellations, day.attendees) == (2, 1, 1), 'Returned an invalid day'
+        assert day.fillRate == 1.0 / conf.maxAttendees, 'Returned an invalid fill rate'
+
+    def testWaitlist(self):
+        """ TEST: Waiters of a sold-out conference are registered in order when seats free up """
+        self.initDatabase()
+        conf = Conference.query(Conference.name == 'room #2').get()
+        container = CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=conf.key.urlsafe())
+
+        # only sold-out conferences have a waitlist
+        self.login(email='test2@test.com')
+        with self.assertRaises(ConflictException):
+            self.api.joinWaitlist(container)
+        self.login()
+        self.api.registerForConference(container)
+        assert conf.key.get().seatsAvailable == 0, "This shouldn't fail. Maybe someone messed with database fixture"
+
+        self.login(email='test2@test.com')
+        assert self.api.joinWaitlist(container).position == 1, 'Returned an invalid position'
+        # joining again keeps the first place
+        assert self.api.joinWaitlist(container).position == 1, 'Failed to keep the waiter in place'
+        self.login(email='test3@test.com')
+        assert self.api.joinWaitlist(container).position == 2, 'Returned an invalid position'
+        self.login()
+        assert self.api.getWaitlistPosition(container).position == 0, 'Returned a position for a non-waiter'
+
+        # unregistering hands the seat to the first waiter
+        self.api.unregisterFromConference(container)
+        # the freed seat can't be taken directly while users are waiting, but the waitlist can be joined
+        with self.assertRaises(ConflictException):
+            self.api.registerForConference(container)
+        assert self.api.joinWaitlist(container).position == 3, 'Failed to join a waitlist with a free seat'
+        assert self.runTasks(main.app, url=tasks.PROMOTE_WAITLIST_URL) == 1, 'Failed to enqueue the promotion'
+        assert conf.key in ndb.Key(Profile, 'test2@test.com').get().conferenceKeysToAttend, \
+            'Failed to register the first waiter'
+        assert conf.key.get().seatsAvailable == 0, 'Failed to take the seat'
+        self.login(email='test3@test.com')
+        assert self.api.getWaitlistPosition(container).position == 1, 'Failed to move the waitlist forward'
+        self.login(email='test2@test.com')
+        assert self.api.getWaitlistPosition(container).position == 0, 'Promoted waiter is still waiting'
+
+    def testBatch(self):
+        """ TEST: Read-only calls are run in one request, in order, and fail one by one """
+        self.initDatabase()
+        self.login()
+        conf = Conference.query(Conference.name == 'room #1').get()
+        params = json.dumps({'websafeConferenceKey': conf.key.urlsafe()})
+        missing = json.dumps({'websafeConferenceKey': ndb.Key(Conference, 999999, parent=conf.key.parent()).urlsafe()})
+        items = [
+            BatchItemForm(method='getConference', params=params),
+            BatchItemForm(method='getConferenceSessions', params=params),
+            BatchItemForm(method='getProfile'),
+            BatchItemForm(method='getConference', params=missing),
+            BatchItemForm(method='getConference', params='{"websafeConferenceKey": "garbage"}'),
+            BatchItemForm(method='getConference', params='not json'),
+            BatchItemForm(method='registerForConference', params=params),
+        ]
+        r = self.api.batch(BatchRequestForm(items=items))
+        assert [item.status for item in r.items] == [200, 200, 200, 404, 400, 400, 400], 'Returned invalid statuses'
+        assert json.loads(r.items[0].result)['websafeKey'] == conf.key.urlsafe(), 'Returned an invalid conference'
+        assert len(json.loads(r.items[1].result)['items']) == conf.sessions.count(), 'Returned invalid sessions'
+        assert json.loads(r.items[2].result)['mainEmail'] == 'test1@test.com', 'Returned an invalid profile'
+        assert r.items[3].error and not r.items[3].result, 'Failed to return the error'
+        assert conf.key not in ndb.Key(Profile, 'test1@test.com').get().conferenceKeysToAttend, \
+            'Ran a write method in a batch'
+
+        # batches over the size or cost limits are rejected as a whole
+        with self.assertRaises(BadRequestException):
+            self.api.batch(BatchRequestForm(items=[BatchItemForm(method='getProfile')] * 21))
+        with self.assertRaises(BadRequestException):
+            self.api.batch(BatchRequestForm(items=[BatchItemForm(method='querySessions')] * 9))
+
+    def testRateLimit(self):
+        """ TEST: Calls over a user's per-class rate limit are rejected with a retry-after """
+        self.initDatabase()
+        self.login()
+        limits = dict(ratelimit.RATE_LIMITS)
+        ratelimit.RATE_LIMITS['read'] = (3, 60)
+        try:
+            void = message_types.VoidMessage()
+            for i in range(3):
+                self.api.getConferencesCreated(void)
+            with self.assertRaises(ratelimit.TooManyRequestsException) as cm:
+                self.api.getConferencesCreated(void)
+            assert 0 < cm.exception.retryAfter <= 60, 'Invalid retry-after: %s' % cm.exception.retryAfter
+            assert cm.exception.retryAfter <= cm.exception.refillAfter <= 120, 'Invalid refill: %s' % cm.exception.refillAfter
+            assert 'refills in %d seconds' % cm.exception.refillAfter in cm.exception.message, 'Refill missing from message'
+            # other method classes and other users have their own buckets
+            self.api.saveProfile(ProfileMiniForm(displayName='Luiz'))
+            self.login(email='test2@test.com')
+            self.api.getConferencesCreated(void)
+        finally:
+            ratelimit.RATE_LIMITS.update(limits)
+
+        # the previous slice is weighted by how much of it is still in the sliding window
+        ratelimit.RATE_LIMITS['write'] = (4, 60)
+        try:
+            for now in (6000, 6000, 6000, 6000, 6090, 6090):
+                assert ratelimit.consume('write', 'test3@test.com', now=now) == 0, 'Throttled a call within limit'
+            # 3 calls in this slice plus half of the 4 in the previous one
+            assert ratelimit.consume('write', 'test3@test.com', now=6090) == 15, 'Invalid retry-after'
+            assert ratelimit.consume('write', 'test3@test.com', now=6200) == 0, 'Failed to refill the bucket'
+        finally:
+            ratelimit.RATE_LIMITS.update(limits)
+
+    def testDeleteConference(self):
+        """ TEST: Delete conference, its sessions and every reference to them in chained batches """
+        self.initDatabase()
+        conf = Conference.query(Conference.name == 'room #4').get()
+        sessionKeys = conf.sessions.fetch(keys_only=True)
+        assert len(sessionKeys) == 4, "This shouldn't fail. Maybe someone messed with database fixture"
+        # test1@test.com attends the conference and has one of its sessions in their wish list
+        prof = ndb.Key(Profile, 'test1@test.com').get()
+        prof.conferenceKeysToAttend.append(conf.key)
+        prof.wishList = sessionKeys[:1] + Session.query(Session.name == 'PHP').fetch(keys_only=True)
+        prof.put()
+        # registration events and stats, a waitlist and a trending score are cleaned up too
+        analytics.registrationEvent(conf.key, 1).put()
+        ConferenceStats(key=analytics.statsKey(conf.key), days={}).put()
+        waitlist.join(conf.key, 'test3@test.com')
+        TrendingScores(key=trending.SCORES_KEY, scores={conf.key.urlsafe(): 1.0}, top=[conf.key.urlsafe()],
+                       flushedMinute=0).put()
+        container = CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=conf.key.urlsafe())
+
+        # only the owner may delete the conference
+        self.login()
+        try:
+            self.api.deleteConference(container)
+            assert False, 'ForbiddenException should of been thrown...'
+        except ForbiddenException:
+            pass
+
+        self.login(email='test2@test.com')
+        r = self.api.deleteConference(container)
+        assert r.data, 'Returned an invalid response'
+        # a repeated delete restarts the cleanup, and the pending task becomes stale
+        assert self.api.deleteConference(container).data, 'Returned an invalid response'
+        # the conference is hidden right away
+        assert conf.key.urlsafe() not in [c.websafeKey for c in self.api.queryConferences(ConferenceQueryForms()).items]
+        try:
+            self.api.getConference(container)
+            assert False, 'NotFoundException should of been thrown...'
+        except endpoints.NotFoundException:
+            pass
+
+        # run the cleanup with small batches so it chains several tasks
+        sessionBatchSize, deletion.SESSION_BATCH_SIZE = deletion.SESSION_BATCH_SIZE, 3
+        try:
+            count = self.runTasks(main.app, url='/tasks/delete_conference')
+        finally:
+            deletion.SESSION_BATCH_SIZE = sessionBatchSize
+        assert count == 7, 'Expected 1 stale task, 2 session batches, then 1 profile, descendant, waitlist ' \
+                           'and conference batch'
+
+        assert conf.key.get() is None, 'Failed to delete conference'
+        assert Session.query(ancestor=conf.key).count() == 0, 'Failed to delete sessions'
+        assert ndb.Query(ancestor=conf.key).fetch(keys_only=True) == [deletion.progressKey(conf.key)], \
+            'Failed to delete the descendants'
+        assert not ndb.Query(ancestor=waitlist.waitlistKey(conf.key)).fetch(keys_only=True), 'Failed to delete waitlist'
+        assert trending.top() == [], 'Failed to drop the trending score'
+        prof = prof.key.get()
+        assert conf.key not in prof.conferenceKeysToAttend, 'Failed to scrub conferenceKeysToAttend'
+        assert len(prof.wishList) == 1 and prof.wishList[0] not in sessionKeys, 'Failed to scrub wish list'
+        progress = deletion.progressKey(conf.key).get()
+        assert progress.stage == 'done' and progress.sessionsDeleted == 4 and progress.profilesScrubbed == 1, \
+            'Invalid cleanup progress'
+
+        # the cleanup is idempotent: running a finished one again does nothing
+        assert deletion.processBatch(conf.key, progress.batch) is None
+
+    def testSchemaMigration(self):
+        """ TEST: Migrations run in chained batches and can be paused and resumed """
+        self.initDatabase()
+        # the fixture conferences were created without `month`
+        assert Conference.query(Conference.month > 0).count() == 0, \
+            "This shouldn't fail. Maybe someone messed with database fixture"
+
+        # migrations of a kind run in version order
+        try:
+            migrations.start('backfillConferenceDeleted')
+            assert False, 'MigrationError should of been thrown...'
+        except migrations.MigrationError:
+            pass
+
+        # start with batches of 1 conference, then pause after the first batch
+        migrations.start('backfillConferenceMonth', batchSize=1)
+        queued = self.taskqueue_stub.get_filtered_tasks(url='/tasks/migrate')
+        assert len(queued) == 1, 'Failed to enqueue the first batch'
+        state = migrations.runBatch('backfillConferenceMonth', 0)
+        assert state.batch == 1 and state.processed == 1 and state.changed == 1, 'Invalid checkpoint'
+        migrations.pause('backfillConferenceMonth')
+
+        # the batches left in the queue are dropped while paused, a stale batch is always dropped
+        self.taskqueue_stub.FlushQueue('default')
+        assert migrations.runBatch('backfillConferenceMonth', 1) is None, 'Ran a batch of a paused migration'
+        migrations.resume('backfillConferenceMonth', batchSize=2)
+        assert migrations.runBatch('backfillConferenceMonth', 1) is None, 'Ran a stale batch'
+
+        # run the remaining batches from the checkpoint
+        self.runTasks(main.app, url='/tasks/migrate')
+        state = ndb.Key(MigrationState, 'backfillConferenceMonth').get()
+        assert state.status == 'done' and state.processed == 4 and state.changed == 4, 'Invalid checkpoint'
+        for conf in Conference.query():
+            assert conf.month == conf.startDate.month, 'Failed to migrate conference'
+
+        # the next version can run now, and a finished migration can't be restarted
+        migrations.start('backfillConferenceDeleted')
+        self.runTasks(main.app, url='/tasks/migrate')
+        assert Conference.query(Conference.deleted == False).count() == 4, 'Failed to migrate conference'
+        try:
+            migrations.start('backfillConferenceMonth')
+            assert False, 'MigrationError should of been thrown...'
+        except migrations.MigrationError:
+            pass
+
+    def testExport(self):
+        """ TEST: Export conferences, sessions and profiles to JSONL with a manifest """
+        self.initDatabase()
+        root = tempfile.mkdtemp()
+        settings = export.EXPORT_LOCAL_ROOT, export.EXPORT_BATCH_SIZE
+        # export to a temporary directory in batches of 2 so shards chain several parts
+        export.EXPORT_LOCAL_ROOT, export.EXPORT_BATCH_SIZE = root, 2
+        try:
+            export.start('test-export', shards=2, sink='local', compress=True)
+            self.runTasks(main.app, url='/tasks/export')
+
+            job = ndb.Key(export.ExportJob, 'test-export').get()
+            assert job.status == 'done' and job.pendingShards == 0, 'Export did not finish'
+            with open(os.path.join(root, job.manifestPath)) as f:
+                manifest = json.load(f)
+            expected = {'Conference': 4, 'Session': 6, 'Profile': 3}
+            for kind, count in expected.items():
+                assert manifest['kinds'][kind]['count'] == count, 'Invalid %s count in manifest' % kind
+
+                keys = set()
+                for part in manifest['kinds'][kind]['parts']:
+                    with open(os.path.join(root, part['path']), 'rb') as f:
+                        data = f.read()
+                    assert hashlib.md5(data).hexdigest() == part['md5'], 'Invalid checksum in manifest'
+                    lines = gzip.GzipFile(fileobj=StringIO.StringIO(data)).read().splitlines()
+                    assert len(lines) == part['count'], 'Invalid part count in manifest'
+                    keys.update(json.loads(line)['websafeKey'] for line in lines)
+                # every entity is exported exactly once
+                assert len(keys) == count, 'Exported an invalid set of %s entities' % kind
+        finally:
+            export.EXPORT_LOCAL_ROOT, export.EXPORT_BATCH_SIZE = settings
+            shutil.rmtree(root)
+
     def testSaveProfile(self):
         self.initDatabase()
         self.login()
@@ -552,11 +1166,46 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         request.method = tasks[0].method
         response = request.get_response(main.app)
         assert response.status_int == 200, 'Invalid response expected 200 but got %d' % response.status_int
-        # verify email was sent
+        # the email waits in the outbox until it is drained
         prof = ndb.Key(Profile, self.getUserId()).get()
+        assert len(self.mail_stub.get_sent_messages(to=prof.mainEmail)) == 0, 'Email should wait in the outbox'
+        response = webapp2.Request.blank('/crons/drain_outbox').get_response(main.app)
+        assert response.status_int == 204, 'Invalid response expected 204 but got %d' % response.status_int
+        # verify email was sent
         messages = self.mail_stub.get_sent_messages(to=prof.mainEmail)
         assert len(messages) == 1, 'Failed to send confirmation email'
 
+    def testMailOutbox(self):
+        """ TEST: Outbox dedupes, merges emails per recipient and drains in rate-limited batches """
+        self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.initDatabase()
+        # 3 conferences by test1@test.com, 1 by test2@test.com, the first one queued twice
+        conferences = Conference.query().order(Conference.name).fetch()
+        for conf in conferences + conferences[:1]:
+            outbox.queueConfirmation(conf, conf.key.parent().get())
+        assert outbox.stats()['depth'] == 4, 'Failed to dedupe outbox entries'
+
+        # one email per drain: test1@test.com gets a single digest for their 3 conferences
+        assert outbox.drain(batch_size=1) == 1, 'Drain exceeded its batch size'
+        messages = self.mail_stub.get_sent_messages(to='test1@test.com')
+        assert len(messages) == 1 and '3 new Conferences' in messages[0].subject, 'Failed to send digest'
+        assert len(self.mail_stub.get_sent_messages(to='test2@test.com')) == 0, 'Drain exceeded its batch size'
+        stats = outbox.stats()
+        assert stats['depth'] == 1 and stats['sent'] == 1 and stats['entries'] == 3, 'Returned invalid stats'
+
+        # the next drain sends the remaining email
+        assert outbox.drain() == 1
+        assert len(self.mail_stub.get_sent_messages(to='test2@test.com')) == 1, 'Failed to send email'
+        assert outbox.stats()['depth'] == 0, 'Failed to empty the outbox'
+        # a retried confirmation finds its sent entry and isn't sent again
+        outbox.queueConfirmation(conferences[0], conferences[0].key.parent().get())
+        assert outbox.drain() == 0, 'Sent a confirmation twice'
+        assert len(self.mail_stub.get_sent_messages(to='test1@test.com')) == 1, 'Sent a confirmation twice'
+
+        # the admin handler reports the stats
+        response = webapp2.Request.blank('/admin/outbox').get_response(main.app)
+        assert 'depth: 0' in response.body, 'Returned invalid stats'
+
     def testGetFeaturedSpeaker(self):
         """ TEST: Returns the featured speakers and their registered sessions from memcache. """
         self.initDatabase()
@@ -596,8 +1245,9 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
         count = Session.query().count()
         assert count == initial_count + 2, 'Failed to add sessions to conference...'
 
+        # both sessions have the same speaker, so their featured speaker tasks are coalesced
         tasks = self.taskqueue_stub.get_filtered_tasks()
-        assert len(tasks) == 2, 'No tasks were added to queue'
+        assert len(tasks) == 1, 'Expected a single coalesced featured speaker task'
         for task in tasks:
             request = webapp2.Request.blank(task.url + '?' + task.payload)
             request.method = task.method
@@ -616,6 +1266,191 @@ class ConferenceTestCase(BaseEndpointAPITestCase):
                'PHP' in data and \
                'Python' in data, 'Returned an invalid featured speaker'
 
+    def testRpcBudgetStaysFlat(self):
+        """ TEST: Listing endpoints make the same number of round trips as the fixture grows """
+        self.initDatabase()
+        self.login()
+        prof = ndb.Key(Profile, self.getUserId()).get()
+        conferences = Conference.query().fetch()
+        void = message_types.VoidMessage()
+
+        # registered to one conference vs. all of them
+        prof.conferenceKeysToAttend = [conferences[0].key]
+        prof.put()
+        with self.countRpcs() as small:
+            self.api.getConferencesToAttend(void)
+        prof.conferenceKeysToAttend = [conf.key for conf in conferences]
+        prof.put()
+        with self.countRpcs() as large:
+            r = self.api.getConferencesToAttend(void)
+        assert len(r.items) == len(conferences), 'Returned an invalid number of conferences'
+        assert small == large, 'getConferencesToAttend RPCs grew with the fixture: %s -> %s' % (small, large)
+
+        # the same holds for the session wish list
+        sessions = Session.query().fetch()
+        prof.wishList = [sessions[0].key]
+        prof.put()
+        with self.countRpcs() as small:
+            self.api.getSessionsInWishlist(void)
+        prof.wishList = [session.key for session in sessions]
+        prof.put()
+        with self.countRpcs() as large:
+            self.api.getSessionsInWishlist(void)
+        assert small == large, 'getSessionsInWishlist RPCs grew with the fixture: %s -> %s' % (small, large)
+
+        # and for queries, where organizer names are fetched in one batch
+        form = ConferenceQueryForms()
+        with self.countRpcs() as small:
+            self.api.queryConferences(form)
+        ndb.put_multi([Conference(parent=ndb.Key(Profile, email), name='extra %d' % i, organizerUserId=email,
+                                  startDate=datetime.date(2015, 9, 1), endDate=datetime.date(2015, 9, 2))
+                       for i in range(5) for email in ('test2@test.com', 'test3@test.com')])
+        with self.countRpcs() as large:
+            r = self.api.queryConferences(form)
+        assert len(r.items) == len(conferences) + 10, 'Returned an invalid number of conferences'
+        assert small == large, 'queryConferences RPCs grew with the fixture: %s -> %s' % (small, large)
+
+    def testMetricsMiddleware(self):
+        """ TEST: Record per-endpoint latency and RPC counts and report them """
+        self.initDatabase()
+        app = metrics.metrics_wsgi_middleware(main.app)
+
+        # run the announcement cron twice through the middleware
+        for i in range(2):
+            response = webapp2.Request.blank('/crons/set_announcement').get_response(app)
+            assert response.status_int == 204, 'Invalid response expected 204 but got %d' % response.status_int
+
+        report = metrics.getReport(['/crons/set_announcement', '/tasks/set_featured_speaker'])
+        assert '/tasks/set_featured_speaker' not in report, 'Reported an endpoint that was never called'
+        for window in metrics.METRICS_WINDOWS:
+            stats = report['/crons/set_announcement'][window]
+            assert stats['calls'] == 2, 'Recorded an invalid number of calls'
+            assert stats['datastore_rpcs'] >= 1 and stats['entities_read'] >= 1, 'Failed to count datastore RPCs'
+            assert stats['memcache_rpcs'] >= 1, 'Failed to count memcache RPCs'
+            assert stats['p50'] is None or stats['p50'] in metrics.LATENCY_BUCKETS
+
+        # histogram percentiles use the upper bound of each bucket
+        histogram = [0] * (len(metrics.LATENCY_BUCKETS) + 1)
+        histogram[0], histogram[3], histogram[-1] = 50, 45, 5
+        assert metrics.percentile(histogram, 50) == metrics.LATENCY_BUCKETS[0]
+        assert metrics.percentile(histogram, 95) == metrics.LATENCY_BUCKETS[3]
+        assert metrics.percentile(histogram, 99) is None
+
+        # the admin report lists the recorded endpoint
+        response = webapp2.Request.blank('/admin/metrics').get_response(main.app)
+        assert response.status_int == 200, 'Invalid response expected 200 but got %d' % response.status_int
+        assert '/crons/set_announcement' in response.body, 'Report is missing an endpoint'
+
+    def testTransactionContention(self):
+        """ TEST: Collided transactions are retried with backoff, counted, and reported with their entity group """
+        self.initDatabase()
+        conf = Conference.query().get()
+        collisions = []
+
+        @contention.transactional(group=lambda key, collide: key)
+        def contendedWrite(key, collide):
+            if len(collisions) < collide:
+                collisions.append(key)
+                raise datastore_errors.TransactionFailedError('collided')
+            entity = key.get()
+            entity.put()
+            return entity
+
+        original = dict(contention.TRANSACTION_RETRIES)
+        contention.TRANSACTION_RETRIES['contendedWrite'] = (2, 0.001, 0.002)
+        try:
+            # two collisions are retried, a third exhausts the retries
+            assert contendedWrite(conf.key, 2).key == conf.key, 'Failed to retry the transaction'
+            del collisions[:]
+            with self.assertRaises(datastore_errors.TransactionFailedError):
+                contendedWrite(conf.key, 3)
+            del collisions[:]
+            contendedWrite(conf.key, 0)
+        finally:
+            contention.TRANSACTION_RETRIES.clear()
+            contention.TRANSACTION_RETRIES.update(original)
+
+        stats, groups = contention.getReport(['contendedWrite'])
+        stats = stats['contendedWrite']
+        assert stats['calls'] == 3 and stats['attempts'] == 7, 'Recorded invalid attempts: %s' % stats
+        assert stats['collisions'] == 5 and stats['retried'] == 2 and stats['failures'] == 1, \
+            'Recorded invalid collisions: %s' % stats
+        # collisions count against the root of the entity group
+        assert groups == [(5, 'contendedWrite', conf.key.parent().urlsafe())], 'Returned invalid groups: %s' % groups
+
+        response = webapp2.Request.blank('/admin/contention').get_response(main.app)
+        assert response.status_int == 200, 'Invalid response expected 200 but got %d' % response.status_int
+        assert 'contendedWrite' in response.body, 'Report is missing a method'
+
+    def testSamplingProfiler(self):
+        """ TEST: Sampled and admin-requested requests are profiled and their top functions reported """
+        self.initDatabase()
+        app = profiler.profiler_wsgi_middleware(main.app)
+
+        # profiling is off by default, and the header is ignored for other users
+        request = webapp2.Request.blank('/crons/set_announcement', headers={'X-Profile-Request': '1'})
+        request.get_response(app)
+        assert not profiler.getReport(['/crons/set_announcement']), 'Profiled an unsampled request'
+
+        profiler.PROFILE_SAMPLE_RATES['/crons/set_announcement'] = 1
+        try:
+            for i in range(2):
+                response = webapp2.Request.blank('/crons/set_announcement').get_response(app)
+                assert response.status_int == 204, 'Invalid response expected 204 but got %d' % response.status_int
+        finally:
+            del profiler.PROFILE_SAMPLE_RATES['/crons/set_announcement']
+        self.login(is_admin=True)
+        request = webapp2.Request.blank('/admin/outbox', headers={'X-Profile-Request': '1'})
+        request.get_response(app)
+
+        report = profiler.getReport(['/crons/set_announcement', '/admin/outbox'])
+        profiles, rows = report['/crons/set_announcement']
+        assert profiles == 2, 'Stored an invalid number of profiles'
+        assert [row[4] for row in rows] == sorted([row[4] for row in rows], reverse=True), 'Rows are not sorted'
+        assert any('main.py' in row[0] for row in rows), 'Profile is missing the handler'
+        assert report['/admin/outbox'][0] == 1, 'Failed to profile the admin request'
+
+        response = webapp2.Request.blank('/admin/profiles?sort=tottime').get_response(main.app)
+        assert response.status_int == 200, 'Invalid response expected 200 but got %d' % response.status_int
+        assert '/crons/set_announcement' in response.body, 'Report is missing an endpoint'
+
+    def testTaskBuffer(self):
+        """ TEST: Buffered tasks are enqueued in batches and named tasks are coalesced """
+        self.initDatabase()
+        conf = Conference.query().get()
+
+        # identical featured speaker tasks are coalesced, in the buffer and across flushes
+        tasks.add(tasks.featuredSpeakerTask(conf.key, 'superman', now=0))
+        tasks.add(tasks.featuredSpeakerTask(conf.key, 'superman', now=1))
+        tasks.add(tasks.featuredSpeakerTask(conf.key, 'flash', now=1))
+        tasks.flush()
+        tasks.add(tasks.featuredSpeakerTask(conf.key, 'superman', now=2))
+        tasks.flush()
+        assert len(self.taskqueue_stub.get_filtered_tasks()) == 2, 'Failed to coalesce featured speaker tasks'
+
+        # more tasks than a single add accepts are split into several batches
+        for i in range(tasks.MAX_TASKS_PER_ADD + 1):
+            tasks.add(tasks.confirmationEmailTask(conf.key))
+        tasks.flush()
+        queued = self.taskqueue_stub.get_filtered_tasks(url=tasks.SEND_CONFIRMATION_EMAIL_URL)
+        assert len(queued) == tasks.MAX_TASKS_PER_ADD + 1, 'Failed to enqueue every buffered task'
+        # the payload is the conference key, not a dump of the form
+        assert queued[0].payload == 'websafeConferenceKey=' + conf.key.urlsafe(), 'Invalid task payload'
+
+        # tasks buffered by a failing endpoint method are discarded
+        @tasks.flushTasks
+        def failing():
+            tasks.add(tasks.confirmationEmailTask(conf.key))
+            raise ValueError()
+        try:
+            failing()
+            assert False, 'ValueError should of been thrown...'
+        except ValueError:
+            pass
+        tasks.flush()
+        assert len(self.taskqueue_stub.get_filtered_tasks(url=tasks.SEND_CONFIRMATION_EMAIL_URL)) == \
+            tasks.MAX_TASKS_PER_ADD + 1, 'Enqueued a task from a failed request'
+
     def testTask3QueryProblem(self):
         """ TEST: Solve task 3 "the query related problem"  """
         # init and verify database fixture
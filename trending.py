@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""
+trending.py -- Trending conferences from registration velocity
+
+Every registration increments a per-minute counter of its conference in
+memcache. Counters are sharded, so a conference selling out doesn't turn
+into a single hot key:
+
+    <minute>:<shard>:<websafe conference key>
+
+The first registration of a conference in a minute and shard also adds
+the conference to that minute's list of touched conferences. That is
+how the flush finds the counters to read.
+
+The flush cron runs every minute and folds the complete minutes into
+exponentially decayed scores (half-life TRENDING_HALF_LIFE), persisted in
+one `TrendingScores` entity. The decayed score stands in for per-hour
+buckets: old registrations keep counting, but less and less. The top
+conferences are kept with `heapq` and cached in memcache, so
+`getTrendingConferences` never queries `Conference`.
+
+"""
+
+import heapq
+import math
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import TrendingScores
+
+MEMCACHE_TRENDING_NAMESPACE = 'TRENDING'
+MEMCACHE_TRENDING_TOP_KEY = 'top'
+SCORES_KEY = ndb.Key(TrendingScores, 'latest')
+TRENDING_SHARDS = 4
+# a registration is worth half as much after this many seconds
+TRENDING_HALF_LIFE = 3600
+# minutes folded by a single flush; older counters are dropped
+MAX_FLUSH_MINUTES = 60
+# seconds the per-minute counters are kept in memcache, past the last flush that can read them
+COUNTER_TTL = (MAX_FLUSH_MINUTES + 5) * 60
+# conferences whose scores are kept, and scores below which they are dropped
+TRENDING_MAX_TRACKED = 1000
+TRENDING_MIN_SCORE = 0.01
+# conferences returned by `top()`
+TRENDING_TOP_K = 10
+
+
+def _minute(now=None):
+    return int((now or time.time()) // 60)
+
+
+def _counterKey(minute, shard, websafeKey):
+    return '%d:%d:%s' % (minute, shard, websafeKey)
+
+
+def _touchedKey(minute, shard, n=None):
+    key = 'touched:%d:%d' % (minute, shard)
+    return key if n is None else '%s:%d' % (key, n)
+
+
+def record(conf_key, now=None):
+    """Count a registration to `conf_key`."""
+    minute, shard, websafeKey = _minute(now), random.randint(0, TRENDING_SHARDS - 1), conf_key.urlsafe()
+    key = _counterKey(minute, shard, websafeKey)
+    # `incr` can't set an expiry, so the counters are created with one first
+    memcache.add_multi({key: 0, _touchedKey(minute, shard): 0}, time=COUNTER_TTL,
+                       namespace=MEMCACHE_TRENDING_NAMESPACE)
+    counts = memcache.offset_multi({key: 1}, namespace=MEMCACHE_TRENDING_NAMESPACE, initial_value=0)
+    if counts.get(key) == 1:
+        # first registration of this conference in this minute & shard
+        n = memcache.incr(_touchedKey(minute, shard), namespace=MEMCACHE_TRENDING_NAMESPACE, initial_value=0)
+        if n:
+            memcache.set(_touchedKey(minute, shard, n), websafeKey, time=COUNTER_TTL,
+                         namespace=MEMCACHE_TRENDING_NAMESPACE)
+
+
+def _readMinutes(minutes):
+    """Return {websafe key: {minute: registrations}} for the given minutes."""
+    buckets = [(minute, shard) for minute in minutes for shard in range(TRENDING_SHARDS)]
+    touched = memcache.get_multi([_touchedKey(*bucket) for bucket in buckets],
+                                 namespace=MEMCACHE_TRENDING_NAMESPACE)
+    entries = [bucket + (n,) for bucket in buckets for n in range(1, int(touched.get(_touchedKey(*bucket), 0)) + 1)]
+    websafeKeys = memcache.get_multi([_touchedKey(*entry) for entry in entries],
+                                     namespace=MEMCACHE_TRENDING_NAMESPACE)
+    counters = {}
+    for minute, shard, n in entries:
+        websafeKey = websafeKeys.get(_touchedKey(minute, shard, n))
+        if websafeKey:
+            counters[_counterKey(minute, shard, websafeKey)] = (websafeKey, minute)
+    counts = memcache.get_multi(counters.keys(), namespace=MEMCACHE_TRENDING_NAMESPACE)
+
+    result = {}
+    for key, (websafeKey, minute) in counters.items():
+        perMinute = result.setdefault(websafeKey, {})
+        perMinute[minute] = perMinute.get(minute, 0) + int(counts.get(key, 0))
+    return result
+
+
+def flush(now=None):
+    """Fold the registrations of every complete minute since the last flush into the decayed scores.
+    Returns the updated `TrendingScores`.
+    """
+    current = _minute(now)
+    state = SCORES_KEY.get() or TrendingScores(key=SCORES_KEY, scores={}, top=[],
+                                               flushedMinute=current - MAX_FLUSH_MINUTES - 1)
+    minutes = range(max(state.flushedMinute + 1, current - MAX_FLUSH_MINUTES), current)
+    if not minutes:
+        return state
+
+    # decay per minute, so scores at the end of the last complete minute are comparable
+    decay = math.exp(-math.log(2) * 60 / TRENDING_HALF_LIFE)
+    last = minutes[-1]
+    scores = dict((key, score * decay ** (last - state.flushedMinute)) for key, score in state.scores.items())
+    for websafeKey, perMinute in _readMinutes(minutes).items():
+        scores[websafeKey] = scores.get(websafeKey, 0) + sum(
+            count * decay ** (last - minute) for minute, count in perMinute.items())
+
+    tracked = heapq.nlargest(TRENDING_MAX_TRACKED, ((score, key) for key, score in scores.items()
+                                                    if score >= TRENDING_MIN_SCORE))
+    state.scores = dict((key, score) for score, key in tracked)
+    state.top = [key for score, key in tracked[:TRENDING_TOP_K]]
+    state.flushedMinute = last
+    state.put()
+    memcache.set(MEMCACHE_TRENDING_TOP_KEY, state.top, namespace=MEMCACHE_TRENDING_NAMESPACE)
+    return state
+
+
+@ndb.transactional()
+def forget(conf_key):
+    """Drop `conf_key` (e.g. a deleted conference) from the trending scores."""
+    state = SCORES_KEY.get()
+    websafeKey = conf_key.urlsafe()
+    if not state or websafeKey not in state.scores:
+        return
+    del state.scores[websafeKey]
+    state.top = [key for key in state.top if key != websafeKey]
+    state.put()
+    ndb.get_context().call_on_commit(
+        lambda: memcache.delete(MEMCACHE_TRENDING_TOP_KEY, namespace=MEMCACHE_TRENDING_NAMESPACE))
+
+
+def top(limit=TRENDING_TOP_K):
+    """Return the keys of the trending conferences, hottest first."""
+    websafeKeys = memcache.get(MEMCACHE_TRENDING_TOP_KEY, namespace=MEMCACHE_TRENDING_NAMESPACE)
+    if websafeKeys is None:
+        state = SCORES_KEY.get()
+        websafeKeys = state.top if state else []
+        memcache.set(MEMCACHE_TRENDING_TOP_KEY, websafeKeys, namespace=MEMCACHE_TRENDING_NAMESPACE)
+    return [ndb.Key(urlsafe=websafeKey) for websafeKey in websafeKeys[:limit]]
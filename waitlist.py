@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+waitlist.py -- FIFO waitlist for sold-out conferences
+
+Instead of retrying `registerForConference` on a sold-out conference,
+users join its waitlist. The waitlist is a root entity of its own, so
+joining is a small append that never writes to the conference's entity
+group:
+
+    Waitlist(id=<websafe conference key>)   head and tail sequence numbers
+        WaitlistEntry(id=<sequence>)        the user who took that number
+        WaitlistMember(id=<user id>)        the user's sequence number
+
+A user's position is their sequence number minus `head`, read with a
+single batch get. When a seat is freed, a task promotes the waiters in
+order, one transaction per waiter, until the conference is full again or
+the waitlist is empty.
+
+"""
+
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import Waitlist
+from models import WaitlistEntry
+from models import WaitlistMember
+import analytics
+import hotcache
+import tasks
+import trending
+
+# waiters promoted (or skipped) per task before it chains the next one
+PROMOTIONS_PER_TASK = 20
+
+
+def waitlistKey(conf_key):
+    """Return the key of the waitlist of `conf_key`."""
+    return ndb.Key(Waitlist, conf_key.urlsafe())
+
+
+@ndb.transactional()
+def join(conf_key, user_id):
+    """Append `user_id` to the waitlist of `conf_key` and return their position.
+    A user who is already waiting keeps their place.
+    """
+    wl_key = waitlistKey(conf_key)
+    wl, member = ndb.get_multi([wl_key, ndb.Key(WaitlistMember, user_id, parent=wl_key)])
+    wl = wl or Waitlist(key=wl_key)
+    if member and member.sequence > wl.head:
+        return member.sequence - wl.head
+    wl.tail += 1
+    ndb.put_multi([
+        wl,
+        WaitlistEntry(id=wl.tail, parent=wl_key, userId=user_id),
+        WaitlistMember(id=user_id, parent=wl_key, sequence=wl.tail)
+    ])
+    return wl.tail - wl.head
+
+
+def isWaiting(conf_key):
+    """Return True while users wait in the waitlist of `conf_key`, so freed seats are theirs."""
+    wl = waitlistKey(conf_key).get()
+    return bool(wl) and wl.head < wl.tail
+
+
+def position(conf_key, user_id):
+    """Return the position of `user_id` in the waitlist of `conf_key`: 1 is next in line, 0 when not waiting.
+    Waiters ahead who registered on their own are still counted until the promotion task skips them.
+    """
+    wl_key = waitlistKey(conf_key)
+    wl, member = ndb.get_multi([wl_key, ndb.Key(WaitlistMember, user_id, parent=wl_key)])
+    if not wl or not member or member.sequence <= wl.head:
+        return 0
+    return member.sequence - wl.head
+
+
+@ndb.transactional(xg=True)
+def _promoteNext(conf_key):
+    """Register the next waiter if a seat is free.
+    Returns True when a waiter was promoted or skipped, False when there is nothing to do.
+    """
+    wl = waitlistKey(conf_key).get()
+    if not wl or wl.head >= wl.tail:
+        return False
+    conf = conf_key.get()
+    if not conf or conf.deleted or conf.seatsAvailable <= 0:
+        return False
+
+    wl.head += 1
+    entry = ndb.Key(WaitlistEntry, wl.head, parent=wl.key).get()
+    prof = ndb.Key(Profile, entry.userId).get()
+    if prof and conf.key not in prof.conferenceKeysToAttend:
+        prof.conferenceKeysToAttend.append(conf.key)
+        conf.seatsAvailable -= 1
+        ndb.put_multi([wl, prof, conf, analytics.registrationEvent(conf.key, 1)])
+        hotcache.invalidate(conf.key)
+        ndb.get_context().call_on_commit(lambda: trending.record(conf_key))
+    else:
+        # the waiter registered on their own, or is gone
+        wl.put()
+    return True
+
+
+def promote(conf_key, limit=PROMOTIONS_PER_TASK):
+    """Promote waiters of `conf_key` into its free seats, chaining another task after `limit` waiters.
+    Returns the number of waiters promoted or skipped.
+    """
+    count = 0
+    while count < limit and _promoteNext(conf_key):
+        count += 1
+    if count == limit:
+        tasks.promoteWaitlistTask(conf_key).add()
+    return count